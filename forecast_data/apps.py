@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class ForecastDataConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'forecast_data'
+
+    def ready(self):
+        # state registry invalidation on system_state changes
+        from forecast_data import signals
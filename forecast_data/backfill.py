@@ -0,0 +1,180 @@
+'''
+Date ranges, manifests and the bounded pool of the forecast processing
+commands (gen_ecmwf_hres_raster, update_state_ecmwf_hres_nc)
+
+Dates are given as yyyymmdd, yyyymmdd:yyyymmdd ranges (both included)
+or comma separated lists of both. Every processed date leaves a manifest
+in FCST_MANIFEST_DIR/<command>/<yyyymmdd>.json with the input file's
+mtime and size, the options of the run and a checksum of every output,
+a date whose manifest still matches is skipped without opening the
+input file.
+
+Dates run in a forked process pool of at most --jobs processes, each
+date in its own process so a failing date does not stop the others.
+States only move forward, a backfill of older dates keeps the state on
+the newest run.
+'''
+import os
+import json
+import time
+import hashlib
+import tempfile
+import multiprocessing
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.db import connections
+
+from forecast_data.models import system_state
+
+
+DATE_FORMAT = '%Y%m%d'
+DONE, SKIPPED, FAILED = 'done', 'skipped', 'failed'
+
+
+def parse_dates(specs):
+    '''
+    sorted unique dates of yyyymmdd, yyyymmdd:yyyymmdd and comma lists,
+    raises ValueError
+    '''
+    dates = set()
+    for spec in specs:
+        for part in filter(None, spec.split(',')):
+            first, _, last = part.partition(':')
+            start = datetime.strptime(first, DATE_FORMAT)
+            end = datetime.strptime(last, DATE_FORMAT) if last else start
+            if end < start:
+                raise ValueError(f'date range {part} ends before it starts')
+            while start <= end:
+                dates.add(start)
+                start += timedelta(days=1)
+    return sorted(dates)
+
+
+def input_stat(path):
+    # raises FileNotFoundError
+    stat = os.stat(path)
+    return {'path': path, 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as rf:
+        for block in iter(lambda: rf.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def options_digest(options):
+    return hashlib.sha1(json.dumps(options, sort_keys=True).encode()).hexdigest()
+
+
+def outputs_digest(root, names):
+    # {name: sha1} of files under root, None for missing files
+    digests = dict()
+    for name in names:
+        try:
+            digests[name] = file_digest(os.path.join(root, name))
+        except FileNotFoundError:
+            digests[name] = None
+    return digests
+
+
+def manifest_path(command, date):
+    path = os.path.join(settings.FCST_MANIFEST_DIR, command)
+    os.makedirs(path, exist_ok=True)
+    return os.path.join(path, date.strftime(DATE_FORMAT) + '.json')
+
+
+def load_manifest(command, date):
+    try:
+        with open(manifest_path(command, date)) as rf:
+            return json.load(rf)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def save_manifest(command, date, manifest):
+    path = manifest_path(command, date)
+    fd, temp_path = tempfile.mkstemp(prefix='tmp.', dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as wf:
+        json.dump(manifest, wf, indent=1)
+    os.replace(temp_path, path)
+
+
+def is_current(manifest, source, options, root=None):
+    '''
+    True if manifest was made from the same input file and options and
+    all its outputs under root are unchanged
+    '''
+    if manifest is None:
+        return False
+    if manifest.get('input') != source or manifest.get('options') != options_digest(options):
+        return False
+    outputs = manifest.get('outputs', dict())
+    return outputs_digest(root, outputs) == outputs if outputs else True
+
+
+def run_dates(func, dates, options, jobs=1):
+    '''
+    func(date, options) -> result dict with at least 'status', for every
+    date in at most jobs forked processes
+    returns [(date, result)] in date order, failures as FAILED results
+    '''
+    def failed(e):
+        return {'status': FAILED, 'message': str(e) or type(e).__name__}
+
+    if jobs <= 1 or len(dates) <= 1:
+        results = []
+        for date in dates:
+            try:
+                results.append((date, func(date, options)))
+            except Exception as e:
+                results.append((date, failed(e)))
+        return results
+
+    # forked processes must not share the parent's database connections
+    connections.close_all()
+    with ProcessPoolExecutor(
+        max_workers=jobs, mp_context=multiprocessing.get_context('fork')
+    ) as pool:
+        futures = [(date, pool.submit(func, date, options)) for date in dates]
+
+    results = []
+    for date, future in futures:
+        try:
+            results.append((date, future.result()))
+        except Exception as e:
+            results.append((date, failed(e)))
+    return results
+
+
+def latest_done(results):
+    # result of the latest date that was processed or skipped
+    for date, result in reversed(results):
+        if result['status'] != FAILED:
+            return date, result
+    return None, None
+
+
+def newer_state(state_name, init_time):
+    '''
+    stored init_time of state_name if it is newer than init_time, None if
+    the state may move to init_time, yyyymmdd_hh strings sort by time
+    '''
+    stored = system_state.objects.filter(state_name=state_name).values_list('init_time', flat=True).first()
+    return stored if stored is not None and stored > init_time else None
+
+
+def print_summary(results, tic):
+    counts = {status: 0 for status in (DONE, SKIPPED, FAILED)}
+    for date, result in results:
+        counts[result['status']] += 1
+        if result['status'] == FAILED:
+            print(f"{date.strftime(DATE_FORMAT)}: failed :: {result['message']}")
+
+    print(
+        f"{len(results)} dates: {counts[DONE]} done, {counts[SKIPPED]} skipped, "
+        f"{counts[FAILED]} failed ({time.perf_counter() - tic:.2f}s)"
+    )
@@ -0,0 +1,230 @@
+'''
+Background jobs of large forecast subsets
+
+A job is a subset request accepted right away and built by a bounded
+thread pool of the worker process that received it, no broker is
+needed. The subset_job table holds the request params, the status and
+the progress, so the status and download endpoints work from any worker.
+
+Finished files are linked from the subset cache into FCST_JOB_DIR under
+the job id and removed FCST_JOB_TTL seconds later by expire_jobs, which
+runs on every submit and from the expire_subset_jobs command.
+
+A heartbeat thread of every worker touches updated_at of the jobs queued
+or running in it each FCST_JOB_HEARTBEAT seconds, also while a job sits
+in one long read. A running job is timed from its start or its last
+heartbeat, a job without a heartbeat for FCST_JOB_TIMEOUT seconds was
+lost with its worker process and is marked failed. Jobs waiting in the
+queue of a live worker are never failed.
+'''
+import os
+import time
+import uuid
+import shutil
+import threading
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.datastructures import MultiValueDict
+
+from forecast_data import subset_cache
+from forecast_data.models import subset_job
+from forecast_data.subset import make_subset, subset_filename, SubsetError
+from forecast_data.request_params import get_subset_params
+
+
+ACTIVE = (subset_job.QUEUED, subset_job.RUNNING)
+
+# progress is written to the database at most every this many fractions
+PROGRESS_STEP = 0.05
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# pks of the jobs queued or running in this process
+_jobs = set()
+
+
+def executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.FCST_JOB_WORKERS, thread_name_prefix='subset_job'
+            )
+            threading.Thread(target=heartbeat, name='subset_job_heartbeat', daemon=True).start()
+    return _executor
+
+
+def enqueue(pk):
+    with _executor_lock:
+        _jobs.add(pk)
+    executor().submit(run_job, pk)
+
+
+def local_jobs():
+    with _executor_lock:
+        return set(_jobs)
+
+
+def touch_jobs():
+    # heartbeat of the jobs of this process, returns the number touched
+    pks = local_jobs()
+    if not pks:
+        return 0
+    return subset_job.objects.filter(pk__in=pks, status__in=ACTIVE).update(updated_at=timezone.now())
+
+
+def heartbeat():
+    # runs in a daemon thread as long as the process
+    while True:
+        time.sleep(settings.FCST_JOB_HEARTBEAT)
+        try:
+            touch_jobs()
+        except Exception:
+            # the next beat tries again, a lasting outage fails the jobs
+            pass
+        finally:
+            connections.close_all()
+
+
+def job_dir():
+    path = settings.FCST_JOB_DIR
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def job_file(job):
+    return os.path.join(job_dir(), str(job.job_id))
+
+
+def job_info(job):
+    info = {
+        'job_id': str(job.job_id),
+        'status': job.status,
+        'progress': round(job.progress, 3),
+        'status_url': reverse('forecast.subset_job', args=[job.job_id]),
+    }
+    if job.message:
+        info['message'] = job.message
+    if job.status == subset_job.DONE:
+        info['download_url'] = reverse('forecast.subset_job_download', args=[job.job_id])
+        info['file_name'] = job.file_name
+        info['file_size'] = job.file_size
+        info['expires_at'] = job.expires_at.isoformat()
+    return info
+
+
+def submit_job(state_name, params):
+    '''
+    queues a subset of state_name for the request params,
+    name -> list of values, raises JobQueueFull
+    '''
+    expire_jobs()
+
+    active = subset_job.objects.filter(status__in=ACTIVE).count()
+    if active >= settings.FCST_JOB_MAX_QUEUED:
+        raise JobQueueFull(f'{active} subset jobs are waiting, try again later')
+
+    job = subset_job.objects.create(job_id=uuid.uuid4(), state_name=state_name, params=params)
+    # the job row has to be visible to the pool thread
+    transaction.on_commit(lambda: enqueue(job.pk))
+    return job
+
+
+def run_job(pk):
+    # runs in a pool thread, which has its own database connection
+    try:
+        job = subset_job.objects.get(pk=pk)
+        job.status = subset_job.RUNNING
+        job.save(update_fields=['status', 'updated_at'])
+
+        reported = [0.0]
+
+        def progress(fraction):
+            if fraction - reported[0] >= PROGRESS_STEP or fraction >= 1:
+                reported[0] = fraction
+                subset_job.objects.filter(pk=pk).update(progress=fraction, updated_at=timezone.now())
+
+        try:
+            kwargs = get_subset_params(MultiValueDict(job.params))
+            subset_file, key, update = make_subset(
+                state_name=job.state_name, ECMWF_NC=settings.ECMWF_HRES_NC, progress=progress, **kwargs
+            )
+            with subset_file:
+                store_file(job, subset_file, key)
+        except (SubsetError, ValueError) as e:
+            message = f'{e.error} :: {e.message}' if isinstance(e, SubsetError) else str(e)
+            fail_job(job, message)
+            return
+        except Exception as e:
+            fail_job(job, f'subset failed :: {e}')
+            raise
+
+        job.status = subset_job.DONE
+        job.progress = 1
+        job.init_time = update
+        job.file_name = subset_filename(
+            job.state_name, kwargs['top_lat'], kwargs['bottom_lat'],
+            kwargs['right_lon'], kwargs['left_lon'], kwargs['fmt']
+        )
+        job.file_size = os.path.getsize(job_file(job))
+        job.expires_at = timezone.now() + timedelta(seconds=settings.FCST_JOB_TTL)
+        job.save()
+    finally:
+        with _executor_lock:
+            _jobs.discard(pk)
+        connections.close_all()
+
+
+def store_file(job, subset_file, key):
+    '''
+    links the cached subset to the job's path, copies it from the open
+    file when it was evicted meanwhile or links are not supported
+    '''
+    path = job_file(job)
+    temp_path = f'{path}.tmp'
+    subset_cache.remove(temp_path)
+    try:
+        os.link(os.path.join(subset_cache.cache_dir(), key + subset_cache.SUFFIX), temp_path)
+    except OSError:
+        with open(temp_path, 'wb') as wf:
+            shutil.copyfileobj(subset_file, wf)
+    os.replace(temp_path, path)
+
+
+def fail_job(job, message):
+    job.status = subset_job.FAILED
+    job.message = message
+    job.save(update_fields=['status', 'message', 'updated_at'])
+
+
+def expire_jobs():
+    '''
+    removes the files of expired jobs and fails lost ones, jobs without a
+    heartbeat for FCST_JOB_TIMEOUT seconds, returns the number of jobs changed
+    '''
+    now = timezone.now()
+
+    expired = subset_job.objects.filter(status=subset_job.DONE, expires_at__lte=now)
+    for job in expired:
+        subset_cache.remove(job_file(job))
+    changed = expired.update(status=subset_job.EXPIRED)
+
+    # the jobs of this process are alive whatever their heartbeat says
+    changed += subset_job.objects.filter(
+        status__in=ACTIVE, updated_at__lte=now - timedelta(seconds=settings.FCST_JOB_TIMEOUT)
+    ).exclude(
+        pk__in=local_jobs()
+    ).update(status=subset_job.FAILED, message='job lost, its worker stopped before it finished')
+
+    return changed
@@ -0,0 +1,80 @@
+'''
+Scaling benchmark of gen_ecmwf_hres_raster --workers
+
+Makes the rasters of one date with every worker count into a temporary
+directory, the system states and manifests are not touched. Reports the
+best of --repeat runs, the speedup over the first count and whether all
+counts wrote the same files. Scaling is only measured up to the CPUs of
+the host, counts beyond them are flagged.
+
+    python manage.py bench_ecmwf_hres_raster 20231202 --workers 1 2 4 8
+'''
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from forecast_data.management.commands.gen_ecmwf_hres_raster import Command as RasterCommand, UFG
+from forecast_data.ufgrid import COMPRESSIONS, ZLIB
+
+
+def tree_digest(root):
+    digest = hashlib.sha1()
+    for path, _, names in sorted(os.walk(root)):
+        for name in sorted(names):
+            digest.update(os.path.relpath(os.path.join(path, name), root).encode())
+            with open(os.path.join(path, name), 'rb') as rf:
+                digest.update(rf.read())
+    return digest.hexdigest()
+
+
+class Command(BaseCommand):
+
+    help = 'benchmark gen_ecmwf_hres_raster over worker counts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('date', type=str, help="forecast date in yyyymmdd format")
+        parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8], help="worker counts to run")
+        parser.add_argument('--repeat', type=int, default=3, help="runs per worker count, the best is reported")
+        parser.add_argument('--compression', type=str, choices=COMPRESSIONS, default=ZLIB)
+
+    def handle(self, *args, **options):
+        try:
+            date_obj = datetime.strptime(options['date'], '%Y%m%d')
+        except ValueError:
+            raise CommandError('date must be formatted as yyyymmdd')
+
+        cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+        print(f'date: {options["date"]}, cpus: {cpus}, best of {options["repeat"]} runs')
+        print(f'{"workers":>8} {"seconds":>9} {"speedup":>8}  output')
+
+        base, reference = None, None
+        for workers in options['workers']:
+            best, digest = None, None
+            for _ in range(options['repeat']):
+                seconds, digest = self.run(date_obj, workers, options['compression'])
+                best = seconds if best is None else min(best, seconds)
+
+            base = base or best
+            reference = reference or digest
+            print(
+                f'{workers:>8} {best:>9.3f} {base / best:>7.2f}x  '
+                + ('same' if digest == reference else 'DIFFERENT')
+                + ('  (more workers than cpus, not a scaling measurement)' if workers > cpus else '')
+            )
+
+    def run(self, date_obj, workers, compression):
+        command = RasterCommand()
+        command.configure({'format': UFG, 'compression': compression, 'workers': workers, 'force': True})
+        command.root_path = tempfile.mkdtemp(prefix='bench_hres_raster.')
+        try:
+            tic = time.perf_counter()
+            command.gen_hres_raster_json(date_obj)
+            seconds = time.perf_counter() - tic
+            return seconds, tree_digest(command.root_path)
+        finally:
+            shutil.rmtree(command.root_path, ignore_errors=True)
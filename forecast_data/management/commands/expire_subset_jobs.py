@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from forecast_data.jobs import expire_jobs
+
+
+class Command(BaseCommand):
+
+    help = 'Remove the files of expired subset jobs and fail jobs lost with their worker'
+
+    def handle(self, *args, **options):
+        print(f'{expire_jobs()} subset jobs expired or failed')
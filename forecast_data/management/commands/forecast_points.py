@@ -0,0 +1,84 @@
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from forecast_data.models import system_state
+from forecast_data.ncio import coord_index
+from forecast_data.points import (
+    extract_points, write_points, check_variables, station_points, latlon_points, METHODS, NEAREST
+)
+from forecast_data.subset import FORMATS, JSON
+
+
+class Command(BaseCommand):
+
+    help = 'Extract ECMWF HRES forecast time series at stations and lat/lon points'
+    state_name = "ECMWF_HRES_NC"
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', type=str, help="output file")
+        parser.add_argument('--date', type=str, default=None, help="forecast date in yyyymmdd format, default current state")
+        parser.add_argument('--variables', type=str, nargs='+', required=True, help="netcdf variable names")
+        parser.add_argument('--station', type=int, nargs='+', default=None, help="obs_data station ids")
+        parser.add_argument('--point', type=str, action='append', default=[], help="free point as lat,lon, repeatable")
+        parser.add_argument('--method', type=str, choices=METHODS, default=NEAREST)
+        parser.add_argument('--format', type=str, choices=FORMATS, default=JSON)
+        parser.add_argument('--lead-start', type=float, default=None, help="first lead time in hours")
+        parser.add_argument('--lead-end', type=float, default=None, help="last lead time in hours")
+        parser.add_argument('--significant-digits', type=int, default=None)
+
+    def handle(self, *args, **options):
+        tic = time.perf_counter()
+
+        if options['date']:
+            date_obj = datetime.strptime(options['date'], '%Y%m%d')
+        else:
+            init_time = system_state.objects.get(state_name=self.state_name).init_time
+            date_obj = datetime.strptime(init_time, '%Y%m%d_%H')
+        nc_path = date_obj.strftime(settings.ECMWF_HRES_NC)
+
+        try:
+            lats, lons = zip(*(map(float, point.split(',')) for point in options['point']))
+        except ValueError:
+            if options['point']:
+                raise CommandError('points must be given as lat,lon')
+            lats, lons = (), ()
+
+        # all stations unless only free points are asked for
+        points = []
+        if options['station'] is not None or not lats:
+            try:
+                points.extend(station_points(options['station']))
+            except KeyError as e:
+                raise CommandError(f'station id does not exist :: {e}')
+        points.extend(latlon_points(lats, lons))
+
+        try:
+            index = coord_index(nc_path)
+        except FileNotFoundError:
+            raise CommandError(f'forecast file does not exist :: {nc_path}')
+
+        try:
+            check_variables(index, options['variables'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        time_slice = index.time_slice(options['lead_start'], options['lead_end'])
+        if time_slice is None:
+            raise CommandError('selected time window not available')
+
+        values, attrs = extract_points(
+            nc_path, index, points, options['variables'], options['method'], time_slice
+        )
+        write_points(
+            options['format'], options['output'], points, index, time_slice,
+            values, attrs, options['significant_digits']
+        )
+
+        print(
+            f"{len(points)} points x {len(index.times[time_slice])} time steps x "
+            f"{len(values)} variables -> {options['output']} "
+            f"({time.perf_counter() - tic:.2f}s)"
+        )
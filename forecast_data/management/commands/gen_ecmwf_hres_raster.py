@@ -5,6 +5,9 @@ Generate JSON data for ECMWF HERS forecast
 - Temporal Reduction : Daily 
 - Stream Name        : R1Dxxx
 - Lead Time          : 10 Day
+- Raster Format      : binary ufg (forecast_data.ufgrid), json as fallback
+- Products           : forecast_data/products.yaml, all products of the
+                       source from one read of the bbox around their regions
 
 Author: Nazmul Ahasan
 email: nazmul@rimes.int / nzahasan@gmail.com
@@ -12,127 +15,174 @@ email: nazmul@rimes.int / nzahasan@gmail.com
 '''
 import os
 import json
+import time
+import shutil
+import resource
+import tempfile
+import multiprocessing
 import numpy as np
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
 from django.conf import settings
 from forecast_data.models import *  
-from netCDF4 import Dataset as nco, num2date as n2d
+from forecast_data.ncio import coord_index, open_dataset
+from forecast_data.ufgrid import write_ufg, COMPRESSIONS, ZLIB
+from forecast_data.products import get_registry
+from forecast_data.backfill import (
+    parse_dates, input_stat, load_manifest, save_manifest, is_current, options_digest,
+    outputs_digest, run_dates, latest_done, newer_state, print_summary, DONE, SKIPPED
+)
+from netCDF4 import num2date as n2d
 from django.core.management.base  import BaseCommand, CommandError
 from datetime import datetime as dt
 from  yaspin import yaspin
 
 
-class Command(BaseCommand):
+UFG, JSON = 'ufg', 'json'
+RASTER_FORMATS = (UFG, JSON)
 
-    help="generate raster of ecmwf hres forecast"
+# state of a raster worker process, see Command.run_parallel
+_worker = dict()
 
-    source = 'ECMWF_HRES'
-    sys_state = 'ECMWF_HRES_VIS'
-    source_obj = forecast_source.objects.get(name=source)
-    daily_step = 4
-    lead_day = 10
-    sim_time = 0 # simulation utc time
-    root_path = os.path.join(settings.FCST_JSONOUT,source)
-    
-    temp_cinf = {
-        'name':'plasma',
-        'stops': 100,
-        'extend_min': True,
-        'extend_max': True,
-        'reversed': False,
-        'range':[-10,45]
-    }
 
-    rh_cinf = {
-        'name': 'summer',
-        'stops': 100,
-        'extend_min': True,
-        'extend_max': True,
-        'reversed': True,
-        'range':[5,95]
+def init_worker(command, paths):
+    _worker['command'] = command
+    _worker['arrays'] = {
+        var_name: np.load(path, mmap_mode='r') for var_name, path in paths.items()
     }
 
-    rf_cinf = {
-        'name': 'Spectral',
-        'stops': 100,
-        'extend_min': False,
-        'extend_max': True,
-        'reversed': True,
-        'range':[1,250]
-    }
 
-    ws_cinf = {
-        'name': 'YlGnBu',
-        'stops': 100,
-        'extend_min': True,
-        'extend_max': True,
-        'reversed': False,
-        'range':[1,110]
-    }
+def raster_date(date_obj, options):
+    # one date of a run, also the job of a --jobs process
+    command = Command()
+    command.configure(options)
+    return command.process_date(date_obj)
 
-    finfo = {
-        'time':[],
-        'params':{
-            'rf': {
-                'fullname':'Rainfall',
-                'unit':'mm',
-                'cinf': rf_cinf,
-                'fa_icon':'fal fa-raindrops',
-            },
-            'tmin': { 
-                'fullname':'Temperature Min',
-                'unit':'°C',
-                'cinf': temp_cinf,
-                'fa_icon':'fal fa-thermometer-quarter',
-            },
-            'tmax': {
-                'fullname':'Temperature Max',
-                'unit':'°C',
-                'cinf': temp_cinf,
-                'fa_icon':'fal fa-thermometer-three-quarters',
-            },
-            'wsavg': {
-                'fullname':'Wind Speed Avg',
-                'unit':'kmph',
-                'cinf': ws_cinf,
-                'fa_icon':'fal fa-wind',
-            },
-
-            'rhavg': {
-                'fullname':'Relative Humidity Avg',
-                'unit':'%',
-                'cinf': rh_cinf,
-                'fa_icon':'fal fa-humidity',
-            },
-        },
-        
-        'file_suffix' :[]
-    }
+
+def raster_task(var_name, iday, lats, lons, adate):
+    command = _worker['command']
+    window = command.shared_window(_worker['arrays'], command.day_slice(iday))
+    return command.save_variable_day(var_name, iday, window, lats, lons, adate)
+
+
+class Command(BaseCommand):
+
+    help="generate raster of ecmwf hres forecast"
+
+    source = 'ECMWF_HRES'
+    manifest_name = 'gen_ecmwf_hres_raster'
+    source_obj = forecast_source.objects.get(name=source)
+    sim_time = 0 # simulation utc time
+    root_path = settings.FCST_JSONOUT
 
     def add_arguments(self, parser):
-        parser.add_argument('date', type=str, help="forecast date in yyyymmdd format")
+        parser.add_argument('date', type=str, nargs='+', help="forecast dates, yyyymmdd, yyyymmdd:yyyymmdd or comma separated")
+        parser.add_argument('--format', type=str, choices=RASTER_FORMATS, default=UFG, help="binary ufg rasters, or json as fallback")
+        parser.add_argument('--compression', type=str, choices=COMPRESSIONS, default=ZLIB, help="payload compression of ufg rasters")
+        parser.add_argument('--workers', type=int, default=1, help="processes making the (parameter, day) rasters, 1 -> serial")
+        parser.add_argument('--jobs', type=int, default=1, help="dates processed at the same time")
+        parser.add_argument('--force', action='store_true', help="rebuild dates whose manifest is current")
 
 
     def handle(self,*args,**kwargs):
 
-        try:        
-            date_obj = dt.strptime(kwargs['date'],'%Y%m%d')
-            with yaspin() as ysp:
-                ysp.text = "Processing ECMWF_HRES_VIS. "
-                self.gen_hres_raster_json(date_obj)
-        except Exception as e:
-            print(e)
-
-    def update_state(self,forecast_date):
+        tic = time.perf_counter()
+        self.configure(kwargs)
+
+        try:
+            dates = parse_dates(kwargs['date'])
+        except ValueError as e:
+            raise CommandError(f'invalid date :: {e}')
+
+        if kwargs['jobs'] > 1 and self.workers > 1:
+            raise CommandError('--jobs and --workers can not be combined')
+
+        text = f"Processing {self.source} rasters, {len(dates)} dates. "
+        # --jobs and --workers fork, the spinner's thread must not be
+        # writing to stdout while the process is forked
+        forks = kwargs['jobs'] > 1 or self.workers > 1
+        if forks:
+            print(text)
+        with (nullcontext() if forks else yaspin(text=text)):
+            results = run_dates(raster_date, dates, kwargs, kwargs['jobs'])
+
+        # the map shows the latest forecast run of the dates
+        _, latest = latest_done(results)
+        if latest is not None:
+            for product in self.products.values():
+                self.update_state(product['state'], latest['adate'])
+
+        print_summary(results, tic)
+
+        # ru_maxrss is in kilobytes on linux, children -> largest worker
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        worker_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+        print(
+            f'runtime: {time.perf_counter() - tic:.2f}s, peak rss: {peak_rss:.1f} MB'
+            + (f', worker peak rss: {worker_rss:.1f} MB' if self.workers > 1 else '')
+        )
+
+    def configure(self, options:dict):
+        self.raster_format = options['format']
+        self.compression = options['compression']
+        self.workers = options['workers']
+        self.force = options['force']
+
+        self.registry = get_registry()
+        if self.source not in self.registry.sources:
+            raise CommandError(f'{self.source} is not a source of {settings.FCST_PRODUCTS_FILE}')
+        self.products = self.registry.source_products(self.source)
+        self.raster_vars = self.registry.source_variables(self.source)
+        self.window_vars, self.accumulated_vars = self.registry.inputs(self.raster_vars)
+
+        source = self.registry.sources[self.source]
+        self.nc_path = getattr(settings, source['nc_path'])
+        self.daily_step = source['daily_step']
+        self.lead_day = source['lead_day']
+
+
+    def process_date(self, date_obj:dt)->dict:
+        # rasters of one date unless its manifest is still current
+        nc_filename = date_obj.strftime(self.nc_path)
+        source = input_stat(nc_filename)
+        options = {
+            'format': self.raster_format,
+            'compression': self.compression,
+            # products, regions, variables and colormaps, a change rebuilds the rasters
+            'products': self.registry.source_config(self.source),
+        }
+
+        manifest = load_manifest(self.manifest_name, date_obj)
+        if not self.force and is_current(manifest, source, options, self.root_path):
+            return {'status': SKIPPED, 'adate': manifest['adate']}
+
+        adate, outputs = self.gen_hres_raster_json(date_obj)
+        save_manifest(self.manifest_name, date_obj, {
+            'input': source,
+            'options': options_digest(options),
+            'adate': adate,
+            # relative to root_path
+            'outputs': outputs_digest(self.root_path, outputs),
+        })
+        return {'status': DONE, 'adate': adate}
+
+
+    def update_state(self,sys_state,forecast_date):
         # update system state
 
-        if system_state.objects.filter(state_name=self.sys_state,source=self.source_obj).count():
-            print('State exists. updating..')
-            state = system_state.objects.get(state_name=self.sys_state,source=self.source_obj)
+        newer = newer_state(sys_state, forecast_date)
+        if newer is not None:
+            print(f'State {sys_state} is at the newer run {newer}. keeping..')
+            return
+
+        if system_state.objects.filter(state_name=sys_state,source=self.source_obj).count():
+            print(f'State {sys_state} exists. updating..')
+            state = system_state.objects.get(state_name=sys_state,source=self.source_obj)
             state.init_time = forecast_date
             state.save()
         else:
-            print('State dosent exists. Creating..')
-            system_state(state_name=self.sys_state,source=self.source_obj,init_time=forecast_date).save()			
+            print(f'State {sys_state} dosent exists. Creating..')
+            system_state(state_name=sys_state,source=self.source_obj,init_time=forecast_date).save()			
 
 
 
@@ -158,9 +208,13 @@ class Command(BaseCommand):
 
         data['sf'] = scale_factor
 
+        if self.raster_format == UFG:
+            write_ufg(out_file, data, arr2d, self.compression)
+            return True
+
         data['data'] = (arr2d.flatten()*scale_factor).astype(int).tolist(fill_value=-9999*scale_factor)
 
-        with open(os.path.join(self.outpath,out_file),'w') as wf:
+        with open(out_file,'w') as wf:
             json.dump(data,wf,separators=(',', ':'))
             return True 
 
@@ -168,115 +222,188 @@ class Command(BaseCommand):
 
 
 
-    def calc_rh(self, temp:np.ndarray, dewtemp:np.ndarray)->np.ndarray:
+    def day_slice(self, iday:int)->slice:
+        # time steps of lead day iday, both ends included
+        start_idx = iday * self.daily_step
+        end_idx = start_idx + self.daily_step
+        return slice(start_idx, end_idx+1)
 
-        ''' 
-        Using, August–Roche–Magnus approximation
-        RH = 100*( EXP( (17.625*TD) / (243.04+TD) ) / EXP( (17.625*T) / (243.04+T) ) )
 
-        a = 17.625
-        b = 243.04
+    def file_suffix(self, adate:str, iday:int)->str:
+        return f'{adate}.d{iday:02d}.{self.raster_format}'
 
-        ** 6.1094 ommited cause will calucate fraction later
-        es_td = (a*TD)/(b+TD)
-        es_t  = (a*T) /(b+T)
 
-        RH = 100*( exp(es_td) / exp(es_t) ) 
+    def save_variable_day(self, var_name:str, iday:int, window:dict, lats:np.ndarray, lons:np.ndarray, adate:str)->list:
+        '''
+        daily var_name of the window, reduced once and cut to the region
+        of every product of the variable, returns the files relative to
+        root_path
+        '''
+        values = self.registry.reduce(var_name, window, iday)
+        out_files = []
+        for name, product in self.products.items():
+            if var_name not in product['variables']:
+                continue
+            lat_cut, lon_cut = self.cuts[name]
+            out_file = os.path.join(product['output'], adate, f'{var_name}.{self.file_suffix(adate, iday)}')
+            self.save_ufgrid(
+                lats[lat_cut], lons[lon_cut], values[lat_cut, lon_cut], -9999, True, 100,
+                os.path.join(self.root_path, out_file)
+            )
+            out_files.append(out_file)
+        return out_files
+
+
+    def run_parallel(self, nc_filename:str, lat_slice:slice, lon_slice:slice, lats:np.ndarray, lons:np.ndarray, adate:str):
         '''
-        a = 17.625
-        b = 243.04
+        (variable, day) rasters on a process pool, the bbox of all lead
+        days is read once into memory-mapped temporaries which the workers
+        map read-only, no array is pickled
+        '''
+        n_steps = self.day_slice(self.lead_day - 1).stop
+        tmpdir = tempfile.mkdtemp(prefix='hres_raster.')
+        try:
+            paths = dict()
+            with open_dataset(nc_filename) as nf:
+                for var_name in self.window_vars:
+                    data = nf.variables[var_name][0:n_steps, lat_slice, lon_slice]
+                    paths[var_name] = os.path.join(tmpdir, f'{var_name}.npy')
+                    shared = np.lib.format.open_memmap(paths[var_name], mode='w+', dtype=data.dtype, shape=data.shape)
+                    # masked cells are carried as nan
+                    shared[:] = np.ma.filled(data, np.nan)
+                    shared.flush()
+                    del shared, data
+
+            # workers are forked, they inherit the configured django and the command
+            with ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('fork'),
+                initializer=init_worker,
+                initargs=(self, paths),
+            ) as pool:
+                tasks = [
+                    pool.submit(raster_task, var_name, iday, lats, lons, adate)
+                    for iday in range(self.lead_day) for var_name in self.raster_vars
+                ]
+                for task in tasks:
+                    task.result()
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+    def shared_window(self, arrays:dict, time_slice:slice)->dict:
+        # same window as read_window, from the memory-mapped bbox
+        window = dict()
+        time_ends = [time_slice.start, time_slice.stop - 1]
+        for var_name in self.window_vars:
+            if var_name in self.accumulated_vars:
+                window[var_name] = np.ma.masked_invalid(arrays[var_name][time_ends])
+            else:
+                window[var_name] = np.ma.masked_invalid(arrays[var_name][time_slice])
+        return window
+
+
+    def read_window(self, nc_filename:str, time_slice:slice, lat_slice:slice, lon_slice:slice)->dict:
+        # hyperslab of the variables, only the first and last step of the accumulations
+        window = dict()
+        time_ends = [time_slice.start, time_slice.stop - 1]
+        with open_dataset(nc_filename) as nf:
+            for var_name in self.window_vars:
+                if var_name in self.accumulated_vars:
+                    window[var_name] = nf.variables[var_name][time_ends, lat_slice, lon_slice]
+                else:
+                    window[var_name] = nf.variables[var_name][time_slice, lat_slice, lon_slice]
+        return window
+
+
+    def region_cuts(self, index, nc_filename:str):
+        '''
+        (lat slice, lon slice) of the bbox around all product regions and
+        every product's region as slices of that bbox
+        '''
+        slices = dict()
+        for name, product in self.products.items():
+            region = self.registry.regions[product['region']]
+            slices[name] = index.bbox_slices(
+                region['top_lat'], region['bottom_lat'], region['right_lon'], region['left_lon']
+            )
+            if slices[name] is None:
+                raise ValueError(f"region {product['region']} of {name} is outside {nc_filename}")
+
+        lat_slice = slice(min(s[0].start for s in slices.values()), max(s[0].stop for s in slices.values()))
+        lon_slice = slice(min(s[1].start for s in slices.values()), max(s[1].stop for s in slices.values()))
+
+        self.cuts = {
+            name: (
+                slice(s[0].start - lat_slice.start, s[0].stop - lat_slice.start),
+                slice(s[1].start - lon_slice.start, s[1].stop - lon_slice.start),
+            )
+            for name, s in slices.items()
+        }
+        return lat_slice, lon_slice
 
-        es_td = (a * dewtemp) / (b + dewtemp)
-        es_t  = (a * temp)    / (b + temp)
 
-        return 100 * ( np.exp(es_td) / np.exp(es_t) )
-        
-        
     def gen_hres_raster_json(self,date_obj:dt):
         
         
-        nc_filename = date_obj.strftime(settings.ECMWF_HRES_NC)
+        nc_filename = date_obj.strftime(self.nc_path)
 
-        nf = nco(nc_filename,'r')
+        index = coord_index(nc_filename)
 
-        nclats = nf.variables['latitude'][:]
-        nclons = nf.variables['longitude'][:]
+        # one read for all products, regions are cut from it
+        lat_slice, lon_slice = self.region_cuts(index, nc_filename)
+        lats, lons = index.lats[lat_slice], index.lons[lon_slice]
         
-        bottom_lat, top_lat, left_lon, right_lon = 5.725, 10.16, 79.23, 82.35
-        lat_indices, lon_indices = np.where((nclats >= bottom_lat) & (nclats <= top_lat)), np.where((nclons >= left_lon) & (nclons <= right_lon))
-        lats, lons = nclats[lat_indices], nclons[lon_indices]
-        
-        times = n2d(nf.variables['time'][:],nf.variables['time'].units)
+        times = n2d(index.times, index.time_units)
 
         adate  = times[0].strftime('%Y%m%d_%H')
         
-        self.outpath = os.path.join(self.root_path,adate)
-
         # create path if not exists
-        if not os.path.exists(self.outpath): os.makedirs(self.outpath)
+        for product in self.products.values():
+            os.makedirs(os.path.join(self.root_path, product['output'], adate), exist_ok=True)
         
         # check if if grid is regular
-        if np.diff(lats,n=2).all() != 0 or np.diff(lons,n=2).all() != 0:
+        if not (index.lat.regular and index.lon.regular):
             print('warning: non regular grid')
 
-        lat_desc = True 
-
-        if lats[1]-lats[0] > 0:
-            lat_desc = False
-
-        rf = (nf.variables['lsp'][:] + nf.variables['cp'][:])*1000 # m2mm : *1000
-        
-        temp = nf.variables['t2m'][:] - 273.15 # k2dc : -273.15
-        
-        ws = np.sqrt( np.square(nf.variables['u10'][:]) + np.square(nf.variables['v10'][:]) ) * 3.6
-
-        dewtemp = nf.variables['d2m'][:] - 273.15
-        
-        rh = self.calc_rh(temp, dewtemp)
-
-
+        if self.workers > 1:
+            self.run_parallel(nc_filename, lat_slice, lon_slice, lats, lons, adate)
+        else:
+            for iday in range(self.lead_day):
+                # only the bbox of the day's time steps is read, memory is
+                # bounded by bbox x daily_step whatever the file's domain
+                window = self.read_window(nc_filename, self.day_slice(iday), lat_slice, lon_slice)
+                for var_name in self.raster_vars:
+                    self.save_variable_day(var_name, iday, window, lats, lons, adate)
+
+        time_info, file_suffix = [], []
         for iday in range(self.lead_day):
-            
-            start_idx = iday * self.daily_step
-            end_idx = start_idx + self.daily_step
-
-            if iday==0:
-                rf_day = rf[end_idx,:,:]
-            else:
-                rf_day = rf[end_idx,:,:] - rf[start_idx,:,:]
-            tmin_day = np.amin(temp[start_idx:end_idx+1,:,:], axis=0)
-            tmax_day = np.amax(temp[start_idx:end_idx+1,:,:], axis=0)
-            wsavg_day = np.average(ws[start_idx:end_idx+1,:,:], axis=0)
-            rhavg_day = np.average(rh[start_idx:end_idx+1,:,:], axis=0)
-
-            # print(rf_day.sum())
-            # return
-            file_suffix = f'{adate}.d{iday:02d}.json'
-
-            # save parameter
-            
-            self.save_ufgrid(lats, lons, tmin_day, -9999, True, 100, f'tmin.{file_suffix}')
-            self.save_ufgrid(lats, lons, tmax_day, -9999, True, 100, f'tmax.{file_suffix}')
-            self.save_ufgrid(lats, lons, rf_day, -9999, True, 100, f'rf.{file_suffix}')
-            self.save_ufgrid(lats, lons, wsavg_day, -9999, True, 100, f'wsavg.{file_suffix}')
-            self.save_ufgrid(lats, lons, rhavg_day, -9999, True, 100, f'rhavg.{file_suffix}')
-
-            # finfo
-            self.finfo['time'].append({
+            start_idx, end_idx = self.day_slice(iday).start, self.day_slice(iday).stop - 1
+            time_info.append({
                 'start_time': times[start_idx].strftime('%d-%b_%H'),
                 'end_time': times[end_idx].strftime('%d-%b_%H'),
-            }) 
-
-            self.finfo['file_suffix'].append(file_suffix) 
-
-
-            # print(FileNotFoundError())
-
-        with open(os.path.join(self.outpath,'finfo.json'),'w') as wf:
-            json.dump(self.finfo, wf)
-
-        # update state
-        
-        self.update_state(adate)
-
-
+            })
+            file_suffix.append(self.file_suffix(adate, iday))
+
+        outputs = []
+        for name, product in self.products.items():
+            outpath = os.path.join(product['output'], adate)
+
+            finfo = {
+                'time': time_info,
+                'params': self.registry.params(name),
+                'file_suffix': file_suffix,
+                # tells the map which loader to use for the rasters
+                'format': self.raster_format,
+            }
+
+            with open(os.path.join(self.root_path, outpath, 'finfo.json'),'w') as wf:
+                json.dump(finfo, wf)
+
+            outputs.extend(
+                os.path.join(outpath, f'{var_name}.{suffix}')
+                for suffix in file_suffix for var_name in product['variables']
+            )
+            outputs.append(os.path.join(outpath, 'finfo.json'))
+
+        return adate, outputs
@@ -1,10 +1,21 @@
+import time
 from datetime import datetime 
 
 from netCDF4 import Dataset, num2date
 
 from django.core.management.base import BaseCommand, CommandError
 from forecast_data.models import *
-from sricdms.settings import ECMWF_HRES_NC
+from forecast_data import subset_cache
+from forecast_data.backfill import (
+    parse_dates, input_stat, load_manifest, save_manifest, is_current, options_digest,
+    run_dates, latest_done, newer_state, print_summary, DONE, SKIPPED
+)
+from django.conf import settings
+
+
+def state_date(dateobj, options):
+    # one date of a run, also the job of a --jobs process
+    return Command().read_date(dateobj, options['force'])
 
 
 class Command(BaseCommand):
@@ -13,17 +24,50 @@ class Command(BaseCommand):
     state_name = "ECMWF_HRES_NC"
     source = "ECMWF_HRES"
     source_obj = forecast_source.objects.get(name=source)
+    manifest_name = 'update_state_ecmwf_hres_nc'
 
     def add_arguments(self, parser):
-        parser.add_argument('date', type=str, help="forecast date in yyyymmdd format")
+        parser.add_argument('date', type=str, nargs='+', help="forecast dates, yyyymmdd, yyyymmdd:yyyymmdd or comma separated")
+        parser.add_argument('--jobs', type=int, default=1, help="dates read at the same time")
+        parser.add_argument('--force', action='store_true', help="read dates whose manifest is current")
 
     def handle(self, *args, **options):
-        dateobj = datetime.strptime(options['date'], '%Y%m%d')
-        self.update_state(dateobj)
+        tic = time.perf_counter()
+        try:
+            dates = parse_dates(options['date'])
+        except ValueError as e:
+            raise CommandError(f'invalid date :: {e}')
+
+        results = run_dates(state_date, dates, options, options['jobs'])
+
+        # the state points to the latest forecast run of the dates
+        _, latest = latest_done(results)
+        if latest is not None:
+            self.update_state(latest['init_time'], latest['info'])
+
+        print_summary(results, tic)
+
+
+    def read_date(self, dateobj, force=False):
+        # header info of one date unless its manifest is still current
+        ncfile_path = dateobj.strftime(settings.ECMWF_HRES_NC)
+        source = input_stat(ncfile_path)
 
+        manifest = load_manifest(self.manifest_name, dateobj)
+        if not force and is_current(manifest, source, {}):
+            return {'status': SKIPPED, 'init_time': manifest['init_time'], 'info': manifest['info']}
 
-    def update_state(self, dateobj):
-        ncfile_path = dateobj.strftime(ECMWF_HRES_NC)
+        date, info = self.read_info(ncfile_path)
+        save_manifest(self.manifest_name, dateobj, {
+            'input': source,
+            'options': options_digest({}),
+            'init_time': date,
+            'info': info,
+        })
+        return {'status': DONE, 'init_time': date, 'info': info}
+
+
+    def read_info(self, ncfile_path):
         print(ncfile_path)
         ncfile = Dataset(ncfile_path,'r')
         var_list = []
@@ -61,6 +105,15 @@ class Command(BaseCommand):
         date = num2date(ncfile.variables['time'][:].min(), ncfile.variables['time'].units).strftime('%Y%m%d_%H') # using min() to find init date
         ncfile.close()
 
+        return date, info
+
+
+    def update_state(self, date, info):
+        newer = newer_state(self.state_name, date)
+        if newer is not None:
+            print(f'{self.state_name} is at the newer run {newer}, keeping it...')
+            return
+
         if system_state.objects.filter(state_name=self.state_name, source=self.source_obj).exists():
             print('updating existing record...')
             state = system_state.objects.get(state_name=self.state_name, source=self.source_obj)
@@ -70,6 +123,9 @@ class Command(BaseCommand):
         else:
             print("Creating new record...")
             system_state(state_name=self.state_name, init_time=date, source=self.source_obj, info=info).save()
+
+        # cached subsets of the previous forecast run are not served anymore
+        subset_cache.discard_init_times(self.state_name, date)
             
             
         
@@ -0,0 +1,39 @@
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from forecast_data.models import system_state
+from forecast_data.verification import verify, PARAMETERS
+
+
+class Command(BaseCommand):
+
+    help = 'Verify ECMWF HRES forecast against station observations and store the scores'
+    state_name = "ECMWF_HRES_NC"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', type=str, default=None, help="forecast date in yyyymmdd format, default current state")
+        parser.add_argument('--parameters', type=str, nargs='+', choices=list(PARAMETERS), default=None, help="obs_data parameters, default all")
+
+    def handle(self, *args, **options):
+        tic = time.perf_counter()
+
+        state = system_state.objects.get(state_name=self.state_name)
+        if options['date']:
+            date_obj = datetime.strptime(options['date'], '%Y%m%d')
+        else:
+            date_obj = datetime.strptime(state.init_time, '%Y%m%d_%H')
+        init_time = date_obj.strftime('%Y%m%d_%H')
+
+        try:
+            count = verify(
+                state.source, init_time, date_obj.strftime(settings.ECMWF_HRES_NC), options['parameters']
+            )
+        except FileNotFoundError:
+            raise CommandError(f'forecast file of {init_time} does not exist')
+        except KeyError as e:
+            raise CommandError(f'parameter does not exist :: {e}')
+
+        print(f'{init_time}: {count} scores stored ({time.perf_counter() - tic:.2f}s)')
@@ -0,0 +1,35 @@
+# Generated by Django 3.2.5 on 2026-10-18 15:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forecast_data', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='subset_job',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('job_id', models.UUIDField(unique=True, verbose_name='public id of the job')),
+                ('state_name', models.CharField(max_length=128, verbose_name='name of the state the subset is made of')),
+                ('params', models.JSONField(default=dict, verbose_name='request params, name -> list of values')),
+                ('status', models.CharField(choices=[('queued', 'queued'), ('running', 'running'), ('done', 'done'), ('failed', 'failed'), ('expired', 'expired')], default='queued', max_length=16, verbose_name='job status')),
+                ('progress', models.FloatField(default=0, verbose_name='fraction of the subset written')),
+                ('message', models.TextField(blank=True, default='', verbose_name='error message of a failed job')),
+                ('file_name', models.CharField(blank=True, default='', max_length=255, verbose_name='download file name')),
+                ('file_size', models.BigIntegerField(blank=True, null=True, verbose_name='size of the finished file in bytes')),
+                ('init_time', models.CharField(blank=True, default='', max_length=32, verbose_name='init_time of the subset, yyyymmdd_hh')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='job submit time')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='job update time')),
+                ('expires_at', models.DateTimeField(blank=True, null=True, verbose_name='time the finished file is removed')),
+            ],
+            options={
+                'verbose_name_plural': 'Subset Job',
+                'indexes': [models.Index(fields=['status', 'expires_at'], name='forecast_da_status_f79294_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.2.5 on 2026-10-18 17:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('obs_data', '0005_station_summary_version'),
+        ('forecast_data', '0002_subset_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='verification_score',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('init_time', models.CharField(max_length=32, verbose_name='init time of the forecast, yyyymmdd_hh')),
+                ('lead_day', models.IntegerField(verbose_name='lead day, 0 -> first 24 hours')),
+                ('count', models.IntegerField(verbose_name='number of forecast / observation pairs')),
+                ('bias', models.FloatField(verbose_name='mean error, forecast - observation')),
+                ('mae', models.FloatField(verbose_name='mean absolute error')),
+                ('rmse', models.FloatField(verbose_name='root mean square error')),
+                ('fcst_mean', models.FloatField(verbose_name='mean forecast value')),
+                ('obs_mean', models.FloatField(verbose_name='mean observed value')),
+                ('categorical', models.JSONField(blank=True, default=dict, verbose_name='contingency table and scores by threshold, rainfall only')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='field update time')),
+                ('parameter', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='obs_data.parameter')),
+                ('source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='forecast_data.forecast_source')),
+                ('station', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='obs_data.station')),
+            ],
+            options={
+                'verbose_name_plural': 'Verification Score',
+                'indexes': [models.Index(fields=['source', 'parameter', 'init_time'], name='forecast_da_source__5e0757_idx'), models.Index(fields=['station', 'parameter', 'init_time'], name='forecast_da_station_2bc8c4_idx')],
+            },
+        ),
+    ]
@@ -41,3 +41,68 @@ class system_state(models.Model):
             models.Index(fields=['state_name']),
         ]
     
+
+
+class subset_job(models.Model):
+
+    QUEUED, RUNNING, DONE, FAILED, EXPIRED = 'queued', 'running', 'done', 'failed', 'expired'
+    STATUS_CHOICES = [
+        (QUEUED, 'queued'),
+        (RUNNING, 'running'),
+        (DONE, 'done'),
+        (FAILED, 'failed'),
+        (EXPIRED, 'expired'),
+    ]
+
+    job_id = models.UUIDField('public id of the job', unique=True)
+    state_name = models.CharField("name of the state the subset is made of", max_length=128)
+    params = models.JSONField("request params, name -> list of values", default=dict)
+    status = models.CharField('job status', max_length=16, choices=STATUS_CHOICES, default=QUEUED)
+    progress = models.FloatField('fraction of the subset written', default=0)
+    message = models.TextField('error message of a failed job', default='', blank=True)
+    file_name = models.CharField('download file name', max_length=255, default='', blank=True)
+    file_size = models.BigIntegerField('size of the finished file in bytes', null=True, blank=True)
+    init_time = models.CharField('init_time of the subset, yyyymmdd_hh', max_length=32, default='', blank=True)
+    created_at = models.DateTimeField('job submit time', auto_now_add=True)
+    updated_at = models.DateTimeField('job update time', auto_now=True)
+    expires_at = models.DateTimeField('time the finished file is removed', null=True, blank=True)
+
+    def __str__(self):
+        return f'{self.job_id} // {self.state_name} // {self.status}'
+
+    class Meta:
+        verbose_name_plural = "Subset Job"
+        indexes = [
+            models.Index(fields=['status', 'expires_at']),
+        ]
+
+
+class verification_score(models.Model):
+
+    # written by forecast_data.verification, station null -> all stations
+    source = models.ForeignKey(forecast_source, on_delete=models.CASCADE)
+    init_time = models.CharField('init time of the forecast, yyyymmdd_hh', max_length=32)
+    parameter = models.ForeignKey('obs_data.parameter', on_delete=models.CASCADE)
+    station = models.ForeignKey('obs_data.station', on_delete=models.CASCADE, null=True, blank=True)
+    lead_day = models.IntegerField('lead day, 0 -> first 24 hours')
+
+    count = models.IntegerField('number of forecast / observation pairs')
+    bias = models.FloatField('mean error, forecast - observation')
+    mae = models.FloatField('mean absolute error')
+    rmse = models.FloatField('root mean square error')
+    fcst_mean = models.FloatField('mean forecast value')
+    obs_mean = models.FloatField('mean observed value')
+    categorical = models.JSONField(
+        "contingency table and scores by threshold, rainfall only", default=dict, blank=True
+    )
+    updated_at = models.DateTimeField('field update time', auto_now=True)
+
+    def __str__(self):
+        return f'{self.source.name} // {self.init_time} // {self.parameter.name} // d{self.lead_day}'
+
+    class Meta:
+        verbose_name_plural = "Verification Score"
+        indexes = [
+            models.Index(fields=['source', 'parameter', 'init_time']),
+            models.Index(fields=['station', 'parameter', 'init_time']),
+        ]
@@ -0,0 +1,230 @@
+'''
+NetCDF access for the forecast views and commands
+
+The netcdf-c/HDF5 libraries are not thread-safe while netCDF4 releases
+the GIL during library calls, so every use of netCDF4 in a web worker
+has to hold NETCDF_LOCK. The library keeps global state across files,
+a lock per file or handle would not be enough. The lock is held for the
+library calls only: hyperslabs are read into memory with read_hyperslab
+and everything done with them afterwards (conversion, quantization,
+interpolation, text formats) runs without it, so requests and subset
+jobs of a worker interleave instead of waiting for whole files.
+
+Opened files are kept in a DatasetPool, an LRU of handles keyed by
+path and checked against the file's mtime, so requests do not pay the
+HDF5 open and metadata parsing each time and a file replaced by a new
+forecast run is reopened. Coordinate axes of a file are read once into a
+CoordIndex, kept in an LRU keyed by path and mtime, and bboxes are
+resolved to index slices by binary search instead of masking the whole
+axes on every request.
+'''
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+
+import numpy as np
+from netCDF4 import Dataset, num2date
+
+
+NETCDF_LOCK = threading.RLock()
+
+# number of files whose coordinate index is kept in memory
+COORD_INDEX_CACHE_SIZE = 32
+
+# number of open dataset handles kept per process
+DATASET_POOL_SIZE = 8
+
+
+class DatasetPool:
+
+    def __init__(self, size):
+        self.size = size
+        # path -> (mtime_ns, Dataset), least recently used first
+        self.handles = OrderedDict()
+
+    @contextmanager
+    def dataset(self, path):
+        '''
+        yields the open dataset of path while holding NETCDF_LOCK,
+        the handle must not be used or closed outside the with block
+        '''
+        with NETCDF_LOCK:
+            yield self.get(path)
+
+    def get(self, path):
+        mtime_ns = os.stat(path).st_mtime_ns
+
+        entry = self.handles.pop(path, None)
+        if entry is not None and entry[0] != mtime_ns:
+            # replaced by a new forecast run
+            entry[1].close()
+            entry = None
+
+        if entry is None:
+            entry = (mtime_ns, Dataset(path))
+
+        self.handles[path] = entry
+        while len(self.handles) > self.size:
+            _, (_, nc) = self.handles.popitem(last=False)
+            nc.close()
+
+        return entry[1]
+
+    def clear(self):
+        with NETCDF_LOCK:
+            while self.handles:
+                _, (_, nc) = self.handles.popitem()
+                nc.close()
+
+
+pool = DatasetPool(DATASET_POOL_SIZE)
+
+
+def open_dataset(path):
+    '''
+    pooled read-only dataset of path, to be used as context manager,
+    raises FileNotFoundError
+    '''
+    return pool.dataset(path)
+
+
+def read_hyperslab(path, v_name, slices):
+    '''
+    (masked) values of variable v_name within the index slices of the
+    pooled dataset of path, NETCDF_LOCK is held for the read only,
+    raises FileNotFoundError
+    '''
+    with open_dataset(path) as nc:
+        return nc[v_name][slices]
+
+
+def variable_info(path, names):
+    '''
+    name -> (datatype, dimensions, attributes) of the variables of path
+    '''
+    with open_dataset(path) as nc:
+        return {
+            name: (
+                nc[name].datatype, nc[name].dimensions,
+                {k: nc[name].getncattr(k) for k in nc[name].ncattrs()}
+            )
+            for name in names
+        }
+
+
+@contextmanager
+def create_dataset(path):
+    '''
+    new NETCDF4 file at path, written and closed while holding NETCDF_LOCK,
+    for small files whose values are ready before it is created
+    '''
+    with NETCDF_LOCK:
+        nc = Dataset(path, 'w', format='NETCDF4')
+        try:
+            yield nc
+        finally:
+            nc.close()
+
+
+class Axis:
+
+    def __init__(self, values):
+        self.values = np.asarray(values)
+        self.size = self.values.shape[0]
+        self.descending = self.size > 1 and self.values[0] > self.values[-1]
+
+        steps = np.diff(self.values)
+        self.step = np.abs(steps.mean()).item() if self.size > 1 else 0.0
+        # regular within float32 rounding of the stored values
+        self.regular = self.size < 3 or bool(np.allclose(steps, steps[0], rtol=1e-4, atol=1e-6))
+
+    def index_slice(self, lower, upper):
+        '''
+        slice of the indices whose values lie within [lower, upper],
+        the same cells np.where((values >= lower) & (values <= upper))
+        selects on a sorted axis, None if there are none
+        '''
+        if self.descending:
+            ascending = self.values[::-1]
+            start = self.size - np.searchsorted(ascending, upper, side='right')
+            stop = self.size - np.searchsorted(ascending, lower, side='left')
+        else:
+            start = np.searchsorted(self.values, lower, side='left')
+            stop = np.searchsorted(self.values, upper, side='right')
+
+        if stop <= start:
+            return None
+        return slice(int(start), int(stop))
+
+
+class CoordIndex:
+
+    def __init__(self, nc):
+        self.variables = list(nc.variables)
+        self.lat = Axis(nc.variables['latitude'][:])
+        self.lon = Axis(nc.variables['longitude'][:])
+        self.times = np.asarray(nc.variables['time'][:])
+        self.time_units = nc.variables['time'].units
+        self.time_calendar = getattr(nc.variables['time'], 'calendar', 'standard')
+
+        self.valid_times = num2date(
+            self.times, self.time_units, self.time_calendar,
+            only_use_cftime_datetimes=False, only_use_python_datetimes=True
+        )
+        # hours since the first time step
+        self.lead = Axis(np.array([
+            (valid_time - self.valid_times[0]).total_seconds() / 3600
+            for valid_time in self.valid_times
+        ]))
+
+    @property
+    def lats(self):
+        return self.lat.values
+
+    @property
+    def lons(self):
+        return self.lon.values
+
+    def bbox_slices(self, top_lat, bottom_lat, right_lon, left_lon):
+        '''
+        returns (lat slice, lon slice) of the cells within the bbox,
+        None if the bbox does not overlap the grid
+        '''
+        lat_slice = self.lat.index_slice(bottom_lat, top_lat)
+        lon_slice = self.lon.index_slice(left_lon, right_lon)
+        if lat_slice is None or lon_slice is None:
+            return None
+        return lat_slice, lon_slice
+
+    def time_slice(self, first_lead=None, last_lead=None, first_time=None, last_time=None):
+        '''
+        slice of the time steps within the lead hours and valid times,
+        bounds which are None are open, None if no time step is left
+        '''
+        lower, upper = -np.inf, np.inf
+        if first_lead is not None:
+            lower = max(lower, first_lead)
+        if last_lead is not None:
+            upper = min(upper, last_lead)
+        if first_time is not None:
+            lower = max(lower, (first_time - self.valid_times[0]).total_seconds() / 3600)
+        if last_time is not None:
+            upper = min(upper, (last_time - self.valid_times[0]).total_seconds() / 3600)
+
+        return self.lead.index_slice(lower, upper)
+
+
+@lru_cache(maxsize=COORD_INDEX_CACHE_SIZE)
+def _load_coord_index(path, mtime_ns):
+    with open_dataset(path) as nc:
+        return CoordIndex(nc)
+
+
+def coord_index(path):
+    '''
+    coordinate index of the netcdf file at path,
+    rebuilt when the file is replaced, raises FileNotFoundError
+    '''
+    return _load_coord_index(path, os.stat(path).st_mtime_ns)
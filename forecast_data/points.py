@@ -0,0 +1,271 @@
+'''
+Forecast time series at points
+
+Interpolation weights of a set of points are computed once per grid and
+kept in an LRU keyed by the grid definition, the method and the points.
+Every variable is read as one hyperslab covering all points and the
+point values are gathered from it with fancy indexing, so the cost does
+not grow with the number of points beyond the size of their bbox.
+
+    nearest  : value of the closest grid cell
+    bilinear : weighted mean of the four surrounding grid cells
+
+Points are either obs_data stations or free lat/lon points, points
+outside the grid get missing values.
+'''
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+
+from forecast_data.ncio import read_hyperslab, variable_info, create_dataset
+from forecast_data.subset import NETCDF, CSV, TIME_FORMAT, format_column, quantize
+from obs_data.registry import get_reference
+
+
+NEAREST, BILINEAR = 'nearest', 'bilinear'
+METHODS = (NEAREST, BILINEAR)
+
+COORDINATES = ('time', 'latitude', 'longitude')
+
+# number of point sets whose weights are kept in memory
+WEIGHTS_CACHE_SIZE = 16
+
+
+class PointWeights:
+
+    def __init__(self, index, lats, lons, method):
+        lat_pos = fractional_index(index.lat, lats)
+        lon_pos = fractional_index(index.lon, lons)
+        self.inside = ~(np.isnan(lat_pos) | np.isnan(lon_pos))
+
+        # points outside the grid are moved into the hyperslab below and masked
+        lat_pos = np.where(self.inside, lat_pos, 0)
+        lon_pos = np.where(self.inside, lon_pos, 0)
+
+        if method == NEAREST:
+            self.lat_idx = np.rint(lat_pos).astype(int)[:, None]
+            self.lon_idx = np.rint(lon_pos).astype(int)[:, None]
+            self.weights = np.ones((len(lats), 1))
+        else:
+            lat0 = np.clip(np.floor(lat_pos).astype(int), 0, max(index.lat.size - 2, 0))
+            lon0 = np.clip(np.floor(lon_pos).astype(int), 0, max(index.lon.size - 2, 0))
+            lat1 = np.minimum(lat0 + 1, index.lat.size - 1)
+            lon1 = np.minimum(lon0 + 1, index.lon.size - 1)
+            fy, fx = lat_pos - lat0, lon_pos - lon0
+
+            self.lat_idx = np.stack([lat0, lat1, lat0, lat1], axis=1)
+            self.lon_idx = np.stack([lon0, lon0, lon1, lon1], axis=1)
+            self.weights = np.stack(
+                [(1 - fy) * (1 - fx), fy * (1 - fx), (1 - fy) * fx, fy * fx], axis=1
+            )
+
+        # hyperslab holding every cell used
+        used_lat, used_lon = self.lat_idx[self.inside], self.lon_idx[self.inside]
+        if used_lat.size:
+            self.lat_slice = slice(int(used_lat.min()), int(used_lat.max()) + 1)
+            self.lon_slice = slice(int(used_lon.min()), int(used_lon.max()) + 1)
+            self.lat_idx[~self.inside] = self.lat_slice.start
+            self.lon_idx[~self.inside] = self.lon_slice.start
+        else:
+            self.lat_slice = self.lon_slice = None
+
+    def apply(self, data):
+        '''
+        data -> (time, lat, lon) hyperslab of lat_slice/lon_slice
+        returns (point, time) values, nan where missing or outside
+        '''
+        cells = data[:, self.lat_idx - self.lat_slice.start, self.lon_idx - self.lon_slice.start]
+        values = (cells * self.weights[None, :, :]).sum(axis=2).T
+        values[~self.inside, :] = np.nan
+        return values
+
+
+def fractional_index(axis, values):
+    # position of values on the axis in cells, nan outside the axis
+    positions = np.arange(axis.size, dtype=float)
+    coords = axis.values.astype(float)
+    if axis.descending:
+        coords, positions = coords[::-1], positions[::-1]
+
+    values = np.asarray(values, dtype=float)
+    result = np.interp(values, coords, positions)
+    result[(values < coords[0]) | (values > coords[-1])] = np.nan
+    return result
+
+
+_weights_cache = OrderedDict()
+_weights_lock = threading.Lock()
+
+
+def station_points(station_ids=None):
+    '''
+    points of the given or all obs_data stations, raises KeyError
+    '''
+    stations = get_reference().stations
+    if station_ids is None:
+        station_ids = list(stations)
+    return [
+        {
+            'station_id': stations[stn_id]['id'],
+            'name': stations[stn_id]['name'],
+            'lat': stations[stn_id]['lat'],
+            'lon': stations[stn_id]['lon'],
+        }
+        for stn_id in station_ids
+    ]
+
+
+def latlon_points(lats, lons):
+    return [
+        {'station_id': None, 'name': None, 'lat': lat, 'lon': lon}
+        for lat, lon in zip(lats, lons)
+    ]
+
+
+def grid_key(index):
+    return (
+        index.lat.size, float(index.lats[0]), float(index.lats[-1]),
+        index.lon.size, float(index.lons[0]), float(index.lons[-1]),
+    )
+
+
+def points_digest(lats, lons):
+    return hashlib.sha1(
+        np.asarray(lats, dtype=float).tobytes() + np.asarray(lons, dtype=float).tobytes()
+    ).hexdigest()
+
+
+def point_weights(index, lats, lons, method):
+    key = (grid_key(index), method, points_digest(lats, lons))
+    with _weights_lock:
+        weights = _weights_cache.pop(key, None)
+        if weights is None:
+            weights = PointWeights(index, lats, lons, method)
+        _weights_cache[key] = weights
+        while len(_weights_cache) > WEIGHTS_CACHE_SIZE:
+            _weights_cache.popitem(last=False)
+    return weights
+
+
+def check_variables(index, variables):
+    '''
+    raises ValueError unless variables are (time, lat, lon) variables of
+    the indexed file
+    '''
+    if not variables:
+        raise ValueError('no variables given')
+    missing = [v_name for v_name in variables if v_name not in index.variables or v_name in COORDINATES]
+    if missing:
+        raise ValueError(f'variable does not exist :: {", ".join(missing)}')
+
+
+def extract_points(nc_path, index, points, variables, method, time_slice):
+    '''
+    returns {variable: (point, time) array} and the variables' attributes,
+    see check_variables for the variables
+    '''
+    lats = [point['lat'] for point in points]
+    lons = [point['lon'] for point in points]
+    weights = point_weights(index, lats, lons, method)
+    n_times = len(index.times[time_slice])
+
+    values, attrs = dict(), dict()
+    for v_name, (_, _, v_attrs) in variable_info(nc_path, variables).items():
+        attrs[v_name] = {k: v_attrs[k] for k in ('units', 'long_name') if k in v_attrs}
+        if weights.lat_slice is None:
+            values[v_name] = np.full((len(lats), n_times), np.nan)
+            continue
+
+        data = read_hyperslab(nc_path, v_name, (time_slice, weights.lat_slice, weights.lon_slice))
+        values[v_name] = weights.apply(np.ma.filled(np.ma.asarray(data, dtype=float), np.nan))
+
+    return values, attrs
+
+
+def write_points(fmt, path, points, index, time_slice, values, attrs, significant_digits=None):
+    '''
+    points -> see station_points and latlon_points
+    '''
+    times = index.valid_times[time_slice]
+    values = {
+        v_name: quantize(value, significant_digits=significant_digits)
+        for v_name, value in values.items()
+    }
+
+    if fmt == NETCDF:
+        write_points_netcdf(path, points, index, time_slice, values, attrs)
+    elif fmt == CSV:
+        write_points_csv(path, points, times, values)
+    else:
+        write_points_json(path, points, times, values, attrs)
+
+
+def write_points_json(path, points, times, values, attrs):
+    data = {
+        'time': [valid_time.strftime(TIME_FORMAT) for valid_time in times],
+        'points': points,
+        'variables': {
+            v_name: {
+                **attrs[v_name],
+                'values': np.where(np.isnan(value), None, value).tolist(),
+            }
+            for v_name, value in values.items()
+        }
+    }
+    with open(path, 'w') as wf:
+        json.dump(data, wf, separators=(',', ':'))
+
+
+def write_points_csv(path, points, times, values):
+    time_column = np.array([valid_time.strftime(TIME_FORMAT) for valid_time in times])
+
+    with open(path, 'w') as wf:
+        wf.write(','.join(['station_id', 'lat', 'lon', 'time', *values]) + '\n')
+        for i, point in enumerate(points):
+            prefix = ','.join(
+                '' if point[k] is None else str(point[k]) for k in ('station_id', 'lat', 'lon')
+            )
+            lines = np.char.add(f'{prefix},', time_column)
+            for value in values.values():
+                lines = np.char.add(np.char.add(lines, ','), format_column(value[i]))
+            wf.write('\n'.join(lines.tolist()))
+            wf.write('\n')
+
+
+def write_points_netcdf(path, points, index, time_slice, values, attrs):
+    with create_dataset(path) as nc:
+        nc.createDimension('point', len(points))
+        nc.createDimension('time', len(index.times[time_slice]))
+
+        var = nc.createVariable('time', 'f8', ('time',))
+        var.units = index.time_units
+        var.calendar = index.time_calendar
+        var[:] = index.times[time_slice]
+
+        var = nc.createVariable('latitude', 'f4', ('point',))
+        var.units = 'degrees_north'
+        var[:] = [point['lat'] for point in points]
+
+        var = nc.createVariable('longitude', 'f4', ('point',))
+        var.units = 'degrees_east'
+        var[:] = [point['lon'] for point in points]
+
+        var = nc.createVariable('station_id', 'i8', ('point',), fill_value=-1)
+        var.long_name = 'id of obs_data station, -1 for free points'
+        var[:] = [-1 if point['station_id'] is None else point['station_id'] for point in points]
+
+        for v_name, value in values.items():
+            var = nc.createVariable(
+                v_name, 'f4', ('point', 'time'), zlib=True, shuffle=True, fill_value=np.float32(np.nan)
+            )
+            var.setncatts(attrs[v_name])
+            var[:] = value
+
+        nc.featureType = 'timeSeries'
+        nc.generated_by = 'Data Exchange Portal, RIMES'
+        nc.source = 'European Center for Medium Range Weather Forecast'
+        nc.generation_time = datetime.today().strftime('%Y %b %m %H:%M:%S')
@@ -0,0 +1,207 @@
+'''
+Registry of the forecast raster products
+
+FCST_PRODUCTS_FILE (forecast_data/products.yaml) describes
+    sources   : forecast files, time steps per lead day and lead days
+    regions   : bboxes
+    colormaps : colormaps of the map
+    variables : daily variables, a derivation from the file's variables at
+                every time step and a temporal reduction over the lead day
+    products  : a region and variables of a source, written to
+                FCST_JSONOUT/<output>/<init time> and pointed to by the
+                system_state <state>
+
+Derivations and reductions are the functions of DERIVATIONS and
+REDUCTIONS, a variable names one of each. Only the first and last time
+step of a day is read for inputs of accumulations.
+'''
+import os
+from functools import lru_cache
+
+import numpy as np
+import yaml
+from django.conf import settings
+
+
+ACCUMULATION = 'accumulation'
+BBOX_KEYS = ('top_lat', 'bottom_lat', 'right_lon', 'left_lon')
+
+
+def calc_rh(temp:np.ndarray, dewtemp:np.ndarray)->np.ndarray:
+
+    '''
+    Using, August–Roche–Magnus approximation
+    RH = 100*( EXP( (17.625*TD) / (243.04+TD) ) / EXP( (17.625*T) / (243.04+T) ) )
+
+    a = 17.625
+    b = 243.04
+
+    ** 6.1094 ommited cause will calucate fraction later
+    es_td = (a*TD)/(b+TD)
+    es_t  = (a*T) /(b+T)
+
+    RH = 100*( exp(es_td) / exp(es_t) )
+    '''
+    a = 17.625
+    b = 243.04
+
+    es_td = (a * dewtemp) / (b + dewtemp)
+    es_t  = (a * temp)    / (b + temp)
+
+    return 100 * ( np.exp(es_td) / np.exp(es_t) )
+
+
+# name -> (input variables, window -> (time, lat, lon) values)
+DERIVATIONS = {
+    # m2mm : *1000
+    'rainfall': (('lsp', 'cp'), lambda w: (w['lsp'] + w['cp']) * 1000),
+    # k2dc : -273.15
+    'temperature': (('t2m',), lambda w: w['t2m'] - 273.15),
+    # ms2kmph : *3.6
+    'wind_speed': (('u10', 'v10'), lambda w: np.sqrt(np.square(w['u10']) + np.square(w['v10'])) * 3.6),
+    'relative_humidity': (('t2m', 'd2m'), lambda w: calc_rh(w['t2m'] - 273.15, w['d2m'] - 273.15)),
+}
+
+
+def accumulation(values, iday):
+    # accumulated from the start of the run, lead day 0 is its last step
+    if iday == 0:
+        return values[-1, :, :]
+    return values[-1, :, :] - values[0, :, :]
+
+
+# name -> ((time, lat, lon) values of a lead day, lead day) -> (lat, lon) values
+REDUCTIONS = {
+    ACCUMULATION: accumulation,
+    'min': lambda values, iday: np.amin(values, axis=0),
+    'max': lambda values, iday: np.amax(values, axis=0),
+    'mean': lambda values, iday: np.average(values, axis=0),
+}
+
+
+class ProductRegistry:
+
+    def __init__(self, config):
+        config = config or dict()
+        self.sources = config.get('sources') or dict()
+        self.regions = config.get('regions') or dict()
+        self.colormaps = config.get('colormaps') or dict()
+        self.variables = config.get('variables') or dict()
+        self.products = config.get('products') or dict()
+
+        errors = self.check()
+        if errors:
+            raise ValueError('invalid product registry :: ' + ', '.join(errors))
+
+    def check(self):
+        errors = []
+        for name, region in self.regions.items():
+            if any(key not in region for key in BBOX_KEYS):
+                errors.append(f'region {name} needs {", ".join(BBOX_KEYS)}')
+            elif region['bottom_lat'] > region['top_lat'] or region['left_lon'] > region['right_lon']:
+                errors.append(f'region {name} is empty')
+
+        for name, variable in self.variables.items():
+            if variable.get('derive') not in DERIVATIONS:
+                errors.append(f'variable {name} has unknown derive {variable.get("derive")}')
+            if variable.get('reduce') not in REDUCTIONS:
+                errors.append(f'variable {name} has unknown reduce {variable.get("reduce")}')
+            if variable.get('colormap') not in self.colormaps:
+                errors.append(f'variable {name} has unknown colormap {variable.get("colormap")}')
+
+        outputs, states = set(), set()
+        for name, product in self.products.items():
+            if product.get('source') not in self.sources:
+                errors.append(f'product {name} has unknown source {product.get("source")}')
+            if product.get('region') not in self.regions:
+                errors.append(f'product {name} has unknown region {product.get("region")}')
+            for var_name in product.get('variables') or ['']:
+                if var_name not in self.variables:
+                    errors.append(f'product {name} has unknown variable {var_name}')
+            # products sharing an output would overwrite their finfo.json
+            for key, seen in (('output', outputs), ('state', states)):
+                if not product.get(key) or product[key] in seen:
+                    errors.append(f'product {name} needs its own {key}')
+                seen.add(product.get(key))
+        return errors
+
+    def source_products(self, source):
+        return {name: product for name, product in self.products.items() if product['source'] == source}
+
+    def source_variables(self, source):
+        # variables of the source's products in order of appearance
+        return list(dict.fromkeys(
+            var_name for product in self.source_products(source).values() for var_name in product['variables']
+        ))
+
+    def inputs(self, var_names):
+        '''
+        (file variables read, of those the ones read at the first and last
+        time step of a day only) of the variables
+        '''
+        read, full = dict(), set()
+        for var_name in var_names:
+            variable = self.variables[var_name]
+            for input_name in DERIVATIONS[variable['derive']][0]:
+                read[input_name] = True
+                if variable['reduce'] != ACCUMULATION:
+                    full.add(input_name)
+        return tuple(read), tuple(name for name in read if name not in full)
+
+    def reduce(self, var_name, window, iday):
+        # (lat, lon) daily values of var_name from the window of lead day iday
+        variable = self.variables[var_name]
+        values = DERIVATIONS[variable['derive']][1](window)
+        return REDUCTIONS[variable['reduce']](values, iday)
+
+    def params(self, product_name):
+        # params of the product's finfo.json
+        params = dict()
+        for var_name in self.products[product_name]['variables']:
+            variable = self.variables[var_name]
+            params[var_name] = {
+                'fullname': variable['fullname'],
+                'unit': variable['unit'],
+                'cinf': self.colormaps[variable['colormap']],
+                'fa_icon': variable['fa_icon'],
+            }
+        return params
+
+    def source_config(self, source):
+        # everything the rasters of source are made of, a change rebuilds them
+        products = self.source_products(source)
+        var_names = self.source_variables(source)
+        return {
+            'source': self.sources[source],
+            'products': products,
+            'regions': {product['region']: self.regions[product['region']] for product in products.values()},
+            'variables': {var_name: self.variables[var_name] for var_name in var_names},
+            'colormaps': {
+                self.variables[var_name]['colormap']: self.colormaps[self.variables[var_name]['colormap']]
+                for var_name in var_names
+            },
+        }
+
+
+def load_registry(path):
+    # raises OSError, ValueError
+    with open(path) as rf:
+        try:
+            config = yaml.safe_load(rf)
+        except yaml.YAMLError as e:
+            raise ValueError(f'invalid product registry :: {e}')
+    return ProductRegistry(config)
+
+
+@lru_cache(maxsize=1)
+def _load_registry(path, mtime_ns):
+    return load_registry(path)
+
+
+def get_registry():
+    '''
+    registry of FCST_PRODUCTS_FILE, read again when the file changes,
+    must not be modified
+    '''
+    path = settings.FCST_PRODUCTS_FILE
+    return _load_registry(path, os.stat(path).st_mtime_ns)
@@ -0,0 +1,33 @@
+'''
+Process-wide registry of the system_state rows
+
+Built once per worker with the source of every state and its info JSON,
+and rebuilt after any state or forecast source changes: signals in
+forecast_data.signals invalidate it on save and delete once the
+transaction commits, which the update commands do whenever they write a
+state. bulk_create and queryset update() send no signal, writes of that
+kind have to call transaction.on_commit(registry.invalidate) themselves.
+'''
+from forecast_data.models import system_state
+from sricdms.versioned_cache import VersionedCache
+
+
+def load_states():
+    return {
+        state.state_name: state
+        for state in system_state.objects.select_related('source').order_by('id')
+    }
+
+
+registry = VersionedCache('forecast_data.system_state', load_states)
+
+
+def get_state(state_name):
+    '''
+    cached system_state of state_name with its source,
+    raises system_state.DoesNotExist, must not be modified
+    '''
+    try:
+        return registry.get()[state_name]
+    except KeyError:
+        raise system_state.DoesNotExist(f'system_state {state_name} does not exist')
@@ -0,0 +1,139 @@
+'''
+Parsing of forecast request params
+
+Params are a QueryDict or any MultiValueDict, so the same parsing serves
+the views and the subset jobs replaying a stored request.
+'''
+from datetime import datetime
+
+from forecast_data.subset import format_from_accept, FORMATS, NETCDF
+from forecast_data.points import station_points, latlon_points
+
+
+def get_points(params):
+    '''
+    points of request params
+        station_id : obs_data station ids, repeated, or all
+        lat, lon   : free points, repeated in pairs
+    raises ValueError
+    '''
+    station_ids = params.getlist('station_id')
+    lats, lons = params.getlist('lat'), params.getlist('lon')
+
+    points = []
+    if station_ids == ['all']:
+        points.extend(station_points())
+    elif station_ids:
+        try:
+            points.extend(station_points([int(stn_id) for stn_id in station_ids]))
+        except (KeyError, ValueError):
+            raise ValueError('station id does not exist')
+
+    if len(lats) != len(lons):
+        raise ValueError('lat and lon must be given in pairs')
+    try:
+        points.extend(latlon_points([float(lat) for lat in lats], [float(lon) for lon in lons]))
+    except ValueError:
+        raise ValueError('lat and lon must be numbers')
+
+    if not points:
+        raise ValueError('no station_id or lat/lon given')
+
+    return points
+
+
+def get_subset_params(params, accept=''):
+    '''
+    arguments of make_subset from request params, raises ValueError
+    '''
+    try:
+        bbox = {
+            'left_lon': float(params.get('left-lon')),
+            'right_lon': float(params.get('right-lon')),
+            'top_lat': float(params.get('top-lat')),
+            'bottom_lat': float(params.get('bottom-lat')),
+        }
+    except (TypeError, ValueError):
+        raise ValueError('left-lon, right-lon, top-lat and bottom-lat must be numbers')
+
+    return {
+        'sel_params': params.getlist('variables'),
+        **bbox,
+        **get_time_window(params),
+        **get_output_options(params, accept),
+    }
+
+
+def get_time_window(params):
+    '''
+    optional time window and spatial stride of request params
+        lead-start, lead-end : lead time in hours since the first time step
+        start-time, end-time : valid time, yyyymmdd_hh
+        stride               : every n-th grid cell in latitude and longitude
+    raises ValueError
+    '''
+    window = dict()
+
+    for param, key in (('lead-start', 'first_lead'), ('lead-end', 'last_lead')):
+        value = params.get(param, None)
+        if value not in (None, ''):
+            try:
+                window[key] = float(value)
+            except ValueError:
+                raise ValueError(f'{param} must be a number of hours')
+
+    for param, key in (('start-time', 'first_time'), ('end-time', 'last_time')):
+        value = params.get(param, None)
+        if value not in (None, ''):
+            try:
+                window[key] = datetime.strptime(value, '%Y%m%d_%H')
+            except ValueError:
+                raise ValueError(f'{param} must be formatted as yyyymmdd_hh')
+
+    stride = params.get('stride', None)
+    if stride not in (None, ''):
+        if not stride.isdigit() or int(stride) < 1:
+            raise ValueError('stride must be a positive integer')
+        window['stride'] = int(stride)
+
+    return window
+
+
+def get_output_options(params, accept='', default=NETCDF):
+    '''
+    output format and encoding of request params
+        format                  : netcdf, csv or json, else taken from Accept
+        complevel               : zlib level of netcdf variables, 0 -> uncompressed
+        least-significant-digit : decimals kept
+        significant-digits      : significant digits kept
+    raises ValueError
+    '''
+    options = dict()
+
+    fmt = params.get('format', None)
+    if fmt in (None, ''):
+        fmt = format_from_accept(accept, default)
+    if fmt not in FORMATS:
+        raise ValueError(f'format must be one of {", ".join(FORMATS)}')
+    options['fmt'] = fmt
+
+    for param, key, lower, upper in (
+        ('complevel', 'complevel', 0, 9),
+        ('least-significant-digit', 'least_significant_digit', -10, 10),
+        ('significant-digits', 'significant_digits', 1, 15),
+    ):
+        value = params.get(param, None)
+        if value in (None, ''):
+            continue
+        try:
+            value = int(value)
+        except ValueError:
+            value = None
+        if value is None or not lower <= value <= upper:
+            raise ValueError(f'{param} must be an integer from {lower} to {upper}')
+        options[key] = value
+
+    if 'least_significant_digit' in options and 'significant_digits' in options:
+        raise ValueError('least-significant-digit and significant-digits can not be combined')
+
+    return options
@@ -0,0 +1,15 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from forecast_data.models import forecast_source, system_state
+from forecast_data.registry import registry
+
+
+@receiver(post_save, sender=system_state)
+@receiver(post_save, sender=forecast_source)
+@receiver(post_delete, sender=system_state)
+@receiver(post_delete, sender=forecast_source)
+def invalidate_states(sender, **kwargs):
+    # after the commit, a worker rebuilding earlier would keep the old rows
+    transaction.on_commit(registry.invalidate)
@@ -0,0 +1,335 @@
+'''
+Writers of forecast subsets
+
+netcdf : NETCDF4 with zlib/shuffle compression, chunked by time step,
+         optionally quantized (least_significant_digit/significant_digits)
+csv    : long format, one row per time step and grid cell, one column per
+         variable, missing values are empty
+json   : compact grid, axes and one time x latitude x longitude list per
+         variable, missing values are null
+
+Only the hyperslab of the requested slices is read from the source file,
+make_subset serves repeated requests from the subset cache.
+'''
+import os
+import json
+from datetime import datetime
+
+import numpy as np
+from netCDF4 import Dataset
+
+from forecast_data import subset_cache
+from forecast_data.registry import get_state
+from forecast_data.ncio import NETCDF_LOCK, read_hyperslab, variable_info, coord_index
+
+
+NETCDF, CSV, JSON = 'netcdf', 'csv', 'json'
+FORMATS = (NETCDF, CSV, JSON)
+
+CONTENT_TYPES = {
+    NETCDF: 'application/netcdf',
+    CSV: 'text/csv',
+    JSON: 'application/json',
+}
+
+FILE_EXTENSIONS = {NETCDF: 'nc', CSV: 'csv', JSON: 'json'}
+
+DEFAULT_COMPLEVEL = 4
+
+# largest chunk along latitude and longitude, chunks hold one time step
+CHUNK_SIZE = 256
+
+# time steps of a variable read and written at a time, NETCDF_LOCK is
+# released in between
+BLOCK_STEPS = 8
+
+# float32 values carry about 7 significant digits, more is noise in text formats
+TEXT_SIGNIFICANT_DIGITS = 7
+
+TIME_FORMAT = '%Y-%m-%d %H:%MZ'
+
+
+class SubsetError(Exception):
+
+    def __init__(self, error, message):
+        super().__init__(message)
+        self.error = error
+        self.message = message
+
+
+def format_from_accept(accept, default=NETCDF):
+    # first supported type of an Accept header, default when none matches
+    for media_type in accept.split(','):
+        media_type = media_type.split(';')[0].strip()
+        for fmt, content_type in CONTENT_TYPES.items():
+            if media_type == content_type:
+                return fmt
+    return default
+
+
+def quantize(values, least_significant_digit=None, significant_digits=None):
+    '''
+    rounds a float array to the given decimals or significant digits
+    '''
+    values = np.asarray(values, dtype=float)
+    if least_significant_digit is not None:
+        return np.round(values, least_significant_digit)
+
+    if significant_digits is None:
+        significant_digits = TEXT_SIGNIFICANT_DIGITS
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        magnitude = np.floor(np.log10(np.abs(values)))
+    magnitude[~np.isfinite(magnitude)] = 0
+    scale = 10.0 ** (significant_digits - 1 - magnitude)
+    return np.round(values * scale) / scale
+
+
+def make_subset(
+        sel_params,
+        top_lat,
+        bottom_lat,
+        right_lon,
+        left_lon,
+        state_name,
+        ECMWF_NC,
+        req_date=None,
+        first_lead=None,
+        last_lead=None,
+        first_time=None,
+        last_time=None,
+        stride=1,
+        fmt=NETCDF,
+        complevel=DEFAULT_COMPLEVEL,
+        least_significant_digit=None,
+        significant_digits=None,
+        progress=None
+):
+    '''
+    subset of the forecast file in fmt, only the time steps within the
+    lead time / valid time window and every stride-th grid cell of the
+    bbox are read, progress is called with the written fraction
+
+    returns (open subset file, cache key, init_time), raises SubsetError
+    '''
+    if req_date:
+        update = req_date
+    else:
+        update = get_state(state_name).init_time
+
+    nc_origin_path = (
+        datetime.strptime(update, '%Y%m%d_%H')
+    ).strftime(ECMWF_NC)
+
+    try:
+        index = coord_index(nc_origin_path)
+        mtime_ns = os.stat(nc_origin_path).st_mtime_ns
+    except FileNotFoundError:
+        raise SubsetError('No file error', 'Requested file does not exist')
+
+    missing = [v_name for v_name in sel_params if v_name not in index.variables]
+    if missing:
+        raise SubsetError('invalid request', f'variable does not exist :: {", ".join(missing)}')
+
+    bbox_slices = index.bbox_slices(top_lat, bottom_lat, right_lon, left_lon)
+    if bbox_slices is None:
+        raise SubsetError('Out of scope', 'Selected region not available')
+
+    time_slice = index.time_slice(first_lead, last_lead, first_time, last_time)
+    if time_slice is None:
+        raise SubsetError('Out of scope', 'Selected time window not available')
+
+    slices = (time_slice,) + tuple(
+        slice(index_slice.start, index_slice.stop, stride) for index_slice in bbox_slices
+    )
+
+    # bboxes covering the same grid cells share one cached subset
+    sel_params = sorted(set(sel_params))
+    encoding = {
+        'complevel': complevel,
+        'least_significant_digit': least_significant_digit,
+        'significant_digits': significant_digits,
+    }
+    key = subset_cache.subset_key(
+        state_name, update, mtime_ns, sel_params, slices, fmt, sorted(encoding.items())
+    )
+    subset_file = subset_cache.get(key)
+
+    if subset_file is None:
+        # every request writes its own temp file, concurrent requests of a
+        # worker or of several workers never share an output file
+        subset_path = subset_cache.new_temp_path()
+        try:
+            write_subset(fmt, nc_origin_path, subset_path, sel_params, index, slices, encoding, progress)
+            subset_file = subset_cache.put(key, subset_path)
+        finally:
+            subset_cache.remove(subset_path)
+
+    return subset_file, key, update
+
+
+def subset_filename(state_name, top_lat, bottom_lat, right_lon, left_lon, fmt):
+    return f'{state_name}_{top_lat}N_{bottom_lat}S_{right_lon}E_{left_lon}W.{FILE_EXTENSIONS[fmt]}'
+
+
+def read_subset(nc_origin_path, sel_params, slices, progress=None):
+    # {name: filled float array with nan for missing values}
+    values = dict()
+    for i, v_name in enumerate(sel_params):
+        values[v_name] = np.ma.filled(
+            np.ma.asarray(read_hyperslab(nc_origin_path, v_name, slices), dtype=float),
+            np.nan
+        )
+        if progress:
+            progress((i + 1) / len(sel_params))
+    return values
+
+
+def time_blocks(time_slice, size):
+    # (output slice, source slice) of blocks of up to size output time steps
+    steps = range(time_slice.start, time_slice.stop, time_slice.step or 1)
+    for first in range(0, len(steps), size):
+        block = steps[first:first + size]
+        yield slice(first, first + len(block)), slice(block.start, block.stop, block.step)
+
+
+def write_subset(fmt, nc_origin_path, subset_path, sel_params, index, slices, encoding, progress=None):
+    '''
+    writes the subset in fmt to subset_path
+    slices   -> (time, latitude, longitude) index slices
+    encoding -> complevel, least_significant_digit, significant_digits
+    progress -> called with the fraction done after each variable
+    '''
+    if fmt == NETCDF:
+        write_netcdf(nc_origin_path, subset_path, sel_params, index, slices, encoding, progress)
+        return
+
+    values = read_subset(nc_origin_path, sel_params, slices, progress)
+    attrs = {
+        v_name: {k: v_attrs[k] for k in ('units', 'long_name') if k in v_attrs}
+        for v_name, (_, _, v_attrs) in variable_info(nc_origin_path, sel_params).items()
+    }
+
+    time_slice, lat_slice, lon_slice = slices
+    times = [valid_time.strftime(TIME_FORMAT) for valid_time in index.valid_times[time_slice]]
+    lats, lons = index.lats[lat_slice], index.lons[lon_slice]
+
+    values = {
+        v_name: quantize(
+            value, encoding['least_significant_digit'], encoding['significant_digits']
+        )
+        for v_name, value in values.items()
+    }
+
+    if fmt == CSV:
+        write_csv(subset_path, times, lats, lons, values)
+    else:
+        write_json(subset_path, times, lats, lons, values, attrs)
+
+
+def write_netcdf(nc_origin_path, subset_path, sel_params, index, slices, encoding, progress=None):
+    time_slice, lat_slice, lon_slice = slices
+    lat_crop, lon_crop = index.lats[lat_slice], index.lons[lon_slice]
+    times = index.times[time_slice]
+
+    compression = dict()
+    if encoding['complevel']:
+        compression = {
+            'zlib': True,
+            'shuffle': True,
+            'complevel': encoding['complevel'],
+            'chunksizes': (1, min(len(lat_crop), CHUNK_SIZE), min(len(lon_crop), CHUNK_SIZE)),
+        }
+    if encoding['least_significant_digit'] is not None:
+        compression['least_significant_digit'] = encoding['least_significant_digit']
+    if encoding['significant_digits'] is not None:
+        compression['significant_digits'] = encoding['significant_digits']
+
+    info = variable_info(nc_origin_path, ('latitude', 'longitude', 'time', *sel_params))
+
+    # the subset is written in blocks, NETCDF_LOCK is held for every
+    # library call but never across the whole file
+    with NETCDF_LOCK:
+        nc_subset = Dataset(subset_path, 'w', format="NETCDF4")
+    try:
+        with NETCDF_LOCK:
+            # dimensions of the subset
+            nc_subset.createDimension('latitude', len(lat_crop))
+            nc_subset.createDimension('longitude', len(lon_crop))
+            nc_subset.createDimension('time', len(times))
+
+            # set values for subset's variables which are in dimensions \
+            # -> lat,lon and time
+            for var_name, values in (('latitude', lat_crop), ('longitude', lon_crop), ('time', times)):
+                datatype, dimensions, attrs = info[var_name]
+                var_subset = nc_subset.createVariable(var_name, datatype, dimensions)
+                var_subset.setncatts(attrs)
+                var_subset[:] = values
+
+        # set values for the params requested by the user
+        for i, v_name in enumerate(sel_params):
+            datatype, dimensions, attrs = info[v_name]
+            with NETCDF_LOCK:
+                var_subset = nc_subset.createVariable(v_name, datatype, dimensions, **compression)
+                var_subset.setncatts({
+                    k: v for k, v in attrs.items()
+                    # set by the library when the subset is quantized
+                    if not k.startswith('_Quantize')
+                })
+
+            for out_slice, src_slice in time_blocks(time_slice, BLOCK_STEPS):
+                block = read_hyperslab(nc_origin_path, v_name, (src_slice, lat_slice, lon_slice))
+                with NETCDF_LOCK:
+                    var_subset[out_slice] = block
+            if progress:
+                progress((i + 1) / len(sel_params))
+
+        with NETCDF_LOCK:
+            nc_subset.generated_by = 'Data Exchange Portal, RIMES'
+            nc_subset.source = 'European Center for Medium Range Weather Forecast'
+            nc_subset.generation_time = datetime.today().strftime('%Y %b %m %H:%M:%S')
+    finally:
+        with NETCDF_LOCK:
+            nc_subset.close()
+
+
+def format_column(values):
+    column = np.char.mod(f'%.{TEXT_SIGNIFICANT_DIGITS}g', values)
+    column[np.isnan(values)] = ''
+    return column
+
+
+def write_csv(subset_path, times, lats, lons, values):
+    # one block of lines per time step, the grid columns are the same for all
+    grid_lat, grid_lon = np.meshgrid(lats, lons, indexing='ij')
+    grid = np.char.add(
+        np.char.add(format_column(grid_lat.ravel()), ','),
+        format_column(grid_lon.ravel())
+    )
+
+    with open(subset_path, 'w') as wf:
+        wf.write(','.join(['time', 'latitude', 'longitude', *values]) + '\n')
+        for i, time in enumerate(times):
+            lines = np.char.add(f'{time},', grid)
+            for value in values.values():
+                lines = np.char.add(np.char.add(lines, ','), format_column(value[i].ravel()))
+            wf.write('\n'.join(lines.tolist()))
+            wf.write('\n')
+
+
+def write_json(subset_path, times, lats, lons, values, attrs):
+    data = {
+        'time': times,
+        'latitude': quantize(lats).tolist(),
+        'longitude': quantize(lons).tolist(),
+        'variables': {
+            v_name: {
+                **attrs[v_name],
+                'values': np.where(np.isnan(value), None, value).tolist(),
+            }
+            for v_name, value in values.items()
+        }
+    }
+
+    with open(subset_path, 'w') as wf:
+        json.dump(data, wf, separators=(',', ':'))
@@ -0,0 +1,123 @@
+'''
+On disk cache of netcdf subsets
+
+A subset is identified by the state, its init_time, the source file's
+mtime, the sorted variables, the time window and bbox snapped to index
+slices and the output format and encoding, so nearby bboxes covering
+the same cells share one file.
+Files are evicted least recently used first once the cache grows over
+FCST_SUBSET_CACHE_MAX_BYTES, and files of older init_times are dropped
+when the state moves on (see discard_init_times).
+
+Files are written under a temp name in the cache directory and moved
+into place, workers never see a partial file.
+'''
+import os
+import hashlib
+import tempfile
+
+from django.conf import settings
+
+
+SUFFIX = '.subset'
+TEMP_PREFIX = 'tmp.'
+
+
+def cache_dir():
+    path = settings.FCST_SUBSET_CACHE_DIR
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def subset_key(state_name, init_time, *parts):
+    '''
+    parts -> everything else the file depends on, with a stable repr
+    '''
+    digest = hashlib.sha1(repr(parts).encode()).hexdigest()
+    return f'{state_name}.{init_time}.{digest}'
+
+
+def open_file(path):
+    # read-only file without a name, stays readable if the path is removed
+    return os.fdopen(os.open(path, os.O_RDONLY), 'rb')
+
+
+def get(key):
+    '''
+    open cached file of key or None
+    '''
+    path = os.path.join(cache_dir(), key + SUFFIX)
+    try:
+        cached = open_file(path)
+    except FileNotFoundError:
+        return None
+
+    try:
+        # mtime is the last use for eviction
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+    return cached
+
+
+def new_temp_path():
+    fd, path = tempfile.mkstemp(prefix=TEMP_PREFIX, suffix=SUFFIX, dir=cache_dir())
+    os.close(fd)
+    return path
+
+
+def put(key, temp_path):
+    '''
+    moves the written temp file into the cache, returns it opened
+    '''
+    path = os.path.join(cache_dir(), key + SUFFIX)
+    cached = open_file(temp_path)
+    os.replace(temp_path, path)
+    evict()
+    return cached
+
+
+def cached_files():
+    # (mtime, size, path) of all cached files
+    files = []
+    with os.scandir(cache_dir()) as entries:
+        for entry in entries:
+            if not entry.name.endswith(SUFFIX) or entry.name.startswith(TEMP_PREFIX):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+    return files
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def evict(max_bytes=None):
+    if max_bytes is None:
+        max_bytes = settings.FCST_SUBSET_CACHE_MAX_BYTES
+
+    files = sorted(cached_files())
+    total = sum(size for _, size, _ in files)
+    for _, size, path in files:
+        if total <= max_bytes:
+            break
+        remove(path)
+        total -= size
+
+
+def discard_init_times(state_name, keep_init_time):
+    '''
+    removes cached subsets of state_name other than keep_init_time
+    '''
+    prefix, keep = f'{state_name}.', f'{state_name}.{keep_init_time}.'
+    for _, _, path in cached_files():
+        name = os.path.basename(path)
+        if name.startswith(prefix) and not name.startswith(keep):
+            remove(path)
@@ -1,3 +1,872 @@
-from django.test import TestCase
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import tempfile
+import threading
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
-# Create your tests here.
+import copy
+
+import numpy as np
+import yaml
+from netCDF4 import Dataset
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.http import QueryDict
+from django.test.client import Client
+from django.urls import reverse
+
+from forecast_data import backfill, jobs, subset, subset_cache, ufgrid, verification
+from forecast_data.ncio import NETCDF_LOCK, Axis, coord_index
+from forecast_data.points import PointWeights
+from forecast_data.products import ProductRegistry, load_registry
+from forecast_data.request_params import get_time_window
+from forecast_data.models import forecast_source, system_state, subset_job, verification_score
+from forecast_data.subset import SubsetError
+from obs_data.models import parameter
+from forecast_data.registry import registry, get_state
+
+
+LOCAL_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def write_forecast_nc(path, lats, lons, hours, variables):
+    '''
+    small forecast file like the ECMWF HRES ones, variables -> name ->
+    (time, lat, lon) values
+    '''
+    with Dataset(path, 'w') as nc:
+        nc.createDimension('time', len(hours))
+        nc.createDimension('latitude', len(lats))
+        nc.createDimension('longitude', len(lons))
+
+        time = nc.createVariable('time', 'i4', ('time',))
+        time.units = 'hours since 2024-01-01 00:00:00'
+        time[:] = hours
+        for name, values in (('latitude', lats), ('longitude', lons)):
+            axis = nc.createVariable(name, 'f4', (name,))
+            axis.units = 'degrees'
+            axis[:] = values
+
+        for name, values in variables.items():
+            var = nc.createVariable(name, 'f4', ('time', 'latitude', 'longitude'), fill_value=-32767)
+            var.units = 'K'
+            var.long_name = name
+            var[:] = values
+
+
+class TempDirMixin:
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp(prefix='forecast_data_test.')
+        self.addCleanup(shutil.rmtree, self.tmpdir, ignore_errors=True)
+
+    def write(self, name, content=b''):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'wb') as wf:
+            wf.write(content)
+        return path
+
+
+class BackfillTests(TempDirMixin, SimpleTestCase):
+
+    def test_parse_dates(self):
+        dates = backfill.parse_dates(['20240103', '20231230:20240101,20240101'])
+        self.assertEqual(
+            [date.strftime('%Y%m%d') for date in dates],
+            ['20231230', '20231231', '20240101', '20240103'],
+        )
+
+    def test_parse_dates_invalid(self):
+        for spec in ('2024010', '20240102:20240101', '20240101:x'):
+            with self.assertRaises(ValueError):
+                backfill.parse_dates([spec])
+
+    def test_is_current(self):
+        source = backfill.input_stat(self.write('input.nc', b'input'))
+        self.write('out.ufg', b'raster')
+        manifest = {
+            'input': source,
+            'options': backfill.options_digest({'format': 'ufg'}),
+            'outputs': backfill.outputs_digest(self.tmpdir, ['out.ufg']),
+        }
+
+        self.assertTrue(backfill.is_current(manifest, source, {'format': 'ufg'}, self.tmpdir))
+        self.assertFalse(backfill.is_current(None, source, {'format': 'ufg'}, self.tmpdir))
+        self.assertFalse(backfill.is_current(manifest, source, {'format': 'json'}, self.tmpdir))
+        self.assertFalse(backfill.is_current(manifest, dict(source, size=0), {'format': 'ufg'}, self.tmpdir))
+
+        self.write('out.ufg', b'changed')
+        self.assertFalse(backfill.is_current(manifest, source, {'format': 'ufg'}, self.tmpdir))
+        os.remove(os.path.join(self.tmpdir, 'out.ufg'))
+        self.assertFalse(backfill.is_current(manifest, source, {'format': 'ufg'}, self.tmpdir))
+
+    def test_latest_done(self):
+        day = lambda d: datetime(2024, 1, d)
+        results = [
+            (day(1), {'status': backfill.DONE}),
+            (day(2), {'status': backfill.SKIPPED}),
+            (day(3), {'status': backfill.FAILED, 'message': 'missing'}),
+        ]
+        self.assertEqual(backfill.latest_done(results)[0], day(2))
+        self.assertEqual(backfill.latest_done(results[2:]), (None, None))
+
+
+class StateForwardTests(TempDirMixin, TestCase):
+    '''
+    a backfill of older dates must not move the states back
+    '''
+
+    def setUp(self):
+        super().setUp()
+        self.source = forecast_source.objects.create(
+            name='ECMWF_HRES', full_name='ECMWF HRES', lead_time=240, fcst_type='single'
+        )
+
+    def command(self, module):
+        # the commands look their source up on import
+        command = __import__(f'forecast_data.management.commands.{module}', fromlist=['Command']).Command()
+        command.source_obj = self.source
+        return command
+
+    def init_time(self, state_name):
+        return system_state.objects.get(state_name=state_name).init_time
+
+    def test_raster_state(self):
+        command = self.command('gen_ecmwf_hres_raster')
+        command.update_state('ECMWF_HRES_VIS', '20240103_00')
+        command.update_state('ECMWF_HRES_VIS', '20240101_00')
+        self.assertEqual(self.init_time('ECMWF_HRES_VIS'), '20240103_00')
+
+        command.update_state('ECMWF_HRES_VIS', '20240104_00')
+        self.assertEqual(self.init_time('ECMWF_HRES_VIS'), '20240104_00')
+
+    def test_netcdf_state(self):
+        with override_settings(FCST_SUBSET_CACHE_DIR=self.tmpdir):
+            command = self.command('update_state_ecmwf_hres_nc')
+            command.update_state('20240103_00', {'variables': []})
+            cached = self.write('ECMWF_HRES_NC.20240103_00.key.subset')
+
+            command.update_state('20240101_00', {'variables': []})
+            self.assertEqual(self.init_time('ECMWF_HRES_NC'), '20240103_00')
+            # subsets of the current run are kept
+            self.assertTrue(os.path.exists(cached))
+
+            command.update_state('20240104_00', {'variables': []})
+            self.assertEqual(self.init_time('ECMWF_HRES_NC'), '20240104_00')
+            self.assertFalse(os.path.exists(cached))
+
+
+class ForecastFileMixin(TempDirMixin):
+    '''
+    forecast file of 20240101_00 on a 0.25 degree grid over Sri Lanka,
+    t2m counts up over (time, lat, lon), and its ECMWF_HRES_NC state
+    '''
+
+    lats = np.arange(10, 4.75, -0.25)
+    lons = np.arange(79, 83.25, 0.25)
+    hours = np.arange(0, 30, 6)
+
+    def setUp(self):
+        super().setUp()
+        shape = (len(self.hours), len(self.lats), len(self.lons))
+        self.t2m = np.arange(np.prod(shape), dtype=float).reshape(shape)
+        self.nc_path = os.path.join(self.tmpdir, '01012024.nc')
+        write_forecast_nc(self.nc_path, self.lats, self.lons, self.hours, {'t2m': self.t2m})
+
+        self.cache_dir = os.path.join(self.tmpdir, 'subsets')
+        settings = override_settings(
+            ECMWF_HRES_NC=os.path.join(self.tmpdir, '%d%m%Y.nc'), FCST_SUBSET_CACHE_DIR=self.cache_dir
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        source = forecast_source.objects.create(
+            name='ECMWF_HRES', full_name='ECMWF HRES', lead_time=240, fcst_type='single'
+        )
+        system_state.objects.create(state_name='ECMWF_HRES_NC', init_time='20240101_00', source=source)
+        # pool threads have no view of the test transaction, the state
+        # has to be in the process registry before they start
+        registry.invalidate()
+        get_state('ECMWF_HRES_NC')
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class SubsetConcurrencyTests(ForecastFileMixin, TestCase):
+    '''
+    parallel subset requests of one worker each get their own file
+    '''
+
+    requests = 8
+
+    def test_parallel_subsets(self):
+        url = reverse('forecast.get_netcdf_subset_hres')
+        start = threading.Barrier(self.requests)
+
+        def request(i):
+            start.wait()
+            response = Client().get(url, {
+                'variables': 't2m',
+                'top-lat': 10 - 0.25 * i, 'bottom-lat': 5,
+                'left-lon': 79, 'right-lon': 83,
+            })
+            content = b''.join(response.streaming_content)
+            response.close()
+            return response, content
+
+        with ThreadPoolExecutor(max_workers=self.requests) as pool:
+            results = list(pool.map(request, range(self.requests)))
+
+        digests = set()
+        for i, (response, content) in enumerate(results):
+            self.assertEqual(response['Content-Type'], 'application/netcdf')
+            self.assertEqual(int(response['Content-Length']), len(content))
+            with Dataset('subset.nc', memory=content) as nc:
+                self.assertEqual(nc['latitude'][0], 10 - 0.25 * i)
+                self.assertEqual(nc['t2m'].shape, (5, 21 - i, 17))
+            digests.add(hashlib.sha1(content).hexdigest())
+        self.assertEqual(len(digests), self.requests)
+
+        # every subset is in the cache, no temp file is left
+        names = os.listdir(self.cache_dir)
+        self.assertEqual(len(names), self.requests)
+        self.assertFalse([name for name in names if name.startswith(subset_cache.TEMP_PREFIX)])
+
+
+
+class CoordIndexTests(TempDirMixin, SimpleTestCase):
+    '''
+    bboxes resolve to the cells the np.where masks of the axes select
+    '''
+
+    def mask_slice(self, values, lower, upper):
+        cells = np.where((values >= lower) & (values <= upper))[0]
+        return slice(int(cells[0]), int(cells[-1]) + 1) if cells.size else None
+
+    def bounds(self, values):
+        # grid values, between them, on and beyond the edges
+        n = len(values)
+        step = abs(float(values[-1] - values[0])) / max(n - 1, 1) or 1.0
+        low, high = float(values.min()), float(values.max())
+        on_grid = [float(value) for value in values[np.unique([0, min(1, n - 1), n // 2, max(n - 2, 0), n - 1])]]
+        points = on_grid + [value + step / 2 for value in on_grid] + [low - step, high + step, low - 10, high + 10]
+        return [(lower, upper) for lower in points for upper in points]
+
+    def test_index_slice(self):
+        for values in (
+            np.arange(10, 4.75, -0.25, dtype=np.float32),
+            np.arange(79, 83.25, 0.25, dtype=np.float32),
+            np.array([1.0, 2.0]),
+            np.array([3.0]),
+        ):
+            axis = Axis(values)
+            for lower, upper in self.bounds(values):
+                self.assertEqual(
+                    axis.index_slice(lower, upper), self.mask_slice(values, lower, upper),
+                    f'{values[0]}..{values[-1]} [{lower}, {upper}]'
+                )
+
+    def test_bbox_slices(self):
+        lats, lons = np.arange(10, 4.75, -0.25), np.arange(79, 83.25, 0.25)
+        path = os.path.join(self.tmpdir, 'grid.nc')
+        write_forecast_nc(path, lats, lons, [0], {})
+        index = coord_index(path)
+
+        for top, bottom, right, left in (
+            (10, 5, 83, 79),            # whole grid
+            (10.1, 4.9, 83.1, 78.9),    # beyond every edge
+            (7.1, 6.9, 80.1, 79.9),     # one cell
+            (7.05, 7.01, 80.2, 80.1),   # between cells
+            (12, 11, 83, 79),           # north of the grid
+            (10, 5, 90, 85),            # east of the grid
+        ):
+            masks = (
+                self.mask_slice(index.lats, bottom, top), self.mask_slice(index.lons, left, right)
+            )
+            expected = None if None in masks else masks
+            self.assertEqual(index.bbox_slices(top, bottom, right, left), expected, (top, bottom, right, left))
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class SubsetCacheTests(ForecastFileMixin, TestCase):
+
+    def put(self, key, content, age=0):
+        path = subset_cache.new_temp_path()
+        with open(path, 'wb') as wf:
+            wf.write(content)
+        subset_cache.put(key, path).close()
+        if age:
+            mtime = time.time() - age
+            os.utime(os.path.join(self.cache_dir, key + subset_cache.SUFFIX), (mtime, mtime))
+
+    def cached(self):
+        return sorted(os.path.basename(path)[:-len(subset_cache.SUFFIX)] for _, _, path in subset_cache.cached_files())
+
+    def make_subset(self, **kwargs):
+        kwargs = dict({'top_lat': 7.1, 'bottom_lat': 6.9, 'right_lon': 80.1, 'left_lon': 79.9}, **kwargs)
+        return subset.make_subset(['t2m'], state_name='ECMWF_HRES_NC', ECMWF_NC=settings.ECMWF_HRES_NC, **kwargs)
+
+    def test_hit(self):
+        with mock.patch.object(subset, 'write_subset', wraps=subset.write_subset) as write:
+            first, key, _ = self.make_subset()
+            # a bbox covering the same cells is the same subset
+            second, same_key, _ = self.make_subset(top_lat=7.2, left_lon=79.8)
+            with first, second:
+                self.assertEqual(first.read(), second.read())
+            self.assertEqual(same_key, key)
+            self.assertEqual(write.call_count, 1)
+
+            self.make_subset(stride=2)[0].close()
+            self.assertEqual(write.call_count, 2)
+        self.assertIsNone(subset_cache.get('ECMWF_HRES_NC.20240101_00.missing'))
+
+    def test_lru_eviction(self):
+        with override_settings(FCST_SUBSET_CACHE_MAX_BYTES=30):
+            self.put('s.1.a', b'a' * 10, age=30)
+            self.put('s.1.b', b'b' * 10, age=20)
+            self.put('s.1.c', b'c' * 10, age=10)
+            # a used last, b is the least recently used now
+            subset_cache.get('s.1.a').close()
+            self.put('s.1.d', b'd' * 10)
+        self.assertEqual(self.cached(), ['s.1.a', 's.1.c', 's.1.d'])
+
+    def test_discard_init_times(self):
+        kept = ['ECMWF_HRES_NC.20240102_00.x', 'ECMWF_HRES_NC.20240102_00.y', 'OTHER.20240101_00.x']
+        for key in kept + ['ECMWF_HRES_NC.20240101_00.x']:
+            self.put(key, b'x')
+        subset_cache.discard_init_times('ECMWF_HRES_NC', '20240102_00')
+        self.assertEqual(self.cached(), kept)
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class TimeWindowTests(ForecastFileMixin, TestCase):
+
+    def test_params(self):
+        window = get_time_window(QueryDict('lead-start=6&lead-end=18.5&start-time=20240101_06&stride=2'))
+        self.assertEqual(window, {
+            'first_lead': 6.0, 'last_lead': 18.5, 'first_time': datetime(2024, 1, 1, 6), 'stride': 2,
+        })
+        self.assertEqual(get_time_window(QueryDict('lead-start=&stride=')), {})
+
+        for query in ('lead-start=x', 'end-time=2024-01-01', 'stride=0', 'stride=-1', 'stride=1.5'):
+            with self.assertRaises(ValueError, msg=query):
+                get_time_window(QueryDict(query))
+
+    def test_time_slice(self):
+        index = coord_index(self.nc_path)
+        for kwargs, expected in (
+            ({}, slice(0, 5)),
+            ({'first_lead': 6, 'last_lead': 18}, slice(1, 4)),
+            ({'first_lead': 5, 'last_lead': 19}, slice(1, 4)),
+            ({'first_lead': -100, 'last_lead': 100}, slice(0, 5)),
+            ({'first_time': datetime(2024, 1, 1, 12)}, slice(2, 5)),
+            ({'first_lead': 0, 'last_time': datetime(2024, 1, 1, 6)}, slice(0, 2)),
+            # lead and valid time bounds narrow each other
+            ({'first_lead': 12, 'first_time': datetime(2024, 1, 1, 6)}, slice(2, 5)),
+            ({'first_lead': 7, 'last_lead': 11}, None),
+            ({'first_lead': 18, 'last_lead': 6}, None),
+            ({'first_lead': 25}, None),
+            ({'last_time': datetime(2023, 12, 31)}, None),
+        ):
+            self.assertEqual(index.time_slice(**kwargs), expected, kwargs)
+
+    def get(self, **params):
+        params = dict({'variables': 't2m', 'top-lat': 10, 'bottom-lat': 5, 'left-lon': 79, 'right-lon': 83}, **params)
+        return self.client.get(reverse('forecast.get_netcdf_subset_hres'), params)
+
+    def test_subset(self):
+        response = self.get(**{'lead-start': 6, 'lead-end': 12, 'stride': 3, 'format': 'json'})
+        data = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(data['time'], ['2024-01-01 06:00Z', '2024-01-01 12:00Z'])
+        self.assertEqual((len(data['latitude']), len(data['longitude'])), (7, 6))
+        self.assertEqual(data['variables']['t2m']['values'], self.t2m[1:3, ::3, ::3].tolist())
+
+        self.assertEqual(self.get(**{'lead-start': 100}).json()['error'], 'Out of scope')
+        self.assertEqual(self.get(stride=0).json()['error'], 'invalid request')
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class StateRegistryTests(TestCase):
+
+    def setUp(self):
+        source = forecast_source.objects.create(
+            name='ECMWF_HRES', full_name='ECMWF HRES', lead_time=240, fcst_type='single'
+        )
+        self.state = system_state.objects.create(state_name='ECMWF_HRES_NC', init_time='20240101_00', source=source)
+        registry.invalidate()
+
+    def test_lookups(self):
+        self.assertEqual(get_state('ECMWF_HRES_NC').init_time, '20240101_00')
+        with self.assertNumQueries(0):
+            for _ in range(3):
+                state = get_state('ECMWF_HRES_NC')
+                self.assertEqual((state.init_time, state.source.name), ('20240101_00', 'ECMWF_HRES'))
+            with self.assertRaises(system_state.DoesNotExist):
+                get_state('ECMWF_SEAS_NC')
+
+    def test_invalidated_on_commit(self):
+        get_state('ECMWF_HRES_NC')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.state.init_time = '20240102_00'
+            self.state.save()
+            self.assertEqual(get_state('ECMWF_HRES_NC').init_time, '20240101_00')
+        self.assertEqual(get_state('ECMWF_HRES_NC').init_time, '20240102_00')
+
+class ProductRegistryTests(SimpleTestCase):
+
+    def setUp(self):
+        with open(settings.FCST_PRODUCTS_FILE) as rf:
+            self.config = yaml.safe_load(rf)
+
+    def check_errors(self, config):
+        with self.assertRaises(ValueError) as raised:
+            ProductRegistry(config)
+        return str(raised.exception)
+
+    def test_shipped_registry(self):
+        registry = load_registry(settings.FCST_PRODUCTS_FILE)
+        self.assertEqual(list(registry.source_products('ECMWF_HRES')), ['ECMWF_HRES_VIS'])
+        self.assertEqual(registry.source_variables('ECMWF_HRES'), ['rf', 'tmin', 'tmax', 'wsavg', 'rhavg'])
+
+    def test_check(self):
+        config = copy.deepcopy(self.config)
+        config['regions']['empty'] = {'top_lat': 5, 'bottom_lat': 6, 'left_lon': 79, 'right_lon': 80}
+        config['regions']['partial'] = {'top_lat': 5}
+        config['variables']['rf']['reduce'] = 'median'
+        config['variables']['tmin']['colormap'] = 'grey'
+        config['products']['OTHER'] = dict(
+            config['products']['ECMWF_HRES_VIS'], region='nowhere', variables=['rf', 'snow']
+        )
+
+        errors = self.check_errors(config)
+        for error in (
+            'region empty is empty',
+            'region partial needs',
+            'variable rf has unknown reduce median',
+            'variable tmin has unknown colormap grey',
+            'product OTHER has unknown region nowhere',
+            'product OTHER has unknown variable snow',
+            'product OTHER needs its own output',
+            'product OTHER needs its own state',
+        ):
+            self.assertIn(error, errors)
+
+    def test_inputs(self):
+        registry = ProductRegistry(self.config)
+        # accumulations only need the ends of the day
+        self.assertEqual(registry.inputs(['rf']), (('lsp', 'cp'), ('lsp', 'cp')))
+        self.assertEqual(
+            registry.inputs(['rf', 'tmax', 'rhavg']),
+            (('lsp', 'cp', 't2m', 'd2m'), ('lsp', 'cp')),
+        )
+
+        config = copy.deepcopy(self.config)
+        config['variables']['rfavg'] = dict(config['variables']['rf'], reduce='mean')
+        self.assertEqual(
+            ProductRegistry(config).inputs(['rf', 'rfavg']), (('lsp', 'cp'), ())
+        )
+
+    def test_reduce(self):
+        registry = ProductRegistry(self.config)
+        ones = np.ones((5, 2, 2))
+        window = {'lsp': np.cumsum(ones, axis=0)[[0, -1]] / 1000, 'cp': 0 * ones[[0, -1]]}
+        # lead day 0 is the accumulation from the start of the run
+        np.testing.assert_allclose(registry.reduce('rf', window, 0), 5)
+        np.testing.assert_allclose(registry.reduce('rf', window, 1), 4)
+
+        window = {'t2m': 273.15 + np.arange(5)[:, None, None] * ones}
+        np.testing.assert_allclose(registry.reduce('tmin', window, 1), 0)
+        np.testing.assert_allclose(registry.reduce('tmax', window, 1), 4)
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class ForecastViewTests(TestCase):
+
+    def setUp(self):
+        registry.invalidate()
+
+    def test_unknown_product(self):
+        response = self.client.get(reverse('forecast.forecast_view'), {'product': 'nope'})
+        self.assertEqual(response.json()['error'], 'invalid request')
+
+    def test_product_not_generated(self):
+        response = self.client.get(reverse('forecast.forecast_view'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['error'], 'No state error')
+
+
+class UfgridTests(TempDirMixin, SimpleTestCase):
+
+    grid = {
+        'nx': 4, 'ny': 3, 'dx': 0.1, 'dy': 0.1, 'xll_center': 79.0, 'yll_center': 5.0,
+        'nodata': -9999, 'min': 0.0, 'max': 1.0, 'sf': 100,
+    }
+
+    def round_trip(self, values, compression):
+        path = os.path.join(self.tmpdir, f'raster.{compression}.ufg')
+        ufgrid.write_ufg(path, self.grid, values, compression)
+        return ufgrid.read_ufg(path)
+
+    def test_round_trip(self):
+        values = np.ma.masked_array(
+            np.linspace(-40.123, 45.678, 12).reshape(3, 4), mask=np.eye(3, 4, dtype=bool)
+        )
+        expected = np.where(values.mask, np.nan, np.trunc(values.data * 100) / 100)
+
+        compressions = [ufgrid.NONE, ufgrid.ZLIB] + ([ufgrid.BROTLI] if ufgrid.brotli else [])
+        for compression in compressions:
+            grid, read = self.round_trip(values, compression)
+            self.assertEqual(grid, self.grid)
+            np.testing.assert_allclose(read, expected)
+
+    def test_value_bytes(self):
+        # int16 while the scaled values fit, int32 beyond
+        small = np.full((3, 4), 300.0)
+        large = np.full((3, 4), 400.0)
+        for values, value_bytes in ((small, 2), (large, 4)):
+            path = os.path.join(self.tmpdir, 'raster.ufg')
+            ufgrid.write_ufg(path, self.grid, values, ufgrid.NONE)
+            with open(path, 'rb') as rf:
+                self.assertEqual(rf.read(ufgrid.HEADER.size)[5], value_bytes)
+            np.testing.assert_allclose(ufgrid.read_ufg(path)[1], values)
+
+    def test_not_ufg(self):
+        path = self.write('raster.json', b'{}' + bytes(ufgrid.HEADER.size))
+        with self.assertRaises(ValueError):
+            ufgrid.read_ufg(path)
+
+
+class RasterWindowTests(TempDirMixin, TestCase):
+    '''
+    the rasters read from the bbox of the regions one lead day at a time
+    are the ones of the whole file reduced and cut to the region
+    '''
+
+    # wider than sri_lanka on every side, 10 lead days of 4 steps
+    lats = np.arange(12, 3.75, -0.25)
+    lons = np.arange(77, 85.25, 0.25)
+    hours = np.arange(0, 246, 6)
+
+    def setUp(self):
+        super().setUp()
+        forecast_source.objects.create(
+            name='ECMWF_HRES', full_name='ECMWF HRES', lead_time=240, fcst_type='single'
+        )
+        rng = np.random.default_rng(21)
+        shape = (len(self.hours), len(self.lats), len(self.lons))
+        t2m = rng.uniform(290, 305, shape)
+        t2m[7, 10, 12] = -32767
+        self.variables = {
+            'lsp': np.cumsum(rng.uniform(0, 0.002, shape), axis=0),
+            'cp': np.cumsum(rng.uniform(0, 0.002, shape), axis=0),
+            't2m': t2m,
+            'd2m': t2m - rng.uniform(0, 8, shape),
+            'u10': rng.uniform(-10, 10, shape),
+            'v10': rng.uniform(-10, 10, shape),
+        }
+        self.nc_path = os.path.join(self.tmpdir, '01012024.nc')
+        write_forecast_nc(self.nc_path, self.lats, self.lons, self.hours, self.variables)
+        self.out_dir = os.path.join(self.tmpdir, 'out')
+
+    def full_grid(self, command):
+        # (var_name, lead day) -> region values from the whole file
+        with Dataset(self.nc_path) as nc:
+            arrays = {name: nc.variables[name][:] for name in self.variables}
+        region = command.registry.regions['sri_lanka']
+        lat_cut, lon_cut = coord_index(self.nc_path).bbox_slices(
+            region['top_lat'], region['bottom_lat'], region['right_lon'], region['left_lon']
+        )
+        expected = dict()
+        for iday in range(command.lead_day):
+            window = {name: values[command.day_slice(iday)] for name, values in arrays.items()}
+            for var_name in command.raster_vars:
+                values = command.registry.reduce(var_name, window, iday)[lat_cut, lon_cut]
+                expected[var_name, iday] = np.ma.filled(values.astype(float), np.nan)
+        return expected
+
+    def test_window_matches_full_grid(self):
+        from forecast_data.management.commands.gen_ecmwf_hres_raster import Command, UFG
+
+        for workers in (1, 2):
+            with self.subTest(workers=workers), override_settings(ECMWF_HRES_NC=os.path.join(self.tmpdir, '%d%m%Y.nc')):
+                command = Command()
+                command.configure({'format': UFG, 'compression': ufgrid.ZLIB, 'workers': workers, 'force': True})
+                command.root_path = os.path.join(self.out_dir, str(workers))
+                adate, _ = command.gen_hres_raster_json(datetime(2024, 1, 1))
+                self.assertEqual(adate, '20240101_00')
+
+                for (var_name, iday), expected in self.full_grid(command).items():
+                    path = os.path.join(
+                        command.root_path, 'ECMWF_HRES', adate, f'{var_name}.{command.file_suffix(adate, iday)}'
+                    )
+                    _, values = ufgrid.read_ufg(path)
+                    # the rasters keep two decimals, truncated
+                    np.testing.assert_allclose(values, expected, atol=0.011, err_msg=f'{var_name} day {iday}')
+
+
+class VerificationTests(TempDirMixin, SimpleTestCase):
+
+    def test_continuous_scores(self):
+        fcst = np.array([[1.0, 2.0], [3.0, np.nan]])
+        obs = np.array([[0.0, 2.0], [1.0, 5.0]])
+        scores = verification.continuous_scores(fcst, obs, 0)
+
+        np.testing.assert_array_equal(scores['count'], [2, 1])
+        np.testing.assert_allclose(scores['bias'], [1.5, 0])
+        np.testing.assert_allclose(scores['mae'], [1.5, 0])
+        np.testing.assert_allclose(scores['rmse'], [np.sqrt(2.5), 0])
+        np.testing.assert_allclose(scores['fcst_mean'], [2, 2])
+        np.testing.assert_allclose(scores['obs_mean'], [0.5, 2])
+
+    def test_categorical_scores(self):
+        fcst = np.array([12, 15, 11, 0, 2, 0, 0, 1, 3, 0, np.nan])
+        obs = np.array([10, 20, 0, 30, 0, 0, 1, 0, 0, 0, 50])
+        table = verification.contingency(fcst, obs, 10, 0)
+        self.assertEqual(tuple(int(n) for n in table), (2, 1, 1, 6))
+
+        scores = verification.categorical_scores(*table)
+        self.assertAlmostEqual(scores['pod'], 2 / 3)
+        self.assertAlmostEqual(scores['far'], 1 / 3)
+        self.assertAlmostEqual(scores['csi'], 0.5)
+        self.assertAlmostEqual(scores['fbias'], 1)
+        # random hits (2 + 1) * (2 + 1) / 10
+        self.assertAlmostEqual(scores['ets'], (2 - 0.9) / (4 - 0.9))
+
+        self.assertIsNone(verification.categorical_scores(0, 0, 0, 5)['pod'])
+
+    def test_day_windows(self):
+        path = os.path.join(self.tmpdir, 'forecast.nc')
+        hours = np.arange(0, 54, 6)
+        t2m = 273.15 + np.arange(len(hours), dtype=float)
+        write_forecast_nc(path, [7.0], [80.0], hours, {'t2m': t2m[:, None, None]})
+
+        windows = verification.DayWindows(coord_index(path))
+        np.testing.assert_array_equal(windows.days, [0, 1])
+        self.assertEqual(windows.starts[1], datetime(2024, 1, 2, tzinfo=timezone.utc))
+
+        # (station, time) values, days share their boundary step
+        values = np.arange(len(hours), dtype=float)[None]
+        np.testing.assert_allclose(windows.accumulation(values), [[4, 4]])
+        np.testing.assert_allclose(windows.minimum(values), [[0, 4]])
+        np.testing.assert_allclose(windows.maximum(values), [[4, 8]])
+        np.testing.assert_allclose(windows.mean(values), [[2, 6]])
+
+    def test_combine_scores(self):
+        rng = np.random.default_rng(1)
+        fcst, obs = rng.gamma(1, 10, 40), rng.gamma(1, 10, 40)
+
+        def row(f, o):
+            scores = verification.continuous_scores(f, o, 0)
+            return dict(
+                {k: float(v) for k, v in scores.items()},
+                lead_day=0,
+                categorical={'10': verification.categorical_scores(*verification.contingency(f, o, 10, 0))},
+            )
+
+        combined = verification.combine_scores([row(fcst[:15], obs[:15]), row(fcst[15:], obs[15:])])[0]
+        pooled = row(fcst, obs)
+        for key in ('count', 'bias', 'mae', 'rmse', 'fcst_mean', 'obs_mean'):
+            self.assertAlmostEqual(combined[key], pooled[key])
+        self.assertEqual(combined['categorical'], pooled['categorical'])
+
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class VerificationViewTests(TestCase):
+
+    def setUp(self):
+        registry.invalidate()
+
+    def get(self, **params):
+        return self.client.get(reverse('forecast.verification_hres'), params).json()
+
+    def test_no_state(self):
+        self.assertEqual(self.get(parameter='rainfall')['error'], 'No state error')
+
+    def test_scores(self):
+        self.assertEqual(self.get()['error'], 'invalid request')
+
+        source = forecast_source.objects.create(
+            name='ECMWF_HRES', full_name='ECMWF HRES', lead_time=240, fcst_type='single'
+        )
+        system_state.objects.create(state_name='ECMWF_HRES_NC', init_time='20240101_00', source=source)
+        param = parameter.objects.create(name='rainfall', full_name='Rainfall', unit='mm', parameter_type=parameter.ACCM)
+        registry.invalidate()
+
+        self.assertEqual(self.get()['error'], 'invalid request')
+        self.assertEqual(self.get(parameter='rainfall')['error'], 'No score error')
+
+        verification_score.objects.create(
+            source=source, init_time='20240101_00', parameter=param, lead_day=0,
+            count=2, bias=1.0, mae=1.0, rmse=1.0, fcst_mean=2.0, obs_mean=1.0
+        )
+        data = self.get(parameter='rainfall')
+        self.assertEqual((data['init_times'], data['station_id']), (['20240101_00'], None))
+
+class AcceptVaryTests(TestCase):
+
+    def test_vary_accept(self):
+        # formats come from Accept, shared caches must keep them apart
+        for name in ('forecast.get_netcdf_subset_hres', 'forecast.get_points_hres'):
+            response = self.client.get(reverse(name), HTTP_ACCEPT='text/csv')
+            self.assertIn('Accept', response['Vary'])
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class PointsTests(ForecastFileMixin, TestCase):
+
+    def get(self, **params):
+        params = dict({'lat': 7, 'lon': 80, 'format': 'json'}, **params)
+        return self.client.get(reverse('forecast.get_points_hres'), params)
+
+    def test_points(self):
+        response = self.get(variables='t2m')
+        data = json.loads(b''.join(response.streaming_content))
+        # (7, 80) is the grid cell (12, 4)
+        self.assertEqual(data['variables']['t2m']['values'], [self.t2m[:, 12, 4].tolist()])
+
+    def test_invalid_variables(self):
+        for params in ({'variables': 'nope'}, {'variables': 'latitude'}, {}):
+            self.assertEqual(self.get(**params).json()['error'], 'invalid request')
+
+    def test_command(self):
+        output = os.path.join(self.tmpdir, 'points.json')
+        for args in (['--variables', 'nope'], ['--variables', 't2m', '--date', '20240102']):
+            with self.assertRaises(CommandError):
+                call_command('forecast_points', output, '--point', '7,80', *args)
+        self.assertFalse(os.path.exists(output))
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class NetcdfLockTests(ForecastFileMixin, TestCase):
+    '''
+    NETCDF_LOCK is held for the library calls of a subset only
+    '''
+
+    def lock_free(self):
+        # another thread can take NETCDF_LOCK right now
+        taken = []
+
+        def take():
+            taken.append(NETCDF_LOCK.acquire(timeout=5))
+            if taken[-1]:
+                NETCDF_LOCK.release()
+
+        thread = threading.Thread(target=take)
+        thread.start()
+        thread.join()
+        return taken == [True]
+
+    def watch(self, target, name):
+        # records lock_free() after every call of target.name
+        real, free = getattr(target, name), []
+
+        def call(*args, **kwargs):
+            result = real(*args, **kwargs)
+            free.append(self.lock_free())
+            return result
+
+        patcher = mock.patch.object(target, name, call)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return free
+
+    def get(self, **params):
+        params = dict({'variables': 't2m', 'top-lat': 10, 'bottom-lat': 5, 'left-lon': 79, 'right-lon': 83}, **params)
+        response = self.client.get(reverse('forecast.get_netcdf_subset_hres'), params)
+        return b''.join(response.streaming_content)
+
+    def test_netcdf_blocks(self):
+        free = self.watch(subset, 'read_hyperslab')
+        with mock.patch.object(subset, 'BLOCK_STEPS', 2):
+            content = self.get(stride=2)
+        with Dataset('subset.nc', memory=content) as nc:
+            np.testing.assert_array_equal(nc['t2m'][:], self.t2m[:, ::2, ::2])
+            np.testing.assert_array_equal(nc['time'][:], self.hours)
+        # 5 time steps in blocks of 2, released between read and write
+        self.assertEqual(free, [True] * 3)
+
+    def test_text_formats(self):
+        free = self.watch(subset, 'write_csv')
+        content = self.get(format='csv').decode()
+        self.assertEqual(len(content.splitlines()), 1 + self.t2m.size)
+        self.assertEqual(free, [True])
+
+    def test_points(self):
+        free = self.watch(PointWeights, 'apply')
+        self.client.get(reverse('forecast.get_points_hres'), {'variables': 't2m', 'lat': 7, 'lon': 80})
+        self.assertEqual(free, [True])
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class JobExpiryTests(TempDirMixin, TestCase):
+    '''
+    unfinished jobs are failed only when their worker stopped heartbeating
+    '''
+
+    def setUp(self):
+        super().setUp()
+        settings = override_settings(FCST_JOB_DIR=self.tmpdir, FCST_JOB_TIMEOUT=600)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def job(self, status, age=0, local=False):
+        job = subset_job.objects.create(job_id=uuid.uuid4(), state_name='ECMWF_HRES_NC', status=status)
+        subset_job.objects.filter(pk=job.pk).update(updated_at=datetime.now(timezone.utc) - timedelta(seconds=age))
+        if local:
+            jobs._jobs.add(job.pk)
+            self.addCleanup(jobs._jobs.discard, job.pk)
+        return job
+
+    def status(self, job):
+        return subset_job.objects.get(pk=job.pk).status
+
+    def test_local_jobs(self):
+        # waiting behind busy pool threads or in a long read of this process
+        queued = self.job(subset_job.QUEUED, age=3600, local=True)
+        running = self.job(subset_job.RUNNING, age=3600, local=True)
+        self.assertEqual(jobs.expire_jobs(), 0)
+
+        self.assertEqual(jobs.touch_jobs(), 2)
+        jobs._jobs.clear()
+        self.assertEqual(jobs.expire_jobs(), 0)
+        self.assertEqual((self.status(queued), self.status(running)), (subset_job.QUEUED, subset_job.RUNNING))
+
+    def test_lost_jobs(self):
+        lost = [self.job(subset_job.QUEUED, age=601), self.job(subset_job.RUNNING, age=601)]
+        alive = self.job(subset_job.RUNNING, age=300)
+        done = self.job(subset_job.DONE)
+        subset_job.objects.filter(pk=done.pk).update(expires_at=datetime.now(timezone.utc))
+        path = self.write(str(done.job_id))
+
+        self.assertEqual(jobs.expire_jobs(), 3)
+        self.assertEqual([self.status(job) for job in lost], [subset_job.FAILED] * 2)
+        self.assertEqual(self.status(alive), subset_job.RUNNING)
+        self.assertEqual(self.status(done), subset_job.EXPIRED)
+        self.assertFalse(os.path.exists(path))
+
+    def test_heartbeat_during_run(self):
+        job = self.job(subset_job.QUEUED, local=True)
+        job.params = {'variables': ['t2m'], 'top-lat': ['10'], 'bottom-lat': ['5'], 'left-lon': ['79'], 'right-lon': ['83']}
+        job.save()
+        beats = []
+
+        def make_subset(**kwargs):
+            # a long read, the heartbeat still reaches the running job
+            beats.append(jobs.touch_jobs())
+            raise SubsetError('No file error', 'Requested file does not exist')
+
+        with mock.patch.object(jobs, 'make_subset', make_subset), mock.patch.object(jobs, 'connections'):
+            jobs.run_job(job.pk)
+
+        self.assertEqual(beats, [1])
+        self.assertEqual(self.status(job), subset_job.FAILED)
+        self.assertNotIn(job.pk, jobs.local_jobs())
@@ -0,0 +1,119 @@
+'''
+Binary uniform grid (ufg) rasters of the forecast map
+
+Same content as the ufgrid JSON of gen_ecmwf_hres_raster, a fixed
+little-endian header followed by the scaled values as int16 or int32,
+row by row from the first latitude of the grid.
+
+    offset  type     field
+         0  4s       magic b'UFG1'
+         4  uint8    version
+         5  uint8    bytes per value, 2 or 4
+         6  uint8    payload compression, see COMPRESSIONS
+         7  uint8    reserved
+         8  uint32   nx
+        12  uint32   ny
+        16  float64  dx, dy, xll_center, yll_center, nodata, min, max, sf
+        80  int32    fill, payload value of missing cells
+        84           payload, nx * ny values
+
+values are value * sf truncated to integers like the JSON data, int16 is
+used whenever they fit. The payload is optionally zlib (deflate, decoded
+by the browser's DecompressionStream) or brotli compressed, brotli needs
+the optional brotli package. templates/js/dataex-rastergrid-loader.js
+reads the format into typed arrays.
+'''
+import struct
+import zlib
+
+import numpy as np
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+MAGIC = b'UFG1'
+VERSION = 1
+HEADER = struct.Struct('<4sBBBBII8di')
+
+NONE, ZLIB, BROTLI = 'none', 'zlib', 'brotli'
+COMPRESSIONS = (NONE, ZLIB, BROTLI)
+
+VALUE_TYPES = {2: np.dtype('<i2'), 4: np.dtype('<i4')}
+
+
+def compress(payload, compression):
+    if compression == ZLIB:
+        return zlib.compress(payload, 6)
+    if compression == BROTLI:
+        if brotli is None:
+            raise ValueError('brotli compression needs the brotli package')
+        return brotli.compress(payload)
+    return payload
+
+
+def decompress(payload, compression):
+    if compression == ZLIB:
+        return zlib.decompress(payload)
+    if compression == BROTLI:
+        if brotli is None:
+            raise ValueError('brotli compression needs the brotli package')
+        return brotli.decompress(payload)
+    return payload
+
+
+def write_ufg(path, grid, values, compression=ZLIB):
+    '''
+    grid   -> nx, ny, dx, dy, xll_center, yll_center, nodata, min, max, sf
+              as written to the ufgrid JSON
+    values -> (ny, nx) array, masked cells are missing
+    '''
+    scaled = np.ma.masked_invalid(np.ma.asarray(values, dtype=float) * grid['sf'])
+    scaled = np.trunc(scaled)
+
+    value_bytes = 4
+    if scaled.count() == 0 or (scaled.min() > -2 ** 15 and scaled.max() < 2 ** 15):
+        value_bytes = 2
+    dtype = VALUE_TYPES[value_bytes]
+    fill = int(np.iinfo(dtype).min)
+
+    payload = np.ma.filled(scaled, fill).astype(dtype).tobytes()
+    header = HEADER.pack(
+        MAGIC, VERSION, value_bytes, COMPRESSIONS.index(compression), 0,
+        grid['nx'], grid['ny'],
+        grid['dx'], grid['dy'], grid['xll_center'], grid['yll_center'],
+        grid['nodata'], grid['min'], grid['max'], grid['sf'],
+        fill,
+    )
+
+    with open(path, 'wb') as wf:
+        wf.write(header)
+        wf.write(compress(payload, compression))
+
+
+def read_ufg(path):
+    '''
+    returns the grid fields and the (ny, nx) values, nan where missing
+    '''
+    with open(path, 'rb') as rf:
+        content = rf.read()
+
+    (
+        magic, version, value_bytes, compression, _, nx, ny,
+        dx, dy, xll_center, yll_center, nodata, v_min, v_max, sf, fill
+    ) = HEADER.unpack_from(content)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f'{path} is not a ufg raster')
+
+    payload = decompress(content[HEADER.size:], COMPRESSIONS[compression])
+    scaled = np.frombuffer(payload, dtype=VALUE_TYPES[value_bytes]).reshape(ny, nx)
+    values = np.where(scaled == fill, np.nan, scaled / sf)
+
+    grid = {
+        'nx': nx, 'ny': ny, 'dx': dx, 'dy': dy,
+        'xll_center': xll_center, 'yll_center': yll_center,
+        'nodata': nodata, 'min': v_min, 'max': v_max, 'sf': sf,
+    }
+    return grid, values
@@ -5,5 +5,9 @@ from .views import *
 urlpatterns = [
     path('', ForecastView.as_view(), name='forecast.forecast_view'),
     path('netcdf/', NetcdfView.as_view(), name='forecast.forecast_netcdf'),
-    path('get_netcdf_subset_hres/', get_netcdf_subset_ecmwf_hres.as_view(), name='forecast.get_netcdf_subset_hres' )
+    path('get_netcdf_subset_hres/', get_netcdf_subset_ecmwf_hres.as_view(), name='forecast.get_netcdf_subset_hres' ),
+    path('jobs/<uuid:job_id>/', subset_job_status.as_view(), name='forecast.subset_job'),
+    path('jobs/<uuid:job_id>/download/', subset_job_download.as_view(), name='forecast.subset_job_download'),
+    path('get_points_hres/', get_points_ecmwf_hres.as_view(), name='forecast.get_points_hres'),
+    path('verification_hres/', get_verification_ecmwf_hres.as_view(), name='forecast.verification_hres'),
 ]
\ No newline at end of file
@@ -0,0 +1,287 @@
+'''
+Verification of forecasts against station observations
+
+Forecast values are taken at the grid cell nearest to every obs_data
+station (the weights of forecast_data.points, computed once per grid) and
+reduced to daily values per lead day, the same way the raster products
+are made
+    rainfall   : accumulation over the day of lsp + cp, mm
+    tmin/tmax  : minimum / maximum of t2m over the day, °C
+    tavg       : mean of t2m over the day, °C
+lead day d covers lead hours [24 * d, 24 * (d + 1)] and is matched to the
+observed daily value (obs_data.aggregation rollup) of the UTC day it
+starts on.
+
+Bias, MAE and RMSE and for rainfall the contingency table of every
+threshold in FCST_VERIF_RAIN_THRESHOLDS are computed for all stations
+together and for every station, for all lead days at once, and stored
+in verification_score. combine_scores merges stored rows of several
+init times from their counts, without going back to the data.
+'''
+import math
+from datetime import timedelta, timezone
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+
+from forecast_data.models import verification_score
+from forecast_data.ncio import coord_index
+from forecast_data.points import extract_points, station_points, NEAREST
+from obs_data.aggregation import rollup, DAY
+from obs_data.models import obs_data
+from obs_data.registry import get_reference
+
+
+HOURS_PER_DAY = 24
+RAINFALL, TMIN, TMAX, TAVG = 'rainfall', 'tmin', 'tmax', 'tavg'
+
+
+class DayWindows:
+
+    def __init__(self, index):
+        # lead days whose first and last hour are time steps of the file
+        leads = index.lead.values.astype(float)
+        days, first, last = [], [], []
+        for day in range(int(leads[-1] // HOURS_PER_DAY) if leads.size else 0):
+            start = np.flatnonzero(leads == day * HOURS_PER_DAY)
+            end = np.flatnonzero(leads == (day + 1) * HOURS_PER_DAY)
+            if start.size and end.size:
+                days.append(day)
+                first.append(start[0])
+                last.append(end[0])
+
+        self.days = np.array(days, dtype=int)
+        self.first = np.array(first, dtype=int)
+        self.last = np.array(last, dtype=int)
+        steps = np.arange(leads.size)
+        # (day, time) steps within each day, both ends included
+        self.mask = (steps >= self.first[:, None]) & (steps <= self.last[:, None])
+        self.starts = [
+            index.valid_times[i].replace(tzinfo=timezone.utc) for i in self.first
+        ]
+
+    def accumulation(self, values):
+        return values[:, self.last] - values[:, self.first]
+
+    def minimum(self, values):
+        return np.where(self.mask[None], values[:, None, :], np.inf).min(axis=2)
+
+    def maximum(self, values):
+        return np.where(self.mask[None], values[:, None, :], -np.inf).max(axis=2)
+
+    def mean(self, values):
+        return np.where(self.mask[None], values[:, None, :], 0).sum(axis=2) / self.mask.sum(axis=1)
+
+
+# obs_data parameter -> (forecast variables, (station, time) values -> (station, day) values)
+PARAMETERS = {
+    RAINFALL: (('lsp', 'cp'), lambda v, w: w.accumulation((v['lsp'] + v['cp']) * 1000)),
+    TMIN: (('t2m',), lambda v, w: w.minimum(v['t2m'] - 273.15)),
+    TMAX: (('t2m',), lambda v, w: w.maximum(v['t2m'] - 273.15)),
+    TAVG: (('t2m',), lambda v, w: w.mean(v['t2m'] - 273.15)),
+}
+
+CATEGORICAL = (RAINFALL,)
+
+
+def observed_daily(param, station_ids, windows):
+    '''
+    (station, day) observed daily values, nan where missing
+    '''
+    values = np.full((len(station_ids), len(windows.days)), np.nan)
+    if not len(windows.days):
+        return values
+
+    qs = obs_data.objects.filter(
+        parameter_id=param['id'],
+        station_id__in=station_ids,
+        start_time__gte=windows.starts[0],
+        start_time__lt=windows.starts[-1] + timedelta(days=1),
+    )
+
+    rows = {stn_id: i for i, stn_id in enumerate(station_ids)}
+    cols = {start.date(): j for j, start in enumerate(windows.starts)}
+    for row in rollup(qs, param['parameter_type'], DAY, group_by=('station_id',)):
+        j = cols.get(row['start_time'].date(), None)
+        if j is not None:
+            values[rows[row['station_id']], j] = row['value']
+    return values
+
+
+def continuous_scores(fcst, obs, axis):
+    '''
+    count, bias, mae, rmse, fcst_mean and obs_mean of the pairs where both
+    are present, reduced along axis, nan where there are no pairs
+    '''
+    valid = ~(np.isnan(fcst) | np.isnan(obs))
+    error = np.where(valid, fcst - obs, 0)
+    count = valid.sum(axis=axis)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {
+            'count': count,
+            'bias': error.sum(axis=axis) / count,
+            'mae': np.abs(error).sum(axis=axis) / count,
+            'rmse': np.sqrt(np.square(error).sum(axis=axis) / count),
+            'fcst_mean': np.where(valid, fcst, 0).sum(axis=axis) / count,
+            'obs_mean': np.where(valid, obs, 0).sum(axis=axis) / count,
+        }
+
+
+def contingency(fcst, obs, threshold, axis):
+    # hits, misses, false alarms and correct negatives of value >= threshold
+    valid = ~(np.isnan(fcst) | np.isnan(obs))
+    fcst_yes = valid & (fcst >= threshold)
+    obs_yes = valid & (obs >= threshold)
+
+    hits = (fcst_yes & obs_yes).sum(axis=axis)
+    misses = (~fcst_yes & obs_yes).sum(axis=axis)
+    false_alarms = (fcst_yes & ~obs_yes).sum(axis=axis)
+    correct_negatives = valid.sum(axis=axis) - hits - misses - false_alarms
+    return hits, misses, false_alarms, correct_negatives
+
+
+def categorical_scores(hits, misses, false_alarms, correct_negatives):
+    '''
+    contingency table with POD, FAR, CSI, frequency bias and ETS,
+    scores are None where undefined
+    '''
+    def ratio(a, b):
+        return float(a / b) if b else None
+
+    total = hits + misses + false_alarms + correct_negatives
+    random_hits = (hits + misses) * (hits + false_alarms) / total if total else 0
+    return {
+        'hits': int(hits),
+        'misses': int(misses),
+        'false_alarms': int(false_alarms),
+        'correct_negatives': int(correct_negatives),
+        'pod': ratio(hits, hits + misses),
+        'far': ratio(false_alarms, hits + false_alarms),
+        'csi': ratio(hits, hits + misses + false_alarms),
+        'fbias': ratio(hits + false_alarms, hits + misses),
+        'ets': ratio(hits - random_hits, hits + misses + false_alarms - random_hits),
+    }
+
+
+def score_rows(source, init_time, param, station_ids, days, fcst, obs, thresholds):
+    '''
+    verification_score rows of all stations and of every station
+    fcst, obs -> (station, day) values
+    '''
+    rows = []
+    # all stations reduce the station axis, every station is a single pair
+    for stations, f, o, axis in (
+        ([None], fcst, obs, 0),
+        (station_ids, fcst[..., None], obs[..., None], 2),
+    ):
+        scores = continuous_scores(f, o, axis)
+        tables = [contingency(f, o, threshold, axis) for threshold in thresholds]
+
+        # all stations -> (day,) arrays, every station -> (station, day) arrays
+        for i, stn_id in enumerate(stations):
+            for j, day in enumerate(days):
+                pos = (j,) if stn_id is None else (i, j)
+                if not scores['count'][pos]:
+                    continue
+
+                rows.append(verification_score(
+                    source=source,
+                    init_time=init_time,
+                    parameter_id=param['id'],
+                    station_id=stn_id,
+                    lead_day=int(day),
+                    categorical={
+                        str(threshold): categorical_scores(*(table[k][pos] for k in range(4)))
+                        for threshold, table in zip(thresholds, tables)
+                    },
+                    **{
+                        k: int(v[pos]) if k == 'count' else float(v[pos])
+                        for k, v in scores.items()
+                    }
+                ))
+    return rows
+
+
+def verify(source, init_time, nc_path, param_names=None):
+    '''
+    scores of the forecast at nc_path against the observations, replaces
+    the stored scores of source, init_time and the parameters
+    returns the number of rows stored
+    '''
+    if param_names is None:
+        param_names = list(PARAMETERS)
+
+    params = {param['name']: param for param in get_reference().parameters.values()}
+    missing = [name for name in param_names if name not in params or name not in PARAMETERS]
+    if missing:
+        raise KeyError(', '.join(missing))
+
+    index = coord_index(nc_path)
+    windows = DayWindows(index)
+
+    points = station_points()
+    station_ids = [point['station_id'] for point in points]
+
+    variables = sorted({v_name for name in param_names for v_name in PARAMETERS[name][0]})
+    values, _ = extract_points(nc_path, index, points, variables, NEAREST, slice(None))
+
+    rows = []
+    for name in param_names:
+        fcst = PARAMETERS[name][1](values, windows)
+        obs = observed_daily(params[name], station_ids, windows)
+        thresholds = settings.FCST_VERIF_RAIN_THRESHOLDS if name in CATEGORICAL else ()
+        rows.extend(score_rows(
+            source, init_time, params[name], station_ids, windows.days, fcst, obs, thresholds
+        ))
+
+    with transaction.atomic():
+        verification_score.objects.filter(
+            source=source, init_time=init_time, parameter__name__in=param_names
+        ).delete()
+        verification_score.objects.bulk_create(rows, batch_size=settings.OBS_INGEST_BATCH_SIZE)
+
+    return len(rows)
+
+
+def combine_scores(rows):
+    '''
+    merges stored scores of several init times by lead day
+    rows -> dicts with lead_day, count, bias, mae, rmse, fcst_mean,
+            obs_mean and categorical
+    '''
+    days = dict()
+    for row in rows:
+        day = days.setdefault(row['lead_day'], {
+            'count': 0, 'error': 0.0, 'abs_error': 0.0, 'sq_error': 0.0,
+            'fcst': 0.0, 'obs': 0.0, 'tables': dict(),
+        })
+        n = row['count']
+        day['count'] += n
+        day['error'] += row['bias'] * n
+        day['abs_error'] += row['mae'] * n
+        day['sq_error'] += row['rmse'] ** 2 * n
+        day['fcst'] += row['fcst_mean'] * n
+        day['obs'] += row['obs_mean'] * n
+        for threshold, table in row['categorical'].items():
+            total = day['tables'].setdefault(threshold, [0, 0, 0, 0])
+            for k, key in enumerate(('hits', 'misses', 'false_alarms', 'correct_negatives')):
+                total[k] += table[key]
+
+    return [
+        {
+            'lead_day': lead_day,
+            'count': day['count'],
+            'bias': day['error'] / day['count'],
+            'mae': day['abs_error'] / day['count'],
+            'rmse': math.sqrt(day['sq_error'] / day['count']),
+            'fcst_mean': day['fcst'] / day['count'],
+            'obs_mean': day['obs'] / day['count'],
+            'categorical': {
+                threshold: categorical_scores(*table)
+                for threshold, table in day['tables'].items()
+            },
+        }
+        for lead_day, day in sorted(days.items())
+    ]
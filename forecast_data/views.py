@@ -1,18 +1,36 @@
 import os
-import io
+import json
 import pytz
 from datetime import datetime 
 
-import numpy as np
-from netCDF4 import Dataset
-from sricdms.settings import ECMWF_HRES_NC
-
 from django.shortcuts import render
 from django.views import View
+from django.utils.decorators import method_decorator
+from django.views.decorators.vary import vary_on_headers
 from django.conf import settings
 from django.http.response import FileResponse, JsonResponse
 
-from forecast_data.models import system_state
+from forecast_data.models import system_state, subset_job, verification_score
+from forecast_data.registry import get_state
+from forecast_data import subset_cache
+from forecast_data.ncio import coord_index
+from forecast_data.subset import (
+    make_subset, subset_filename, SubsetError, NETCDF, JSON, CONTENT_TYPES, FILE_EXTENSIONS
+)
+from forecast_data.points import extract_points, write_points, check_variables, NEAREST, METHODS
+from forecast_data.request_params import (
+    get_points, get_subset_params, get_time_window, get_output_options
+)
+from forecast_data.jobs import submit_job, job_info, job_file, JobQueueFull
+from forecast_data.verification import combine_scores
+from forecast_data.products import get_registry
+
+
+# subset files are streamed to the client in chunks of this many bytes
+SUBSET_BLOCK_SIZE = 64 * 1024
+
+# product of the forecast map without a product param
+DEFAULT_PRODUCT = 'ECMWF_HRES_VIS'
 
 
 # Create your views here.
@@ -23,14 +41,20 @@ class ForecastView(View):
     def get(self, request):
         data = dict()
 
-        data['state_name'] = 'ECMWF_HRES_VIS'
-        data['source'] = 'ECMWF_HRES'
+        # products of forecast_data/products.yaml, rasters under FCST_JSONOUT/<output>
+        products = get_registry().products
+        product = products.get(request.GET.get('product', DEFAULT_PRODUCT), None)
+        if product is None:
+            return JsonResponse({'error': 'invalid request', 'message': f'product must be one of {", ".join(products)}'})
+
+        data['state_name'] = product['state']
+        data['source'] = product['output']
 
         # need to override this with system_state only 
-        data['init_time'] = system_state.objects.filter(
-                                state_name=data['state_name'],
-                                source__name=data['source']
-                            ).values('init_time').first()['init_time']
+        try:
+            data['init_time'] = get_state(data['state_name']).init_time
+        except system_state.DoesNotExist:
+            return JsonResponse({'error': 'No state error', 'message': f'rasters of {product["state"]} are not generated yet'})
         
         data['url_prefix'] = os.path.join(settings.FCST_JSON_URL_PREF,data['source'],data['init_time'])
         data['data'] = get_netcdf_info('ECMWF_HRES_NC')
@@ -44,34 +68,110 @@ class NetcdfView(View):
         return render(request, 'netcdf_view.html')
     
 
+# the output format may be taken from the Accept header
+@method_decorator(vary_on_headers('Accept'), name='get')
 class get_netcdf_subset_ecmwf_hres(View):
 
     state_name = "ECMWF_HRES_NC"
 
     def get(self, request):
-        param_list = request.GET.getlist('variables')
-        left_lon, right_lon = float(request.GET.get('left-lon')), float(request.GET.get('right-lon'))
-        top_lat, bottom_lat = float(request.GET.get('top-lat')), float(request.GET.get('bottom-lat'))
+        accept = request.headers.get('Accept', '')
+        try:
+            subset_params = get_subset_params(request.GET, accept)
+        except ValueError as e:
+            return JsonResponse({'error': 'invalid request', 'message': str(e)})
+
+        # large requests are built by the job queue, see forecast_data.jobs
+        if request.GET.get('async', None) in ('1', 'true'):
+            params = dict(request.GET.lists())
+            params['format'] = [subset_params['fmt']]
+            try:
+                job = submit_job(self.state_name, params)
+            except JobQueueFull as e:
+                return JsonResponse({'error': 'Busy', 'message': str(e)})
+            return JsonResponse(job_info(job), status=202)
 
         return get_subset_netcdf(
+            state_name=self.state_name,
+            ECMWF_NC=settings.ECMWF_HRES_NC,
+            **subset_params
+        )
+
+
+class subset_job_status(View):
+
+    def get(self, request, job_id):
+        job = subset_job.objects.filter(job_id=job_id).first()
+        if job is None:
+            return JsonResponse({'error': 'No job error', 'message': 'Requested job does not exist'})
+        return JsonResponse(job_info(job))
+
+
+class subset_job_download(View):
+
+    def get(self, request, job_id):
+        job = subset_job.objects.filter(job_id=job_id).first()
+        if job is None:
+            return JsonResponse({'error': 'No job error', 'message': 'Requested job does not exist'})
+        if job.status != subset_job.DONE:
+            return JsonResponse({'error': 'Not ready', 'message': f'job is {job.status}', **job_info(job)})
+
+        try:
+            job_subset = subset_cache.open_file(job_file(job))
+        except FileNotFoundError:
+            return JsonResponse({'error': 'No file error', 'message': 'Requested file does not exist'})
+
+        return download_response(job_subset, job.file_name, job.params['format'][0], job.init_time)
+
+
+# the output format may be taken from the Accept header
+@method_decorator(vary_on_headers('Accept'), name='get')
+class get_points_ecmwf_hres(View):
+
+    state_name = "ECMWF_HRES_NC"
+
+    def get(self, request):
+        param_list = request.GET.getlist('variables')
+
+        try:
+            points = get_points(request.GET)
+            window = get_time_window(request.GET)
+            output = get_output_options(request.GET, request.headers.get('Accept', ''), default=JSON)
+        except ValueError as e:
+            return JsonResponse({'error': 'invalid request', 'message': str(e)})
+
+        method = request.GET.get('method', NEAREST)
+        if method not in METHODS:
+            return JsonResponse({
+                'error': 'invalid request',
+                'message': f'method must be one of {", ".join(METHODS)}'
+            })
+
+        if 'stride' in window or 'complevel' in output or 'least_significant_digit' in output:
+            return JsonResponse({
+                'error': 'invalid request',
+                'message': 'stride, complevel and least-significant-digit do not apply to points'
+            })
+
+        return get_forecast_points(
             param_list,
-            top_lat,
-            bottom_lat,
-            right_lon,
-            left_lon,
+            points,
+            method,
             self.state_name,
-            ECMWF_HRES_NC
+            settings.ECMWF_HRES_NC,
+            **window,
+            **output
         )
 
 
 def get_netcdf_info(state_name):
     data = dict()
     params = dict()
-    data['sys_state'] = system_state.objects.get(state_name=state_name)
+    data['sys_state'] = get_state(state_name)
     data['nc_date'] = (
         datetime.strptime(data['sys_state'].init_time, '%Y%m%d_%H')
     ).strftime('%d-%m-%Y')
-    info = system_state.objects.get(state_name=state_name).info
+    info = data['sys_state'].info
     for var in info['variables']:
         if (var['name'] == 'latitude' or
                 var['name'] == 'longitude' or
@@ -112,105 +212,157 @@ def get_subset_netcdf(
         left_lon,
         state_name,
         ECMWF_NC,
-        req_date=None
+        **kwargs
+):
+    '''
+    subset of the forecast file as download, see make_subset for kwargs
+    '''
+    try:
+        subset_file, _, update = make_subset(
+            sel_params, top_lat, bottom_lat, right_lon, left_lon, state_name, ECMWF_NC, **kwargs
+        )
+    except SubsetError as e:
+        return JsonResponse({'error': e.error, 'message': e.message})
+
+    fmt = kwargs.get('fmt', NETCDF)
+    return download_response(subset_file, subset_filename(state_name, top_lat, bottom_lat, right_lon, left_lon, fmt), fmt, update)
+
+
+class get_verification_ecmwf_hres(View):
+
+    state_name = "ECMWF_HRES_NC"
+
+    # parameter=<obs_data parameter name>, station_id=<id> else all stations,
+    # init_time=yyyymmdd_hh or start-date/end-date=yyyymmdd for a range of
+    # init times, default the current state
+    def get(self, request):
+        param_name = request.GET.get('parameter', None)
+        if not param_name:
+            return JsonResponse({'error': 'invalid request', 'message': 'parameter is required'})
+
+        try:
+            state = get_state(self.state_name)
+        except system_state.DoesNotExist:
+            return JsonResponse({'error': 'No state error', 'message': f'{self.state_name} is not available yet'})
+        source = state.source
+
+        station_id = request.GET.get('station_id', None)
+        start_date = request.GET.get('start-date', None)
+        end_date = request.GET.get('end-date', None)
+
+        qs = verification_score.objects.filter(source=source, parameter__name=param_name)
+
+        try:
+            qs = qs.filter(station_id=int(station_id) if station_id else None)
+            if start_date or end_date:
+                if start_date:
+                    qs = qs.filter(init_time__gte=datetime.strptime(start_date, '%Y%m%d').strftime('%Y%m%d_00'))
+                if end_date:
+                    qs = qs.filter(init_time__lte=datetime.strptime(end_date, '%Y%m%d').strftime('%Y%m%d_23'))
+            else:
+                init_time = request.GET.get('init_time', None) or state.init_time
+                qs = qs.filter(init_time=init_time)
+        except ValueError:
+            return JsonResponse({
+                'error': 'invalid request',
+                'message': 'station_id must be an integer and start-date/end-date formatted as yyyymmdd'
+            })
+
+        rows = list(qs.values(
+            'init_time', 'lead_day', 'count', 'bias', 'mae', 'rmse', 'fcst_mean', 'obs_mean', 'categorical'
+        ))
+        if not rows:
+            return JsonResponse({'error': 'No score error', 'message': 'No verification scores for the request'})
+
+        return JsonResponse({
+            'source': source.name,
+            'parameter': param_name,
+            'station_id': int(station_id) if station_id else None,
+            'init_times': sorted({row['init_time'] for row in rows}),
+            'scores': combine_scores(rows),
+        })
+
+
+def download_response(subset_file, filename, fmt, update):
+    file_response = FileResponse(
+            subset_file,
+            filename=filename,
+            as_attachment=True
+    )
+    # sent with the server's file wrapper (sendfile) where available,
+    # otherwise in chunks of block_size, never loaded as a whole
+    file_response.block_size = SUBSET_BLOCK_SIZE
+    file_response['Content-Length'] = os.fstat(subset_file.fileno()).st_size
+    file_response['Content-Type'] = CONTENT_TYPES[fmt]
+    file_response['init_time'] = datetime.strptime(update, '%Y%m%d_%H')
+    return file_response
+
+
+def get_forecast_points(
+        sel_params,
+        points,
+        method,
+        state_name,
+        ECMWF_NC,
+        req_date=None,
+        first_lead=None,
+        last_lead=None,
+        first_time=None,
+        last_time=None,
+        fmt=JSON,
+        significant_digits=None
 ):
+    '''
+    forecast time series at points as download in fmt,
+    points x time for every variable
+    '''
     if req_date:
         update = req_date
     else:
-        update = system_state.objects.get(state_name=state_name).init_time
+        update = get_state(state_name).init_time
 
     nc_origin_path = (
         datetime.strptime(update, '%Y%m%d_%H')
     ).strftime(ECMWF_NC)
 
     try:
-        nc_origin = Dataset(nc_origin_path)
+        index = coord_index(nc_origin_path)
+        mtime_ns = os.stat(nc_origin_path).st_mtime_ns
     except FileNotFoundError:
         data = {}
         data['error'] = 'No file error'
         data['message'] = 'Requested file does not exist'
         return JsonResponse(data)
 
-    # memory is essentially gets ignored if the file format is NETCDF4
-    nc_subset = Dataset('subset.nc', 'w', format="NETCDF4", memory=0)
-
-    lats = nc_origin.variables['latitude'][:]
-    lons = nc_origin.variables['longitude'][:]
-    times = nc_origin.variables['time'][:]
-
-    lat_indices, lon_indices = np.where((lats >= bottom_lat) & (lats <= top_lat)), np.where((lons >= left_lon) & (lons <= right_lon))
-    lat_crop, lon_crop = lats[lat_indices], lons[lon_indices]
     try:
-        latli, latui = lat_indices[0][0], lat_indices[0][-1]
-        lonli, lonui = lon_indices[0][0], lon_indices[0][-1]
-    except IndexError:
+        check_variables(index, sel_params)
+    except ValueError as e:
+        return JsonResponse({'error': 'invalid request', 'message': str(e)})
+
+    time_slice = index.time_slice(first_lead, last_lead, first_time, last_time)
+    if time_slice is None:
         return JsonResponse(
             {
                 'error': 'Out of scope',
-                'message': 'Selected region not available'
+                'message': 'Selected time window not available'
             }
         )
 
-    # dimensions of the subset
-    nc_subset.createDimension('latitude', len(lat_crop))
-    nc_subset.createDimension('longitude', len(lon_crop))
-    nc_subset.createDimension('time', len(times))
-
-    # set values for subset's variables which are in dimensions \
-    # -> lat,lon and time
-    for var_name in nc_subset.dimensions:
-
-        var_subset = nc_subset.createVariable(
-                var_name, nc_origin.variables[var_name].datatype,
-                nc_origin.variables[var_name].dimensions
-        )
-        var_subset.setncatts(
-            {
-                k: nc_origin[var_name].getncattr(k)
-                for k in nc_origin[var_name].ncattrs()
-            }
-        )
-
-        if var_name == 'time':
-            var_subset[:] = times
-
-        if var_name == 'latitude':
-            var_subset[:] = lat_crop
-
-        if var_name == 'longitude':
-            var_subset[:] = lon_crop
-
-    # set values for the params requested by the user
-    for v_name in sel_params:
-        var_subset = nc_subset.createVariable(
-                v_name, nc_origin.variables[v_name].datatype,
-                nc_origin.variables[v_name].dimensions
-            )
-        var_subset.setncatts(
-            {
-                k: nc_origin[v_name].getncattr(k)
-                for k in nc_origin[v_name].ncattrs()
-            }
-        )
-        var_subset[:] = nc_origin[v_name][:, latli:latui+1, lonli:lonui+1]
-
-    nc_origin.close()
-    nc_subset.generated_by = 'Data Exchange Portal, RIMES'
-    nc_subset.source = 'European Center for Medium Range Weather Forecast'
-    nc_subset.generation_time = datetime.today().strftime('%Y %b %m %H:%M:%S')
-
-    mem_view_subset = nc_subset.close()
-    nc_subset_bytes = io.BytesIO(mem_view_subset)
-    filename = (
-            f'{state_name}_{top_lat}N_\
-            {bottom_lat}S_{right_lon}E_{left_lon}W.nc'
-    )
-    nc_subset_bytes.seek(io.SEEK_SET)
-    file_response = FileResponse(
-            nc_subset_bytes,
-            filename=filename,
-            as_attachment=True
+    sel_params = sorted(set(sel_params))
+    key = subset_cache.subset_key(
+        state_name, update, mtime_ns, 'points', sel_params, method, time_slice,
+        fmt, significant_digits, json.dumps(points, sort_keys=True)
     )
-    file_response['Content-Type'] = 'application/netcdf'
-    file_response['init_time'] = datetime.strptime(update, '%Y%m%d_%H')
-    return file_response
+    points_file = subset_cache.get(key)
+
+    if points_file is None:
+        points_path = subset_cache.new_temp_path()
+        try:
+            values, attrs = extract_points(nc_origin_path, index, points, sel_params, method, time_slice)
+            write_points(fmt, points_path, points, index, time_slice, values, attrs, significant_digits)
+            points_file = subset_cache.put(key, points_path)
+        finally:
+            subset_cache.remove(points_path)
+
+    filename = f'{state_name}_points_{update}.{FILE_EXTENSIONS[fmt]}'
+    return download_response(points_file, filename, fmt, update)
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from home.stats import refresh_home_stats
+
+
+class Command(BaseCommand):
+
+    help = 'Recompute cached landing page statistics'
+
+    def handle(self, *args, **options):
+        stats = refresh_home_stats()
+        print(f"{stats['obs_count']} records, {stats['period']}")
@@ -0,0 +1,51 @@
+'''
+Landing page statistics
+
+Record count and period are aggregated from station_summary, never from
+obs_data, and kept in the cache for at most HOME_STATS_MAX_AGE seconds.
+refresh_home_stats (management command) can be scheduled to recompute
+them ahead of expiry. Stations come from the reference registry.
+'''
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Min, Max, Sum
+
+from obs_data.models import station_summary
+from obs_data.registry import get_reference
+
+
+HOME_STATS_CACHE_KEY = 'home.stats'
+
+
+def change_to_str(_date):
+    return _date.strftime('%Y-%m-%d') if _date else 'N/A'
+
+
+def compute_home_stats():
+    period = station_summary.objects.aggregate(
+        Min('rec_start'), Max('rec_end'), Sum('rec_count')
+    )
+
+    return {
+        'obs_count': period['rec_count__sum'] or 0,
+        'period': f"{change_to_str(period['rec_start__min'])} to {change_to_str(period['rec_end__max'])}",
+    }
+
+
+def refresh_home_stats():
+    stats = compute_home_stats()
+    cache.set(HOME_STATS_CACHE_KEY, stats, settings.HOME_STATS_MAX_AGE)
+    return stats
+
+
+def get_home_stats():
+    stats = cache.get(HOME_STATS_CACHE_KEY)
+    if stats is None:
+        stats = refresh_home_stats()
+
+    reference = get_reference()
+    return {
+        **stats,
+        'stations': reference.station_points_json,
+        'num_stations': len(reference.stations),
+    }
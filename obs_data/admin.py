@@ -5,4 +5,5 @@ from .models import *
 admin.site.register(station)
 admin.site.register(obs_data)
 admin.site.register(parameter)
-admin.site.register(level)
\ No newline at end of file
+admin.site.register(level)
+admin.site.register(station_summary)
\ No newline at end of file
@@ -0,0 +1,210 @@
+'''
+Temporal aggregation and downsampling of observation series
+
+Records are rolled up by the database according to parameter_type
+    ACCM       : sum
+    MIN        : minimum
+    MAX        : maximum
+    INST / AVG : average
+missing records (-9999) are left out of every aggregate. Seasons are
+DJF, MAM, JJA and SON, december counts towards the following year's DJF.
+'''
+from datetime import timedelta, timezone
+
+import numpy as np
+from django.db.models import Avg, Count, Max, Min, Sum
+from django.db.models.functions import TruncDay, TruncMonth, TruncYear
+
+from obs_data.models import parameter, MISSING_VALUE
+
+
+DAY, MONTH, SEASON, YEAR = 'day', 'month', 'season', 'year'
+INTERVALS = (DAY, MONTH, SEASON, YEAR)
+
+# LTTB keeps the first and last point and one per bucket in between
+MIN_POINTS = 3
+
+AGGREGATES = {
+    parameter.INST: Avg,
+    parameter.ACCM: Sum,
+    parameter.MIN: Min,
+    parameter.MAX: Max,
+    parameter.AVG: Avg,
+}
+
+# seasons are built from months, interval -> (trunc, months per period)
+TRUNCATE = {
+    DAY: (TruncDay, None),
+    MONTH: (TruncMonth, 1),
+    SEASON: (TruncMonth, 3),
+    YEAR: (TruncYear, 12),
+}
+
+
+def aggregate_of(parameter_type):
+    # aggregate function of a parameter_type, average when unknown
+    return AGGREGATES.get(parameter_type, Avg)
+
+
+def add_months(date, months):
+    month = date.month - 1 + months
+    return date.replace(year=date.year + month // 12, month=month % 12 + 1)
+
+
+def season_start(date):
+    # dec -> dec, jan/feb -> previous dec, mar..may -> mar ...
+    return add_months(date.replace(day=1), -(date.month % 3))
+
+
+def period_end(start, interval):
+    if interval == DAY:
+        return start + timedelta(days=1)
+    return add_months(start, TRUNCATE[interval][1])
+
+
+def rollup(qs, parameter_type, interval, group_by=()):
+    '''
+    aggregate a filtered obs_data queryset into periods of interval
+    returns [{'start_time', 'end_time', 'value', 'count'}, ...] in time order
+
+    with group_by fields (e.g. 'station_id') every group is rolled up
+    separately in the same query and its fields are added to each row
+    '''
+    trunc, _ = TRUNCATE[interval]
+    agg = aggregate_of(parameter_type)
+
+    qs = qs.exclude(value=MISSING_VALUE).annotate(
+        period=trunc('start_time', tzinfo=timezone.utc)
+    ).values(*group_by, 'period').order_by(*group_by, 'period')
+
+    if interval != SEASON:
+        rows = qs.annotate(agg_value=agg('value'), count=Count('pk'))
+        return [
+            {
+                **{field: row[field] for field in group_by},
+                'start_time': row['period'],
+                'end_time': period_end(row['period'], interval),
+                'value': row['agg_value'],
+                'count': row['count'],
+            }
+            for row in rows
+        ]
+
+    # monthly rollup in the database, folded into seasons here
+    rows = qs.annotate(agg_value=agg('value'), total=Sum('value'), count=Count('pk'))
+    seasons = dict()
+    for row in rows:
+        group = tuple(row[field] for field in group_by)
+        start = season_start(row['period'])
+        season = seasons.setdefault((group, start), {'values': [], 'total': 0, 'count': 0})
+        season['values'].append(row['agg_value'])
+        season['total'] += row['total']
+        season['count'] += row['count']
+
+    series = []
+    for (group, start), season in sorted(seasons.items()):
+        if agg is Sum:
+            value = season['total']
+        elif agg is Min:
+            value = min(season['values'])
+        elif agg is Max:
+            value = max(season['values'])
+        else:
+            value = season['total'] / season['count']
+
+        series.append({
+            **dict(zip(group_by, group)),
+            'start_time': start,
+            'end_time': period_end(start, interval),
+            'value': value,
+            'count': season['count'],
+        })
+
+    return series
+
+
+def columnar(rows, series_keys, time_key):
+    '''
+    pack rows of many series into a shared, sorted time axis and one value
+    list per series, gaps and missing records are None
+
+    series_keys -> [(station_id, parameter_id), ...] in output order
+    rows        -> iterable of (station_id, parameter_id, time, value)
+    '''
+    values = {key: dict() for key in series_keys}
+    times = set()
+    for station_id, parameter_id, time, value in rows:
+        series = values.get((station_id, parameter_id), None)
+        if series is None:
+            continue
+        series[time] = None if value == MISSING_VALUE else value
+        times.add(time)
+
+    axis = sorted(times)
+    return {
+        time_key: axis,
+        'series': [
+            {
+                'station_id': station_id,
+                'param_id': parameter_id,
+                'values': [values[(station_id, parameter_id)].get(time, None) for time in axis],
+            }
+            for station_id, parameter_id in series_keys
+        ]
+    }
+
+
+def lttb(x, y, threshold):
+    '''
+    Largest-Triangle-Three-Buckets downsampling, threshold >= MIN_POINTS
+    returns indices of the points to keep
+    '''
+    if threshold < MIN_POINTS:
+        raise ValueError(f'threshold must be at least {MIN_POINTS}')
+
+    n = len(x)
+    if threshold >= n:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+
+    bucket = (n - 2) / (threshold - 2)
+    keep = np.empty(threshold, dtype=int)
+    keep[0], keep[-1] = 0, n - 1
+
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * bucket) + 1
+        end = int((i + 1) * bucket) + 1
+        next_end = min(int((i + 2) * bucket) + 1, n)
+
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+
+        area = np.abs(
+            (x[a] - avg_x) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (avg_y - y[a])
+        )
+        a = start + int(area.argmax())
+        keep[i + 1] = a
+
+    return keep
+
+
+def downsample(series, max_points, time_key='end_time'):
+    '''
+    at most max_points rows of series, a series within max_points is
+    returned as it is, missing records included
+    '''
+    if len(series) <= max_points:
+        return series
+
+    # missing records are dropped, they would otherwise be picked as extremes
+    series = [row for row in series if row['value'] is not None and row['value'] != MISSING_VALUE]
+    if len(series) <= max_points:
+        return series
+
+    x = [row[time_key].timestamp() for row in series]
+    y = [row['value'] for row in series]
+    return [series[i] for i in lttb(x, y, max_points)]
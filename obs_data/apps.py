@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class ObsDataConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'obs_data'
+
+    def ready(self):
+        # registry invalidation on reference table changes
+        from obs_data import signals
@@ -0,0 +1,175 @@
+'''
+Streaming export of observation records
+
+Records are read with a server-side cursor, chunk by chunk, and written
+to the response as they arrive, memory use does not depend on the size
+of the export. CSV is always available, Parquet and Arrow IPC stream
+need pyarrow.
+'''
+import csv
+
+from django.conf import settings
+
+from obs_data.models import obs_data
+from obs_data.registry import get_reference
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+
+CSV, PARQUET, ARROW = 'csv', 'parquet', 'arrow'
+FORMATS = (CSV, PARQUET, ARROW)
+
+CONTENT_TYPES = {
+    CSV: 'text/csv',
+    PARQUET: 'application/vnd.apache.parquet',
+    ARROW: 'application/vnd.apache.arrow.stream',
+}
+
+FILE_EXTENSIONS = {CSV: 'csv', PARQUET: 'parquet', ARROW: 'arrows'}
+
+COLUMNS = [
+    'station_id', 'station', 'parameter_id', 'parameter',
+    'level_id', 'start_time', 'end_time', 'value'
+]
+
+
+def available_formats():
+    return FORMATS if pa is not None else (CSV,)
+
+
+def iter_record_chunks(station_ids, param_ids, sdate, edate, chunk_size=None):
+    '''
+    yields lists of export rows (see COLUMNS), at most chunk_size rows each
+    '''
+    chunk_size = chunk_size or settings.OBS_EXPORT_CHUNK_SIZE
+
+    reference = get_reference()
+    station_names = {stn_id: stn['name'] for stn_id, stn in reference.stations.items()}
+    param_names = {param_id: param['name'] for param_id, param in reference.parameters.items()}
+
+    qs = obs_data.objects.filter(
+        station_id__in=station_ids,
+        parameter_id__in=param_ids,
+        start_time__gte=sdate,
+        end_time__lte=edate
+    ).order_by(
+        'station_id', 'parameter_id', 'start_time'
+    ).values_list(
+        'station_id', 'parameter_id', 'level_id', 'start_time', 'end_time', 'value'
+    ).iterator(chunk_size=chunk_size)
+
+    chunk = []
+    for station_id, parameter_id, level_id, start_time, end_time, value in qs:
+        chunk.append((
+            station_id, station_names.get(station_id), parameter_id, param_names.get(parameter_id),
+            level_id, start_time, end_time, value
+        ))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+class _Echo:
+    # file-like object handing back what is written, for csv.writer
+    def write(self, value):
+        return value
+
+
+def stream_csv(chunks):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(COLUMNS)
+    for chunk in chunks:
+        yield ''.join(
+            writer.writerow((
+                station_id, station_name, parameter_id, param_name, level_id,
+                start_time.strftime('%Y-%m-%d %H:%MZ'), end_time.strftime('%Y-%m-%d %H:%MZ'), value
+            ))
+            for station_id, station_name, parameter_id, param_name, level_id, start_time, end_time, value in chunk
+        )
+
+
+class _ChunkSink:
+    # write-only file object for pyarrow, collects bytes until taken
+    def __init__(self):
+        self.buffer = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.buffer.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b''.join(self.buffer)
+        self.buffer = []
+        return data
+
+
+def arrow_schema():
+    return pa.schema([
+        ('station_id', pa.int64()),
+        ('station', pa.string()),
+        ('parameter_id', pa.int64()),
+        ('parameter', pa.string()),
+        ('level_id', pa.int64()),
+        ('start_time', pa.timestamp('s', tz='UTC')),
+        ('end_time', pa.timestamp('s', tz='UTC')),
+        ('value', pa.float64()),
+    ])
+
+
+def to_record_batch(chunk, schema):
+    columns = list(zip(*chunk))
+    return pa.record_batch(
+        [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+        schema=schema
+    )
+
+
+def stream_arrow(chunks, fmt):
+    '''
+    parquet gets one row group per chunk, arrow one record batch per chunk,
+    bytes are handed out as soon as a chunk is written
+    '''
+    schema = arrow_schema()
+    sink = _ChunkSink()
+
+    if fmt == PARQUET:
+        writer = pq.ParquetWriter(sink, schema, compression='zstd')
+    else:
+        writer = pa.ipc.new_stream(sink, schema)
+
+    for chunk in chunks:
+        batch = to_record_batch(chunk, schema)
+        if fmt == PARQUET:
+            writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            writer.write_batch(batch)
+        yield sink.take()
+
+    writer.close()
+    yield sink.take()
+
+
+def stream_export(chunks, fmt):
+    if fmt == CSV:
+        return stream_csv(chunks)
+    return stream_arrow(chunks, fmt)
@@ -0,0 +1,440 @@
+'''
+Bulk ingest of observation records
+
+Records are read from the request as a stream, validated and converted in
+batches and written with PostgreSQL COPY through a staging table. Other
+database backends (sqlite during development) fall back to bulk_create.
+
+Conflict modes, for records already present in obs_data
+    error  : the whole ingest is rejected (default)
+    ignore : existing records are kept and the new ones are skipped
+    update : existing records get the new value
+'''
+import io
+import json
+import time
+from datetime import datetime as dt, timezone
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import connection, transaction, IntegrityError
+
+from obs_data.models import obs_data
+from obs_data.registry import get_reference
+from obs_data.summary import collect_deltas, apply_deltas
+
+
+OBS_TIME_FORMAT = '%Y-%m-%d %H:%MZ'
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+
+ON_CONFLICT_ERROR, ON_CONFLICT_IGNORE, ON_CONFLICT_UPDATE = 'error', 'ignore', 'update'
+ON_CONFLICT_MODES = (ON_CONFLICT_ERROR, ON_CONFLICT_IGNORE, ON_CONFLICT_UPDATE)
+
+# unique_together of obs_data
+CONFLICT_COLUMNS = 'start_time, end_time, parameter_id, level_id, station_id'
+
+# bulk inserts of a batch retried after a concurrent sender wrote some of its records
+WRITE_ATTEMPTS = 3
+
+
+class IngestError(Exception):
+
+    def __init__(self, error, message):
+        super().__init__(message)
+        self.error = error
+        self.message = message
+
+
+@lru_cache(maxsize=65536)
+def parse_obs_time(value):
+    # records of a batch share a handful of timestamps, parse each only once
+    return dt.strptime(value, OBS_TIME_FORMAT).replace(tzinfo=timezone.utc)
+
+
+def row_key(row):
+    # (start_time, end_time, parameter_id, level_id, station_id)
+    return row[0], row[1], row[3], row[4], row[5]
+
+
+class RecordChecker:
+
+    def __init__(self, reference):
+        self.stations = reference.stations
+        self.parameters = reference.parameters
+        self.levels = reference.levels
+
+    def check(self, rec):
+        '''
+        returns (row, msg), row is None when the record is not okay
+        row -> (start_time, end_time, value, parameter_id, level_id, station_id)
+        '''
+        msg = ''
+
+        if type(rec) != dict:
+            return None, 'data format is not okay :: '
+
+        fmt_ok = ( type(rec.get('station_id', None)) == int ) \
+                & ( type(rec.get('parameter_id', None)) == int ) \
+                & ( type(rec.get('level_id', None)) == int ) \
+                & ( type(rec.get('start_time', None)) == str ) \
+                & ( type(rec.get('end_time', None)) == str ) \
+                & ( type(rec.get('value', None)) in (int, float) )
+
+        start_time = end_time = None
+        try:
+            start_time = parse_obs_time(rec.get('start_time'))
+            end_time = parse_obs_time(rec.get('end_time'))
+            date_ok = start_time <= end_time
+        except (TypeError, ValueError):
+            date_ok = False
+
+        stn_ok = rec.get('station_id', None) in self.stations
+        param_ok = rec.get('parameter_id', None) in self.parameters
+        level_ok = rec.get('level_id', None) in self.levels
+
+        if not fmt_ok:
+            msg += "data format is not okay :: "
+
+        if not date_ok:
+            msg += "date format is not okay :: "
+
+        if not stn_ok:
+            msg += "station id does not exist :: "
+
+        if not param_ok:
+            msg += "parameter id does not exist :: "
+
+        if not level_ok:
+            msg += "level id does not exist :: "
+
+        if not (fmt_ok and date_ok and stn_ok and param_ok and level_ok):
+            return None, msg
+
+        row = (
+            start_time, end_time, rec['value'],
+            rec['parameter_id'], rec['level_id'], rec['station_id']
+        )
+        return row, msg
+
+
+class BatchResult:
+
+    def __init__(self):
+        # rows written as new records
+        self.inserted = []
+        # (row, old value) of existing records which got a new value
+        self.updated = []
+        # (index, reason) of records which were not written
+        self.skipped = []
+
+
+class OrmWriter:
+
+    def __init__(self, batch_size, on_conflict):
+        self.batch_size = batch_size
+        self.on_conflict = on_conflict
+
+    def existing(self, batch):
+        # existing records of the batch, key -> (id, value)
+        starts = [row[0] for _, row in batch]
+        qs = obs_data.objects.filter(
+            station_id__in={row[5] for _, row in batch},
+            parameter_id__in={row[3] for _, row in batch},
+            start_time__gte=min(starts),
+            start_time__lte=max(starts)
+        ).values_list(
+            'start_time', 'end_time', 'parameter_id', 'level_id', 'station_id', 'id', 'value'
+        )
+        return {rec[:5]: rec[5:] for rec in qs}
+
+    def write(self, batch):
+        '''
+        only records actually written count as inserted: the batch is
+        inserted in a savepoint without ignoring conflicts and split again
+        when a concurrent sender wrote some of its records meanwhile
+        '''
+        for attempt in range(WRITE_ATTEMPTS):
+            result, new_rows, old_objs = self.split(batch)
+            try:
+                with transaction.atomic():
+                    self.insert(new_rows)
+                break
+            except IntegrityError:
+                if self.on_conflict == ON_CONFLICT_ERROR or attempt == WRITE_ATTEMPTS - 1:
+                    raise
+
+        if old_objs:
+            obs_data.objects.bulk_update(old_objs, ['value', 'duration'], batch_size=self.batch_size)
+
+        return result
+
+    def split(self, batch):
+        # (result, rows to insert, records to update) of the batch
+        result = BatchResult()
+
+        found = self.existing(batch) if self.on_conflict != ON_CONFLICT_ERROR else {}
+
+        new_rows, old_objs = [], []
+        for i, row in batch:
+            key = row_key(row)
+            if key not in found:
+                new_rows.append(row)
+            elif self.on_conflict == ON_CONFLICT_UPDATE:
+                pk, old_value = found[key]
+                old_objs.append(obs_data(id=pk, value=row[2], duration=row[1] - row[0]))
+                result.updated.append((row, old_value))
+            else:
+                result.skipped.append((i, 'record already exists'))
+
+        result.inserted = new_rows
+        return result, new_rows, old_objs
+
+    def insert(self, new_rows):
+        obs_data.objects.bulk_create(
+            [
+                obs_data(
+                    start_time=start_time,
+                    end_time=end_time,
+                    duration=end_time - start_time,
+                    value=value,
+                    parameter_id=parameter_id,
+                    level_id=level_id,
+                    station_id=station_id
+                )
+                for start_time, end_time, value, parameter_id, level_id, station_id in new_rows
+            ],
+            batch_size=self.batch_size
+        )
+
+
+class CopyWriter:
+
+    staging_table = 'obs_data_ingest_staging'
+    columns = 'start_time, end_time, value, parameter_id, level_id, station_id'
+
+    def __init__(self, cursor, on_conflict):
+        self.cursor = cursor
+        self.on_conflict = on_conflict
+        # staging table lives as long as the ingest transaction, ingests
+        # nested in one outer transaction share it, it is emptied after
+        # every batch
+        self.cursor.execute(
+            f'CREATE TEMP TABLE IF NOT EXISTS {self.staging_table} ('
+            'idx bigint, '
+            'start_time timestamp with time zone, '
+            'end_time timestamp with time zone, '
+            'value double precision, '
+            'parameter_id bigint, '
+            'level_id bigint, '
+            'station_id bigint'
+            ') ON COMMIT DROP'
+        )
+
+    def existing(self):
+        # existing records of the staged batch, idx -> value, locked until
+        # the commit so their old values stay the ones updated
+        self.cursor.execute(
+            f'SELECT s.idx, o.value FROM {self.staging_table} s '
+            f'JOIN {obs_data._meta.db_table} o USING ({CONFLICT_COLUMNS})'
+            + (' FOR UPDATE OF o' if self.on_conflict == ON_CONFLICT_UPDATE else '')
+        )
+        return dict(self.cursor.fetchall())
+
+    def write(self, batch):
+        result = BatchResult()
+
+        buf = io.StringIO()
+        for i, (start_time, end_time, value, parameter_id, level_id, station_id) in batch:
+            buf.write(
+                f'{i}\t{start_time.isoformat()}\t{end_time.isoformat()}\t{value!r}\t'
+                f'{parameter_id}\t{level_id}\t{station_id}\n'
+            )
+        buf.seek(io.SEEK_SET)
+
+        self.cursor.copy_expert(
+            f'COPY {self.staging_table} (idx, {self.columns}) FROM STDIN', buf
+        )
+
+        found = self.existing() if self.on_conflict != ON_CONFLICT_ERROR else {}
+
+        # records written by a concurrent sender after existing() are
+        # skipped too, RETURNING gives the records actually inserted
+        on_conflict = ''
+        if self.on_conflict != ON_CONFLICT_ERROR:
+            on_conflict = f' ON CONFLICT ({CONFLICT_COLUMNS}) DO NOTHING'
+
+        self.cursor.execute(
+            f'WITH written AS ('
+            f'INSERT INTO {obs_data._meta.db_table} '
+            f'(duration, {self.columns}) '
+            f'SELECT end_time - start_time, {self.columns} '
+            f'FROM {self.staging_table}{on_conflict} '
+            f'RETURNING {CONFLICT_COLUMNS}'
+            f') SELECT s.idx FROM written JOIN {self.staging_table} s USING ({CONFLICT_COLUMNS})'
+        )
+        inserted = {idx for idx, in self.cursor.fetchall()}
+
+        if self.on_conflict == ON_CONFLICT_UPDATE:
+            # records a concurrent sender wrote after existing() are updated too
+            missed = {i for i, _ in batch} - inserted - found.keys()
+            if missed:
+                found.update((idx, value) for idx, value in self.existing().items() if idx in missed)
+
+        if self.on_conflict == ON_CONFLICT_UPDATE and found:
+            match = ' AND '.join(f'o.{col} = s.{col}' for col in CONFLICT_COLUMNS.split(', '))
+            self.cursor.execute(
+                f'UPDATE {obs_data._meta.db_table} o '
+                'SET value = s.value, duration = s.end_time - s.start_time '
+                f'FROM {self.staging_table} s WHERE {match} AND s.idx = ANY(%s)',
+                [list(found)]
+            )
+        self.cursor.execute(f'TRUNCATE {self.staging_table}')
+
+        for i, row in batch:
+            if i in inserted:
+                result.inserted.append(row)
+            elif i in found and self.on_conflict == ON_CONFLICT_UPDATE:
+                result.updated.append((row, found[i]))
+            else:
+                result.skipped.append((i, 'record already exists'))
+
+        return result
+
+
+def drop_duplicates(batch, on_conflict):
+    '''
+    a record may appear only once in a batch for ON CONFLICT to work,
+    update keeps the last copy of a record and ignore keeps the first
+    '''
+    keep, skipped = dict(), []
+    for i, row in batch:
+        key = row_key(row)
+        if key in keep:
+            if on_conflict == ON_CONFLICT_UPDATE:
+                skipped.append((keep[key][0], 'duplicate record in request'))
+                keep[key] = (i, row)
+            else:
+                skipped.append((i, 'duplicate record in request'))
+        else:
+            keep[key] = (i, row)
+
+    return list(keep.values()), skipped
+
+
+def iter_request_records(request):
+    '''
+    yields records from the request,
+    ndjson bodies are read line by line instead of being loaded at once
+    '''
+    if request.content_type == NDJSON_CONTENT_TYPE:
+        return _iter_ndjson(request)
+
+    if request.content_type != 'application/json':
+        raise IngestError('invalid request', 'unsupported content type')
+
+    try:
+        req_payload = request.body.decode('utf-8')
+    except Exception:
+        raise IngestError('Max data size limit', 'Request data size is more than 2.5 mb')
+
+    try:
+        req_payload = json.loads(req_payload)
+    except ValueError:
+        raise IngestError('invalid request', 'unperseable json data')
+
+    req_data = req_payload.get('data', None) if type(req_payload) == dict else None
+
+    if req_data == None or type(req_data) != list or len(req_data) == 0:
+        raise IngestError('invalid json format', 'data is not provided or formatted properly')
+
+    return iter(req_data)
+
+
+def _iter_ndjson(stream):
+    for i, line in enumerate(stream):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            raise IngestError('invalid request', f'unperseable json data in line {i}')
+
+
+def get_on_conflict(request):
+    on_conflict = request.GET.get('on_conflict', ON_CONFLICT_ERROR)
+    if on_conflict not in ON_CONFLICT_MODES:
+        raise IngestError(
+            'invalid request',
+            f'on_conflict must be one of {", ".join(ON_CONFLICT_MODES)}'
+        )
+    return on_conflict
+
+
+def ingest_records(records, on_conflict=ON_CONFLICT_ERROR, batch_size=None):
+    '''
+    validate and write records batch by batch inside one transaction
+
+    in error mode the first invalid record rolls back the whole ingest,
+    otherwise invalid and conflicting records are reported by index
+    '''
+    batch_size = batch_size or settings.OBS_INGEST_BATCH_SIZE
+    tic = time.perf_counter()
+
+    checker = RecordChecker(get_reference())
+
+    total, inserted, updated, rejected = 0, 0, 0, []
+
+    with transaction.atomic(), connection.cursor() as cursor:
+
+        if connection.vendor == 'postgresql':
+            writer = CopyWriter(cursor, on_conflict)
+        else:
+            writer = OrmWriter(batch_size, on_conflict)
+
+        def flush(batch):
+            nonlocal inserted, updated
+            skipped = []
+            if on_conflict != ON_CONFLICT_ERROR:
+                batch, skipped = drop_duplicates(batch, on_conflict)
+
+            result = writer.write(batch)
+            apply_deltas(collect_deltas(result.inserted, result.updated))
+            inserted += len(result.inserted)
+            updated += len(result.updated)
+            rejected.extend(
+                {'index': i, 'reason': reason} for i, reason in skipped + result.skipped
+            )
+
+        batch = []
+        for i, rec in enumerate(records):
+            total += 1
+            row, msg = checker.check(rec)
+            if row is None:
+                if on_conflict == ON_CONFLICT_ERROR:
+                    raise IngestError('invalid data', f'error in data in record {i}, {msg}')
+                rejected.append({'index': i, 'reason': msg})
+                continue
+
+            batch.append((i, row))
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = []
+
+        if batch:
+            flush(batch)
+
+        if total == 0:
+            raise IngestError('invalid json format', 'data is not provided or formatted properly')
+
+    elapsed = time.perf_counter() - tic
+
+    return {
+        'rows': total,
+        'inserted': inserted,
+        'updated': updated,
+        'skipped': len(rejected),
+        'rejected': sorted(rejected, key=lambda r: r['index']),
+        'elapsed': round(elapsed, 3),
+        'rows_per_sec': round(total / elapsed) if elapsed > 0 else total,
+    }
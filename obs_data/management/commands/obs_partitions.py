@@ -0,0 +1,58 @@
+from django.db import connection, transaction
+from django.core.management.base import BaseCommand, CommandError
+
+from obs_data.partitions import (
+    is_partitioned, list_partitions, create_partition, create_partitions_ahead,
+    attach_partition, detach_partition, partition_name
+)
+
+
+class Command(BaseCommand):
+
+    help = 'Manage yearly partitions of obs_data (postgresql only)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'action', type=str, choices=['list', 'create', 'attach', 'detach'],
+            help="list partitions, create future ones or attach/detach a year"
+        )
+        parser.add_argument('--year', type=int, help="year of the partition to create/attach/detach")
+        parser.add_argument(
+            '--years-ahead', type=int, default=1,
+            help="with create and no --year, create partitions up to this many years ahead"
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('obs_data partitions require postgresql')
+
+        action, year = options['action'], options['year']
+
+        if action in ('attach', 'detach') and year is None:
+            raise CommandError(f'{action} requires --year')
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            if not is_partitioned(cursor):
+                raise CommandError('obs_data is not partitioned, run migrate first')
+
+            if action == 'list':
+                for name, bound in list_partitions(cursor):
+                    print(f'{name}: {bound}')
+
+            elif action == 'create' and year is not None:
+                if create_partition(cursor, year):
+                    print(f'created {partition_name(year)}')
+                else:
+                    print(f'{partition_name(year)} already exists')
+
+            elif action == 'create':
+                for name in create_partitions_ahead(cursor, options['years_ahead']):
+                    print(f'created {name}')
+
+            elif action == 'attach':
+                attach_partition(cursor, year)
+                print(f'attached {partition_name(year)}')
+
+            else:
+                detach_partition(cursor, year)
+                print(f'detached {partition_name(year)}')
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from obs_data.summary import rebuild_station_summary
+
+
+class Command(BaseCommand):
+
+    help = 'Rebuild station_summary from obs_data'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--station', type=int, nargs='+', dest='stations',
+            help="rebuild only these station ids (default: all stations)"
+        )
+
+    def handle(self, *args, **options):
+        count = rebuild_station_summary(options['stations'])
+        print(f'{count} summary rows written')
@@ -0,0 +1,59 @@
+# Generated by Django 3.2.5 on 2026-10-18 12:55
+
+from django.db import migrations, models
+from django.db.models import Min, Max, Count, Q
+import django.db.models.deletion
+
+
+def build_station_summary(apps, schema_editor):
+    obs_data = apps.get_model('obs_data', 'obs_data')
+    station_summary = apps.get_model('obs_data', 'station_summary')
+
+    rows = obs_data.objects.values('station_id', 'parameter_id').annotate(
+        Min('start_time'),
+        Max('end_time'),
+        Count('pk'),
+        missing=Count('pk', filter=Q(value=-9999))
+    ).order_by()
+
+    station_summary.objects.bulk_create(
+        [
+            station_summary(
+                station_id=row['station_id'],
+                parameter_id=row['parameter_id'],
+                rec_start=row['start_time__min'],
+                rec_end=row['end_time__max'],
+                rec_count=row['pk__count'],
+                missing_count=row['missing']
+            )
+            for row in rows
+        ],
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('obs_data', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='station_summary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rec_start', models.DateTimeField(default=None, null=True, verbose_name='first observation start time')),
+                ('rec_end', models.DateTimeField(default=None, null=True, verbose_name='last observation end time')),
+                ('rec_count', models.BigIntegerField(default=0, verbose_name='number of records')),
+                ('missing_count', models.BigIntegerField(default=0, verbose_name='number of missing records')),
+                ('parameter', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='obs_data.parameter')),
+                ('station', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='obs_data.station')),
+            ],
+            options={
+                'verbose_name_plural': 'station_summary',
+                'unique_together': {('station', 'parameter')},
+            },
+        ),
+        migrations.RunPython(build_station_summary, migrations.RunPython.noop),
+    ]
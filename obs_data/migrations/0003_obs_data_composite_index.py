@@ -0,0 +1,48 @@
+# Generated by Django 3.2.5 on 2026-10-18 12:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('obs_data', '0002_station_summary'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='obs_data',
+            name='obs_data_ob_start_t_c7835f_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='obs_data',
+            name='obs_data_ob_end_tim_ad4c60_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='obs_data',
+            name='obs_data_ob_paramet_c670d0_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='obs_data',
+            name='obs_data_ob_level_i_bf026c_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='obs_data',
+            name='obs_data_ob_station_0924f9_idx',
+        ),
+        migrations.AlterField(
+            model_name='obs_data',
+            name='parameter',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='obs_data.parameter'),
+        ),
+        migrations.AlterField(
+            model_name='obs_data',
+            name='station',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='obs_data.station'),
+        ),
+        migrations.AddIndex(
+            model_name='obs_data',
+            index=models.Index(fields=['station', 'parameter', 'start_time'], include=('end_time', 'value'), name='obs_data_stn_par_start_idx'),
+        ),
+    ]
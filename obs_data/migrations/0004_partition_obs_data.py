@@ -0,0 +1,25 @@
+# Generated by Django 3.2.5 on 2026-10-18 13:05
+
+from django.db import migrations
+
+
+def partition_obs_data(apps, schema_editor):
+    # partitioning is postgresql only, other backends keep the plain table
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    from obs_data.partitions import partition_table
+
+    with schema_editor.connection.cursor() as cursor:
+        partition_table(cursor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('obs_data', '0003_obs_data_composite_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_obs_data, migrations.RunPython.noop),
+    ]
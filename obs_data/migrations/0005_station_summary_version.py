@@ -0,0 +1,24 @@
+# Generated by Django 3.2.5 on 2026-10-18 13:02
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('obs_data', '0004_partition_obs_data'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='station_summary',
+            name='updated_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='last data change'),
+        ),
+        migrations.AddField(
+            model_name='station_summary',
+            name='version',
+            field=models.BigIntegerField(default=0, verbose_name='data version'),
+        ),
+    ]
@@ -1,8 +1,12 @@
 from django.db import models
+from django.utils import timezone
 from datetime import timedelta
 
 # Create your models here.
 
+# value stored for missing observations
+MISSING_VALUE = -9999
+
 
 class parameter(models.Model):
 
@@ -97,9 +101,10 @@ class obs_data(models.Model):
 
     value = models.FloatField('value of data')
 
-    parameter = models.ForeignKey(parameter, on_delete=models.CASCADE)
+    # station and parameter lookups are served by the composite index
+    parameter = models.ForeignKey(parameter, on_delete=models.CASCADE, db_index=False)
     level = models.ForeignKey(level, default=1, on_delete=models.CASCADE)
-    station = models.ForeignKey(station, on_delete=models.CASCADE)
+    station = models.ForeignKey(station, on_delete=models.CASCADE, db_index=False)
     duration = models.DurationField(default=timedelta(seconds=86400))
 
     # calculate time delta of a record
@@ -113,12 +118,16 @@ class obs_data(models.Model):
         verbose_name_plural = "observation_data"
         # to prevent multiple insert
         unique_together = ('start_time', 'end_time', 'parameter', 'level', 'station')
+        # on postgresql the table is partitioned by year of start_time and
+        # the primary key is (id, start_time), see obs_data.partitions
         indexes = [
-            models.Index(fields=['start_time']),
-            models.Index(fields=['end_time']),
-            models.Index(fields=['parameter']),
-            models.Index(fields=['level']),
-            models.Index(fields=['station']),
+            # serves station + parameter + time range queries (GetObs),
+            # covering so the heap is not visited on postgresql
+            models.Index(
+                fields=['station', 'parameter', 'start_time'],
+                include=['end_time', 'value'],
+                name='obs_data_stn_par_start_idx'
+            ),
         ]
 
     def save(self, *args, **kwargs):
@@ -126,3 +135,26 @@ class obs_data(models.Model):
             self.duration = self.delt
         
         super(obs_data, self).save(*args, **kwargs)
+
+
+class station_summary(models.Model):
+
+    # maintained by the insert paths, see obs_data.summary
+    station = models.ForeignKey(station, on_delete=models.CASCADE)
+    parameter = models.ForeignKey(parameter, on_delete=models.CASCADE)
+
+    rec_start = models.DateTimeField('first observation start time', null=True, default=None)
+    rec_end = models.DateTimeField('last observation end time', null=True, default=None)
+    rec_count = models.BigIntegerField('number of records', default=0)
+    missing_count = models.BigIntegerField('number of missing records', default=0)
+
+    # bumped on every insert or update of the records, see obs_data.versions
+    version = models.BigIntegerField('data version', default=0)
+    updated_at = models.DateTimeField('last data change', default=timezone.now)
+
+    def __str__(self):
+        return f'{self.station.name} - {self.parameter.name} - {self.rec_count}'
+
+    class Meta:
+        verbose_name_plural = "station_summary"
+        unique_together = ('station', 'parameter')
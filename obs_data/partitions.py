@@ -0,0 +1,192 @@
+'''
+Yearly range partitions of obs_data on postgresql
+
+obs_data_obs_data is partitioned by start_time, one partition per year
+named obs_data_obs_data_y<year>, plus a default partition which catches
+records outside of every yearly partition. Primary key is (id, start_time)
+as postgresql requires the partition key in every unique constraint;
+the ORM still addresses records by id alone.
+
+id is therefore not enforced unique by the database, it stays unique as
+long as ids come from the table's sequence only, never set them by hand.
+The constraints and indexes keep the names Django gave them, so later
+migrations find them, but a migration changing the primary key of
+obs_data needs hand written SQL on postgresql.
+
+Other database backends keep a plain table (sqlite during development).
+'''
+from django.utils import timezone
+
+from obs_data.models import obs_data
+
+
+TABLE = obs_data._meta.db_table
+DEFAULT_PARTITION = f'{TABLE}_default'
+SEQUENCE = f'{TABLE}_id_part_seq'
+COLUMNS = 'id, start_time, end_time, value, duration, level_id, parameter_id, station_id'
+
+
+def partition_name(year):
+    return f'{TABLE}_y{year}'
+
+
+def year_bounds(year):
+    return f'{year}-01-01 00:00:00+00', f'{year + 1}-01-01 00:00:00+00'
+
+
+def table_exists(cursor, name):
+    cursor.execute('SELECT to_regclass(%s)', [name])
+    return cursor.fetchone()[0] is not None
+
+
+def is_partitioned(cursor):
+    cursor.execute(
+        'SELECT count(*) FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)',
+        [TABLE]
+    )
+    return cursor.fetchone()[0] > 0
+
+
+def list_partitions(cursor):
+    # [(name, bound), ...] of attached partitions
+    cursor.execute(
+        'SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) '
+        'FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+        'WHERE i.inhparent = to_regclass(%s) ORDER BY c.relname',
+        [TABLE]
+    )
+    return cursor.fetchall()
+
+
+def constraint_names(cursor):
+    '''
+    names of the constraints and plain indexes of obs_data,
+    'pkey', 'uniq' and the column of every foreign key and single
+    column index -> name
+    '''
+    names = dict()
+    for name, info in cursor.db.introspection.get_constraints(cursor, TABLE).items():
+        if info['primary_key']:
+            names['pkey'] = name
+        elif info['unique']:
+            names['uniq'] = name
+        elif info['foreign_key']:
+            names[('fk', info['columns'][0])] = name
+        elif info['index'] and len(info['columns']) == 1:
+            names[('index', info['columns'][0])] = name
+    return names
+
+
+def partition_table(cursor):
+    '''
+    convert the plain obs_data table into a partitioned one,
+    existing records are copied into yearly partitions
+    '''
+    if is_partitioned(cursor):
+        return
+
+    new_table = f'{TABLE}_partitioned'
+    names = constraint_names(cursor)
+
+    cursor.execute(f'CREATE SEQUENCE {SEQUENCE}')
+    cursor.execute(
+        f'CREATE TABLE {new_table} ('
+        f"id bigint NOT NULL DEFAULT nextval('{SEQUENCE}'), "
+        'start_time timestamp with time zone NOT NULL, '
+        'end_time timestamp with time zone NOT NULL, '
+        'value double precision NOT NULL, '
+        'duration interval NOT NULL, '
+        # foreign key names are per table, the old ones are taken right away
+        f"level_id bigint NOT NULL CONSTRAINT {names[('fk', 'level_id')]} "
+        'REFERENCES obs_data_level (id) DEFERRABLE INITIALLY DEFERRED, '
+        f"parameter_id bigint NOT NULL CONSTRAINT {names[('fk', 'parameter_id')]} "
+        'REFERENCES obs_data_parameter (id) DEFERRABLE INITIALLY DEFERRED, '
+        f"station_id bigint NOT NULL CONSTRAINT {names[('fk', 'station_id')]} "
+        'REFERENCES obs_data_station (id) DEFERRABLE INITIALLY DEFERRED, '
+        f'CONSTRAINT {new_table}_pkey PRIMARY KEY (id, start_time), '
+        f'CONSTRAINT {new_table}_uniq UNIQUE (start_time, end_time, parameter_id, level_id, station_id)'
+        ') PARTITION BY RANGE (start_time)'
+    )
+    cursor.execute(f'ALTER SEQUENCE {SEQUENCE} OWNED BY {new_table}.id')
+    cursor.execute(f'CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {new_table} DEFAULT')
+
+    cursor.execute(
+        f"SELECT DISTINCT extract(year FROM start_time AT TIME ZONE 'UTC')::int FROM {TABLE}"
+    )
+    for (year,) in cursor.fetchall():
+        lower, upper = year_bounds(year)
+        cursor.execute(
+            f'CREATE TABLE {partition_name(year)} PARTITION OF {new_table} '
+            'FOR VALUES FROM (%s) TO (%s)',
+            [lower, upper]
+        )
+
+    cursor.execute(f'INSERT INTO {new_table} ({COLUMNS}) SELECT {COLUMNS} FROM {TABLE}')
+    # run the deferred fk checks now, pending ones block index creation
+    cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+    cursor.execute(
+        f"SELECT setval('{SEQUENCE}', coalesce((SELECT max(id) FROM {new_table}), 0) + 1, false)"
+    )
+
+    # swap tables, then take over the names of the old constraints
+    cursor.execute(f'DROP TABLE {TABLE}')
+    cursor.execute(f'ALTER TABLE {new_table} RENAME TO {TABLE}')
+    cursor.execute(f"ALTER TABLE {TABLE} RENAME CONSTRAINT {new_table}_pkey TO {names['pkey']}")
+    cursor.execute(f"ALTER TABLE {TABLE} RENAME CONSTRAINT {new_table}_uniq TO {names['uniq']}")
+
+    # indexes declared by the model (obs_data.Meta.indexes) and the level fk,
+    # built after the copy and propagated to every partition
+    cursor.execute(
+        f'CREATE INDEX obs_data_stn_par_start_idx ON {TABLE} '
+        '(station_id, parameter_id, start_time) INCLUDE (end_time, value)'
+    )
+    cursor.execute(f"CREATE INDEX {names[('index', 'level_id')]} ON {TABLE} (level_id)")
+
+
+def create_partition(cursor, year):
+    '''
+    create and attach the partition of a year, records of that year
+    which landed in the default partition are moved into it
+    returns False if the partition already exists
+    '''
+    name = partition_name(year)
+    if table_exists(cursor, name):
+        return False
+
+    lower, upper = year_bounds(year)
+    cursor.execute(f'CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS)')
+    cursor.execute(
+        f'WITH moved AS ('
+        f'DELETE FROM {DEFAULT_PARTITION} WHERE start_time >= %s AND start_time < %s '
+        f'RETURNING {COLUMNS}'
+        f') INSERT INTO {name} ({COLUMNS}) SELECT {COLUMNS} FROM moved',
+        [lower, upper]
+    )
+    cursor.execute(
+        f'ALTER TABLE {TABLE} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)',
+        [lower, upper]
+    )
+    return True
+
+
+def create_partitions_ahead(cursor, years_ahead):
+    # partitions from the current year up to years_ahead, returns created names
+    this_year = timezone.now().year
+    return [
+        partition_name(year)
+        for year in range(this_year, this_year + years_ahead + 1)
+        if create_partition(cursor, year)
+    ]
+
+
+def attach_partition(cursor, year):
+    lower, upper = year_bounds(year)
+    cursor.execute(
+        f'ALTER TABLE {TABLE} ATTACH PARTITION {partition_name(year)} FOR VALUES FROM (%s) TO (%s)',
+        [lower, upper]
+    )
+
+
+def detach_partition(cursor, year):
+    # the detached table is kept, its records are no longer visible in obs_data
+    cursor.execute(f'ALTER TABLE {TABLE} DETACH PARTITION {partition_name(year)}')
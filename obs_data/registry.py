@@ -0,0 +1,52 @@
+'''
+Process-wide registry of the reference tables station, parameter and level
+
+Built once per worker and rebuilt after any of the tables changes,
+signals in obs_data.signals invalidate it on save and delete once the
+transaction commits. bulk_create and queryset update() send no such
+signal, code writing the tables that way has to call
+transaction.on_commit(registry.invalidate) itself.
+'''
+import json
+
+from obs_data.models import station, parameter, level
+from sricdms.versioned_cache import VersionedCache
+
+
+class Reference:
+
+    def __init__(self):
+        self.stations = {
+            row['id']: row for row in station.objects.all().values(
+                'id', 'name', 'full_name', 'station_id', 'wmo_id', 'lat', 'lon',
+                'elevation', 'station_category', 'station_type'
+            ).order_by('id')
+        }
+        self.parameters = {
+            row['id']: row for row in parameter.objects.all().values(
+                'id', 'name', 'full_name', 'unit', 'parameter_type'
+            ).order_by('id')
+        }
+        self.levels = {
+            row['id']: row for row in level.objects.all().values(
+                'id', 'name', 'full_name'
+            ).order_by('id')
+        }
+
+        # station locations for the maps, serialized once
+        self.station_points_json = json.dumps([
+            {'name': stn['name'], 'lat': stn['lat'], 'lon': stn['lon']}
+            for stn in self.stations.values()
+        ])
+
+
+registry = VersionedCache('obs_data.reference', Reference)
+
+
+def get_reference():
+    return registry.get()
+
+
+def reference_version():
+    registry.get()
+    return registry.version
@@ -0,0 +1,17 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from obs_data.models import station, parameter, level
+from obs_data.registry import registry
+
+
+@receiver(post_save, sender=station)
+@receiver(post_save, sender=parameter)
+@receiver(post_save, sender=level)
+@receiver(post_delete, sender=station)
+@receiver(post_delete, sender=parameter)
+@receiver(post_delete, sender=level)
+def invalidate_reference(sender, **kwargs):
+    # after the commit, a worker rebuilding earlier would keep the old rows
+    transaction.on_commit(registry.invalidate)
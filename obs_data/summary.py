@@ -0,0 +1,130 @@
+'''
+Per station and parameter summary of obs_data
+
+station_summary is updated by the ingest engine within the insert
+transaction, so StationMeta and GetParameters never scan obs_data.
+rebuild_station_summary (management command) recomputes it from scratch,
+needed after records are deleted or edited outside the insert endpoints.
+'''
+from django.db import transaction
+from django.utils import timezone
+from django.db.models import Min, Max, Count, Q
+
+from obs_data.models import obs_data, station_summary, MISSING_VALUE
+
+
+class SummaryDelta:
+
+    def __init__(self):
+        self.rec_start = None
+        self.rec_end = None
+        self.rec_count = 0
+        self.missing_count = 0
+
+
+def collect_deltas(inserted, updated):
+    '''
+    inserted -> rows written as new records
+    updated  -> (row, old value) of records which got a new value
+    returns (station_id, parameter_id) -> SummaryDelta
+    '''
+    deltas = dict()
+
+    for start_time, end_time, value, parameter_id, _, station_id in inserted:
+        delta = deltas.setdefault((station_id, parameter_id), SummaryDelta())
+        delta.rec_count += 1
+        delta.missing_count += value == MISSING_VALUE
+        if delta.rec_start is None or start_time < delta.rec_start:
+            delta.rec_start = start_time
+        if delta.rec_end is None or end_time > delta.rec_end:
+            delta.rec_end = end_time
+
+    # updated records change no period or count, but bump the data version
+    for (_, _, value, parameter_id, _, station_id), old_value in updated:
+        delta = deltas.setdefault((station_id, parameter_id), SummaryDelta())
+        delta.missing_count += (value == MISSING_VALUE) - (old_value == MISSING_VALUE)
+
+    return deltas
+
+
+def apply_deltas(deltas):
+    if not deltas:
+        return
+
+    # rows are created and locked in key order, concurrent ingests over
+    # overlapping stations wait for each other instead of deadlocking
+    keys = sorted(deltas)
+
+    with transaction.atomic():
+        # make sure a row exists for every key, then lock exactly those
+        station_summary.objects.bulk_create(
+            [
+                station_summary(station_id=station_id, parameter_id=parameter_id)
+                for station_id, parameter_id in keys
+            ],
+            ignore_conflicts=True
+        )
+
+        match = Q()
+        for station_id, parameter_id in keys:
+            match |= Q(station_id=station_id, parameter_id=parameter_id)
+        summaries = station_summary.objects.select_for_update().filter(match).order_by('station_id', 'parameter_id')
+
+        now = timezone.now()
+        changed = []
+        for summary in summaries:
+            delta = deltas[(summary.station_id, summary.parameter_id)]
+
+            summary.rec_count += delta.rec_count
+            summary.missing_count += delta.missing_count
+            if delta.rec_start and (summary.rec_start is None or delta.rec_start < summary.rec_start):
+                summary.rec_start = delta.rec_start
+            if delta.rec_end and (summary.rec_end is None or delta.rec_end > summary.rec_end):
+                summary.rec_end = delta.rec_end
+            summary.version += 1
+            summary.updated_at = now
+            changed.append(summary)
+
+        station_summary.objects.bulk_update(
+            changed, ['rec_start', 'rec_end', 'rec_count', 'missing_count', 'version', 'updated_at']
+        )
+
+
+def rebuild_station_summary(station_ids=None):
+    '''
+    recompute summary from obs_data, for all or the given stations
+    returns number of summary rows written
+    '''
+    qs = obs_data.objects.all()
+    if station_ids:
+        qs = qs.filter(station_id__in=station_ids)
+
+    rows = qs.values('station_id', 'parameter_id').annotate(
+        Min('start_time'),
+        Max('end_time'),
+        Count('pk'),
+        missing=Count('pk', filter=Q(value=MISSING_VALUE))
+    ).order_by()
+
+    with transaction.atomic():
+        old = station_summary.objects.all()
+        if station_ids:
+            old = old.filter(station_id__in=station_ids)
+        old.delete()
+
+        created = station_summary.objects.bulk_create(
+            [
+                station_summary(
+                    station_id=row['station_id'],
+                    parameter_id=row['parameter_id'],
+                    rec_start=row['start_time__min'],
+                    rec_end=row['end_time__max'],
+                    rec_count=row['pk__count'],
+                    missing_count=row['missing']
+                )
+                for row in rows
+            ],
+            batch_size=1000
+        )
+
+    return len(created)
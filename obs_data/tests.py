@@ -1,3 +1,403 @@
-from django.test import TestCase
+from datetime import datetime, timedelta, timezone
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import numpy as np
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.db import connection, IntegrityError
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from obs_data import partitions
+from obs_data.aggregation import downsample, lttb
+from obs_data.ingest import CopyWriter, OrmWriter, ingest_records, ON_CONFLICT_ERROR, ON_CONFLICT_IGNORE, ON_CONFLICT_UPDATE
+from obs_data.models import obs_data, station, parameter, level, station_summary, MISSING_VALUE
+from obs_data.registry import Reference, registry, get_reference, reference_version
+from obs_data.summary import SummaryDelta, apply_deltas, rebuild_station_summary
+from sricdms.versioned_cache import VersionedCache
+
+
+LOCAL_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def series(values):
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    return [
+        {'end_time': start + timedelta(hours=i), 'value': value}
+        for i, value in enumerate(values)
+    ]
+
+
+class DownsampleTests(SimpleTestCase):
+
+    def test_short_series_untouched(self):
+        # gaps stay in the chart when nothing has to be dropped
+        rows = series([1.0, None, 3.0, MISSING_VALUE, 5.0])
+        self.assertEqual(downsample(rows, 5000), rows)
+
+    def test_long_series(self):
+        values = list(np.sin(np.arange(100) / 5))
+        values[10] = MISSING_VALUE
+        values[20] = None
+        kept = downsample(series(values), 10)
+
+        self.assertEqual(len(kept), 10)
+        self.assertTrue(all(row['value'] not in (None, MISSING_VALUE) for row in kept))
+        self.assertEqual(kept[0]['end_time'], series(values)[0]['end_time'])
+        self.assertEqual(kept[-1]['end_time'], series(values)[-1]['end_time'])
+
+    def test_lttb_threshold(self):
+        x = np.arange(10)
+        self.assertEqual(len(lttb(x, x, 3)), 3)
+        self.assertEqual(len(lttb(x, x, 20)), 10)
+        for threshold in (1, 2):
+            with self.assertRaises(ValueError):
+                lttb(x, x, threshold)
+
+
+class GetObsTests(TestCase):
+
+    def test_max_points_validation(self):
+        params = {'start_date': '2024-01-01', 'end_date': '2024-01-02', 'station_id': 1, 'param_id': 1}
+        for max_points in ('2', '0', 'x'):
+            response = self.client.get(reverse('obs_data.get_obs'), dict(params, max_points=max_points))
+            self.assertEqual(response.json()['error'], 'invalid request')
+
+        response = self.client.get(reverse('obs_data.get_obs'), dict(params, max_points='3'))
+        self.assertEqual(response.json()['obs'], [])
+
+
+class ReferenceMixin:
+    '''
+    a station, a parameter and a level, records of a day of January 2024
+    '''
+
+    def setUp(self):
+        self.station = station.objects.create(
+            name='colombo', full_name='Colombo', lat=6.9, lon=79.87,
+            station_category=station.METEOROLOGICAL, station_type=station.AUTO
+        )
+        self.param = parameter.objects.create(
+            name='rainfall', full_name='Rainfall', unit='mm', parameter_type=parameter.ACCM
+        )
+        self.level = level.objects.create(name='surface', full_name='Surface')
+        registry.invalidate()
+
+    def record(self, day, value):
+        return {
+            'station_id': self.station.id, 'parameter_id': self.param.id, 'level_id': self.level.id,
+            'start_time': f'2024-01-{day:02d} 00:00Z', 'end_time': f'2024-01-{day + 1:02d} 00:00Z',
+            'value': value,
+        }
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class IngestCountTests(ReferenceMixin, TestCase):
+    '''
+    records a concurrent sender wrote between the lookup of existing
+    records and the insert are not counted as inserted
+    '''
+
+    def ingest_stale(self, records, on_conflict):
+        # the first lookup misses the records another sender just wrote
+        writer_class = CopyWriter if connection.vendor == 'postgresql' else OrmWriter
+        real, calls = writer_class.existing, []
+
+        def existing(writer, *args):
+            calls.append(args)
+            return {} if len(calls) == 1 else real(writer, *args)
+
+        with mock.patch.object(writer_class, 'existing', existing):
+            return ingest_records(records, on_conflict)
+
+    def rec_count(self):
+        return station_summary.objects.get(station_id=self.station.id, parameter_id=self.param.id).rec_count
+
+    def test_ignore(self):
+        ingest_records([self.record(1, 1.0)])
+        result = self.ingest_stale([self.record(1, 2.0), self.record(2, 3.0)], ON_CONFLICT_IGNORE)
+
+        self.assertEqual((result['inserted'], result['skipped']), (1, 1))
+        self.assertEqual(obs_data.objects.count(), 2)
+        self.assertEqual(self.rec_count(), 2)
+
+    def test_update(self):
+        ingest_records([self.record(1, 1.0)])
+        result = self.ingest_stale([self.record(1, 2.0)], ON_CONFLICT_UPDATE)
+
+        self.assertEqual((result['inserted'], result['updated']), (0, 1))
+        self.assertEqual(obs_data.objects.get().value, 2.0)
+        self.assertEqual(self.rec_count(), 1)
+
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class SummaryDeltaTests(ReferenceMixin, TestCase):
+    '''
+    station_summary kept by the ingest deltas, as rebuild_station_summary
+    would compute it
+    '''
+
+    fields = ('rec_start', 'rec_end', 'rec_count', 'missing_count')
+
+    def summaries(self):
+        return {
+            (row[0], row[1]): row[2:]
+            for row in station_summary.objects.order_by('station_id', 'parameter_id').values_list(
+                'station_id', 'parameter_id', *self.fields
+            )
+        }
+
+    def summary(self):
+        return station_summary.objects.get(station_id=self.station.id, parameter_id=self.param.id)
+
+    def day(self, day):
+        return datetime(2024, 1, day, tzinfo=timezone.utc)
+
+    def test_insert(self):
+        ingest_records([self.record(2, 1.0), self.record(1, MISSING_VALUE), self.record(3, 2.0)])
+        summary = self.summary()
+        self.assertEqual(
+            (summary.rec_start, summary.rec_end, summary.rec_count, summary.missing_count, summary.version),
+            (self.day(1), self.day(4), 3, 1, 1)
+        )
+
+    def test_ignore(self):
+        ingest_records([self.record(2, 1.0)])
+        ingest_records([self.record(2, MISSING_VALUE), self.record(5, 2.0)], ON_CONFLICT_IGNORE)
+        summary = self.summary()
+        self.assertEqual(
+            (summary.rec_start, summary.rec_end, summary.rec_count, summary.missing_count, summary.version),
+            (self.day(2), self.day(6), 2, 0, 2)
+        )
+
+    def test_update(self):
+        ingest_records([self.record(1, MISSING_VALUE), self.record(2, 1.0)])
+        ingest_records([self.record(1, 3.0), self.record(2, MISSING_VALUE)], ON_CONFLICT_UPDATE)
+        ingest_records([self.record(1, MISSING_VALUE)], ON_CONFLICT_UPDATE)
+        summary = self.summary()
+        self.assertEqual(
+            (summary.rec_start, summary.rec_end, summary.rec_count, summary.missing_count, summary.version),
+            (self.day(1), self.day(3), 2, 2, 3)
+        )
+
+    def test_rebuild(self):
+        other = parameter.objects.create(name='tmax', full_name='Tmax', unit='C', parameter_type=parameter.MAX)
+        registry.invalidate()
+
+        ingest_records([self.record(3, 1.0), dict(self.record(1, MISSING_VALUE), parameter_id=other.id)])
+        ingest_records(
+            [self.record(3, MISSING_VALUE), self.record(9, 2.0), dict(self.record(4, 5.0), parameter_id=other.id)],
+            ON_CONFLICT_UPDATE
+        )
+        ingest_records([self.record(1, 0.0), self.record(9, 7.0)], ON_CONFLICT_IGNORE)
+
+        kept = self.summaries()
+        self.assertEqual(len(kept), 2)
+        rebuild_station_summary()
+        self.assertEqual(self.summaries(), kept)
+
+    def test_locks_keys_in_order(self):
+        # only the summaries of the ingest are changed
+        other = parameter.objects.create(name='tmax', full_name='Tmax', unit='C', parameter_type=parameter.MAX)
+        untouched = station_summary.objects.create(station_id=self.station.id, parameter_id=other.id)
+
+        deltas = {(self.station.id, self.param.id): SummaryDelta()}
+        with CaptureQueriesContext(connection) as queries:
+            apply_deltas(deltas)
+        untouched.refresh_from_db()
+        self.assertEqual(untouched.version, 0)
+        self.assertEqual(self.summary().version, 1)
+
+        if connection.features.has_select_for_update:
+            locking = [query['sql'] for query in queries if 'FOR UPDATE' in query['sql']]
+            self.assertEqual(len(locking), 1)
+            self.assertIn('ORDER BY', locking[0])
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class ConditionalGetTests(ReferenceMixin, TestCase):
+
+    def get(self, **headers):
+        params = {
+            'start_date': '2024-01-01', 'end_date': '2024-02-01',
+            'station_id': self.station.id, 'param_id': self.param.id,
+        }
+        return self.client.get(reverse('obs_data.get_obs'), params, **headers)
+
+    def test_not_modified(self):
+        ingest_records([self.record(1, 1.0)])
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        etag, last_modified = response['ETag'], response['Last-Modified']
+
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.get(HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+
+        # a new record changes the etag
+        ingest_records([self.record(2, 2.0)])
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(len(response.json()['obs']), 2)
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class ReferenceRegistryTests(TestCase):
+
+    def setUp(self):
+        registry.invalidate()
+
+    def test_invalidated_on_commit(self):
+        # registry of another worker, sharing the version through the cache
+        other = VersionedCache('obs_data.reference', Reference)
+        self.assertEqual(get_reference().parameters, {})
+        other.get()
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            param = parameter.objects.create(
+                name='rainfall', full_name='Rainfall', unit='mm', parameter_type=parameter.ACCM
+            )
+            # rebuilt before the commit it would miss the new row for good
+            self.assertNotIn(param.id, get_reference().parameters)
+        self.assertEqual(len(callbacks), 1)
+
+        self.assertIn(param.id, get_reference().parameters)
+        self.assertIn(param.id, other.get().parameters)
+
+        version = reference_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            param.delete()
+        self.assertNotEqual(reference_version(), version)
+        self.assertEqual(get_reference().parameters, {})
+
+class ExportObsTests(TestCase):
+
+    def test_required_ids(self):
+        dates = {'start_date': '2024-01-01', 'end_date': '2024-01-02'}
+        for params in ({}, {'station_id': 1}, {'param_id': 1}):
+            response = self.client.get(reverse('obs_data.export'), dict(dates, **params))
+            self.assertEqual(response.json()['error'], 'invalid request')
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class GetObsBatchTests(TestCase):
+
+    def setUp(self):
+        self.station = station.objects.create(
+            name='colombo', full_name='Colombo', lat=6.9, lon=79.87,
+            station_category=station.METEOROLOGICAL, station_type=station.AUTO
+        )
+        self.params = [
+            parameter.objects.create(name=name, full_name=name, unit='', parameter_type=param_type).id
+            for name, param_type in (('tavg', parameter.INST), ('rh', parameter.AVG), ('rainfall', parameter.ACCM))
+        ]
+        registry.invalidate()
+
+    def queries(self, param_ids):
+        params = {
+            'start_date': '2024-01-01', 'end_date': '2024-02-01', 'interval': 'day',
+            'station_id': [self.station.id], 'param_id': param_ids,
+        }
+        self.client.get(reverse('obs_data.get_obs_batch'), params)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('obs_data.get_obs_batch'), params)
+        self.assertEqual(len(response.json()['series']), len(param_ids))
+        return len(queries)
+
+    def test_shared_aggregate(self):
+        # INST and AVG parameters are both averaged in one rollup query
+        one = self.queries(self.params[:1])
+        self.assertEqual(self.queries(self.params[:2]), one)
+        self.assertEqual(self.queries(self.params), one + 1)
+
+
+
+@skipUnless(connection.vendor == 'postgresql', 'COPY ingest runs on postgresql only')
+@override_settings(CACHES=LOCAL_CACHE)
+class CopyIngestTests(ReferenceMixin, TestCase):
+    '''
+    counts and stored records of the COPY staging table path
+    '''
+
+    def stored(self):
+        return dict(obs_data.objects.order_by('start_time').values_list('start_time__day', 'value'))
+
+    def test_error(self):
+        result = ingest_records([self.record(1, 1.0), self.record(2, 2.0)])
+        self.assertEqual((result['inserted'], result['updated'], result['skipped']), (2, 0, 0))
+
+        with self.assertRaises(IntegrityError):
+            ingest_records([self.record(3, 3.0), self.record(2, 4.0)], ON_CONFLICT_ERROR)
+        # the whole second ingest is rolled back
+        self.assertEqual(self.stored(), {1: 1.0, 2: 2.0})
+
+    def test_ignore(self):
+        ingest_records([self.record(1, 1.0)])
+        result = ingest_records(
+            [self.record(1, 5.0), self.record(2, 2.0), self.record(2, 6.0)], ON_CONFLICT_IGNORE
+        )
+        self.assertEqual((result['inserted'], result['updated'], result['skipped']), (1, 0, 2))
+        self.assertEqual([rec['index'] for rec in result['rejected']], [0, 2])
+        self.assertEqual(self.stored(), {1: 1.0, 2: 2.0})
+
+    def test_update(self):
+        ingest_records([self.record(1, 1.0), self.record(2, 2.0)])
+        result = ingest_records(
+            [self.record(2, 5.0), self.record(3, 3.0), self.record(3, 6.0)], ON_CONFLICT_UPDATE
+        )
+        self.assertEqual((result['inserted'], result['updated'], result['skipped']), (1, 1, 1))
+        self.assertEqual(self.stored(), {1: 1.0, 2: 5.0, 3: 6.0})
+        summary = station_summary.objects.get(station_id=self.station.id, parameter_id=self.param.id)
+        self.assertEqual((summary.rec_count, summary.missing_count), (3, 0))
+
+
+@skipUnless(connection.vendor == 'postgresql', 'obs_data is partitioned on postgresql only')
+@override_settings(CACHES=LOCAL_CACHE)
+class PartitionTests(ReferenceMixin, TestCase):
+
+    def record(self, year, value=1.0):
+        return {
+            'station_id': self.station.id, 'parameter_id': self.param.id, 'level_id': self.level.id,
+            'start_time': f'{year}-01-01 00:00Z', 'end_time': f'{year}-01-02 00:00Z', 'value': value,
+        }
+
+    def test_constraint_names(self):
+        # the names Django gave the plain table, later migrations look them up
+        with connection.cursor() as cursor:
+            self.assertTrue(partitions.is_partitioned(cursor))
+            constraints = connection.introspection.get_constraints(cursor, partitions.TABLE)
+        with connection.schema_editor() as editor:
+            uniq = editor._create_index_name(
+                partitions.TABLE, ['start_time', 'end_time', 'parameter_id', 'level_id', 'station_id'], suffix='_uniq'
+            )
+        self.assertEqual(constraints[f'{partitions.TABLE}_pkey']['columns'], ['id', 'start_time'])
+        self.assertTrue(constraints[uniq]['unique'])
+        self.assertEqual(
+            sorted(info['columns'][0] for info in constraints.values() if info['foreign_key']),
+            ['level_id', 'parameter_id', 'station_id']
+        )
+        self.assertFalse([name for name in constraints if 'partitioned' in name])
+
+    def test_ingest_and_pruning(self):
+        ingest_records([self.record(2023), self.record(2024)])
+        with connection.cursor() as cursor:
+            # the 2024 record moves out of the default partition
+            self.assertTrue(partitions.create_partition(cursor, 2024))
+            self.assertFalse(partitions.create_partition(cursor, 2024))
+            cursor.execute(f'SELECT count(*) FROM {partitions.partition_name(2024)}')
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+            result = ingest_records([self.record(2024, 2.0), self.record(2025)], ON_CONFLICT_UPDATE)
+            self.assertEqual((result['inserted'], result['updated']), (1, 1))
+
+            qs = obs_data.objects.filter(
+                station_id=self.station.id, parameter_id=self.param.id,
+                start_time__gte=datetime(2024, 1, 1, tzinfo=timezone.utc),
+                start_time__lt=datetime(2024, 2, 1, tzinfo=timezone.utc),
+            ).values_list('end_time', 'value')
+            self.assertEqual([value for _, value in qs], [2.0])
+            sql, params = qs.query.sql_with_params()
+            cursor.execute('EXPLAIN ' + sql, params)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+        self.assertIn(partitions.partition_name(2024), plan)
+        self.assertNotIn(partitions.DEFAULT_PARTITION, plan)
@@ -1,10 +1,13 @@
 from django.urls import path
-from .views import ObsView, InsertObs, GetObs, StationMeta, GetParameters
+from .views import ObsView, InsertObs, BulkInsertObs, GetObs, GetObsBatch, ExportObs, StationMeta, GetParameters
 
 urlpatterns = [
     path('', ObsView.as_view(), name='obs_data.obs_view'),
     path('insert/', InsertObs.as_view(), name='obs_data.insert'),
+    path('insert/bulk/', BulkInsertObs.as_view(), name='obs_data.insert_bulk'),
     path('view_obs/', GetObs.as_view(), name='obs_data.get_obs'),
+    path('view_obs/batch/', GetObsBatch.as_view(), name='obs_data.get_obs_batch'),
+    path('export/', ExportObs.as_view(), name='obs_data.export'),
     path('stations/', StationMeta.as_view(), name='obs_data.get_station_meta'),
     path('parameters/', GetParameters.as_view(), name='obs_data.get_params'),
 ]
\ No newline at end of file
@@ -0,0 +1,56 @@
+'''
+Data versions of observation endpoints, for conditional GET
+
+The version of a request is taken from the station_summary rows of the
+requested station(s) and parameter(s): their number, the sum of their
+version counters and the latest updated_at. Each insert bumps the
+counters, a rebuild of the summary moves updated_at. The etag also holds
+the reference registry version, responses carry station and parameter
+names.
+'''
+from django.db.models import Count, Max, Sum
+
+from obs_data.models import station_summary
+from obs_data.registry import reference_version
+
+
+def data_version(request):
+    '''
+    (etag, last_modified) of the records a request reads, None if the
+    request does not name valid stations, looked up once per request
+    '''
+    if hasattr(request, '_obs_data_version'):
+        return request._obs_data_version
+
+    version = None
+    try:
+        station_ids = [int(stn_id) for stn_id in request.GET.getlist('station_id')]
+        param_ids = [int(param_id) for param_id in request.GET.getlist('param_id')]
+    except ValueError:
+        station_ids = []
+
+    if station_ids:
+        qs = station_summary.objects.filter(station_id__in=station_ids)
+        if param_ids:
+            qs = qs.filter(parameter_id__in=param_ids)
+
+        info = qs.aggregate(Count('pk'), Sum('version'), Max('updated_at'))
+        if info['updated_at__max'] is not None:
+            version = (
+                f"{info['pk__count']}-{info['version__sum']}-{info['updated_at__max'].timestamp():.6f}"
+                f"-{reference_version()}",
+                info['updated_at__max']
+            )
+
+    request._obs_data_version = version
+    return version
+
+
+def data_etag(request, *args, **kwargs):
+    version = data_version(request)
+    return version[0] if version else None
+
+
+def data_last_modified(request, *args, **kwargs):
+    version = data_version(request)
+    return version[1] if version else None
@@ -2,45 +2,59 @@ import json
 from datetime import datetime as dt
 
 from django.shortcuts import render
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.db import IntegrityError
 from django.views import View
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
-from django.db.models import Min, Max, Count
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 
 from obs_data.models import *
+from obs_data.aggregation import INTERVALS, MIN_POINTS, aggregate_of, rollup, downsample, columnar
+from obs_data.export import (
+    CSV, CONTENT_TYPES, FILE_EXTENSIONS, available_formats, iter_record_chunks, stream_export
+)
+from obs_data.ingest import IngestError, get_on_conflict, iter_request_records, ingest_records
+from obs_data.registry import get_reference
+from obs_data.versions import data_etag, data_last_modified
 
 # Create your views here.
 
+# answer 304 Not Modified while the data version of the requested station(s)
+# and parameter(s) is unchanged, no-cache makes browsers always revalidate
+conditional_on_data = [
+    cache_control(no_cache=True),
+    condition(etag_func=data_etag, last_modified_func=data_last_modified),
+]
+
 
 class ObsView(View):
 
     def get(self, request):
         data = {}
-        data['stations'] = station.objects.all().values('id', 'name')
+        data['stations'] = [
+            {'id': stn['id'], 'name': stn['name']}
+            for stn in get_reference().stations.values()
+        ]
         return render(request, 'obs_view.html', data)
 
 
+@method_decorator(conditional_on_data, name='get')
 class GetParameters(View):
 
     def get(self, request):
         data = {}
         stn_id = request.GET.get('station_id', None)
-        params = []
-        parameter_ids = obs_data.objects.values_list(
-                'parameter__id', flat=True
-            ).filter(
-                station_id=stn_id
-            ).distinct()
-
-        if parameter_ids.exists():
-            params.extend(
-                list(
-                    parameter.objects.filter(id__in=list(parameter_ids)).values('name', 'id')
-                )
-            )
-        
+        parameters = get_reference().parameters
+        params = [
+            {'name': parameters[param_id]['name'], 'id': param_id}
+            for param_id in station_summary.objects.filter(
+                station_id=stn_id, rec_count__gt=0
+            ).values_list('parameter_id', flat=True).order_by('parameter_id')
+            if param_id in parameters
+        ]
+
         data['parameters'] = params
         return JsonResponse(data)
 
@@ -55,49 +69,6 @@ class InsertObs(View):
         )
 
 
-    def date_ok(self,start_date:str, end_date:str)->True:
-        
-        date_ok = True
-        try:
-            start_date_obj = dt.strptime(start_date, '%Y-%m-%d %H:%MZ')
-            end_date_obj = dt.strptime(end_date, '%Y-%m-%d %H:%MZ')
-                
-        except:
-            return False
-
-        if start_date_obj > end_date_obj:
-            date_ok = False
-
-        return date_ok
-
-    def rec_ok(self,rec)->bool:
-        msg = ''
-        
-        # check if the formatting is okay field
-        fmt_ok =  ( rec.get('station_id',None) != None and type(rec['station_id'])==int ) \
-                & ( rec.get('parameter_id',None) != None and type(rec['parameter_id'])==int ) \
-                & ( rec.get('level_id',None) != None and type(rec['level_id'])==int ) \
-                & ( rec.get('start_time',None) != None ) \
-                & ( rec.get('end_time',None) != None ) \
-                & ( rec.get('value',None) != None and ( type(rec['value'])==int or type(rec['value'])==float ) )
-
-        #  check for valid datetime
-        date_ok =  self.date_ok(rec['start_time'], rec['end_time'])
-
-        # check if station is within country
-        stn_ok = rec['station_id'] in self.stations
-
-        if not fmt_ok:
-            msg += "data format is not okay :: "
-
-        if not date_ok:
-            msg += "date format is not okay :: "
-
-        if not stn_ok:
-            msg += "station id does not exist :: "
-
-        return fmt_ok and date_ok and stn_ok, msg
-        
     # req_payload = pre parsed parsed by decorator etc.
     def post(self, request, req_payload=None):
 
@@ -147,67 +118,215 @@ class InsertObs(View):
             data['message'] = 'data is not provided or formatted properly'
             return JsonResponse(data)
 
-        # get station_id list for country
-        self.stations = set(
-                            station.objects.all() \
-                            .values_list('id',flat=True)
-                        )
-
-        obs_data_obj_queue = []
-        for i, rec in enumerate(req_data):
-            
-            # check if record is okay
-            _ok, msg = self.rec_ok(rec)
-            if not _ok:
-                data['error'] = 'invalid data'
-                data['message'] = f'error in data in record {i}, {msg}'
-                return JsonResponse(data)
+        # records are checked and written by the ingest engine,
+        # ?on_conflict=ignore|update reports conflicts instead of failing
+        try:
+            data.update(ingest_records(req_data, get_on_conflict(request)))
+        except IngestError as e:
+            data['error'] = e.error
+            data['message'] = e.message
+        except IntegrityError as e:
+            data['error'] = 'invalid data'
+            data['message'] = f'{e}'
 
-            obs_data_obj_queue.append(
-                obs_data(
-                    start_time = rec['start_time'],
-                    end_time = rec['end_time'],
-                    duration = dt.strptime(rec['end_time'],'%Y-%m-%d %H:%MZ') - dt.strptime(rec['start_time'],'%Y-%m-%d %H:%MZ'),
-                    value = rec['value'],
-                    parameter_id = rec['parameter_id'],
-                    level_id = rec['level_id'],
-                    station_id = rec['station_id']
-                )
-            )
+        return JsonResponse(data)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class BulkInsertObs(View):
+
+    def get(self, request):
+
+        return JsonResponse(
+            {'error':'invalid request', 'message':'restricted access'}
+        )
+
+    # accepts application/json like InsertObs or application/x-ndjson,
+    # one record per line, which is streamed instead of loaded at once
+    def post(self, request):
+
+        data = dict()
+        data['error'] = None
+        data['message'] = 'insert successfull'
 
         try:
-            obs_data.objects.bulk_create(obs_data_obj_queue)
+            data.update(
+                ingest_records(iter_request_records(request), get_on_conflict(request))
+            )
+        except IngestError as e:
+            data['error'] = e.error
+            data['message'] = e.message
         except IntegrityError as e:
             data['error'] = 'invalid data'
             data['message'] = f'{e}'
-            return JsonResponse(data)
 
         return JsonResponse(data)
 
 
+@method_decorator(conditional_on_data, name='get')
 class GetObs(View):
-    
+
+    # optional: interval=day|month|season|year rolls the records up,
+    # max_points=N downsamples the series (LTTB) to at most N points
     def get(self, request):
         data = {}
         start_date = request.GET.get('start_date', None)
         end_date = request.GET.get('end_date', None)
         station_id = request.GET.get('station_id', None)
         param_id = request.GET.get('param_id', None)
+        interval = request.GET.get('interval', None)
+        max_points = request.GET.get('max_points', None)
 
         sdate = dt.strptime(start_date, '%Y-%m-%d')
         edate = dt.strptime(end_date, '%Y-%m-%d')
 
-        data['obs'] = list(
-            obs_data.objects.filter(
+        if interval is not None and interval not in INTERVALS:
+            data['error'] = 'invalid request'
+            data['message'] = f'interval must be one of {", ".join(INTERVALS)}'
+            return JsonResponse(data)
+
+        try:
+            max_points = int(max_points) if max_points else None
+        except ValueError:
+            max_points = 0
+        if max_points is not None and max_points < MIN_POINTS:
+            data['error'] = 'invalid request'
+            data['message'] = f'max_points must be an integer of at least {MIN_POINTS}'
+            return JsonResponse(data)
+
+        qs = obs_data.objects.filter(
                 station_id=station_id,
                 parameter_id=param_id,
                 start_time__gte=sdate.strftime('%Y-%m-%d 00:00:00Z'),
                 end_time__lte=edate.strftime('%Y-%m-%d 00:00:00Z')
-            ).values('end_time', 'value'))
+            )
 
+        if interval:
+            try:
+                param = get_reference().parameters.get(int(param_id), None)
+            except (TypeError, ValueError):
+                param = None
+            param_type = param['parameter_type'] if param else None
+            obs = rollup(qs, param_type, interval)
+            data['interval'] = interval
+        else:
+            obs = list(qs.order_by('end_time').values('end_time', 'value'))
+
+        if max_points:
+            obs = downsample(obs, max_points)
+
+        data['obs'] = obs
         return JsonResponse(data)
 
 
+@method_decorator(conditional_on_data, name='get')
+class GetObsBatch(View):
+
+    # station_id and param_id may be repeated, optional interval like GetObs,
+    # returns a shared time axis and one value list per station/parameter
+    def get(self, request):
+        data = {}
+        start_date = request.GET.get('start_date', None)
+        end_date = request.GET.get('end_date', None)
+        station_ids = request.GET.getlist('station_id')
+        param_ids = request.GET.getlist('param_id')
+        interval = request.GET.get('interval', None)
+
+        if interval is not None and interval not in INTERVALS:
+            data['error'] = 'invalid request'
+            data['message'] = f'interval must be one of {", ".join(INTERVALS)}'
+            return JsonResponse(data)
+
+        try:
+            sdate = dt.strptime(start_date, '%Y-%m-%d')
+            edate = dt.strptime(end_date, '%Y-%m-%d')
+            station_ids = list(dict.fromkeys(int(stn_id) for stn_id in station_ids))
+            param_ids = list(dict.fromkeys(int(param_id) for param_id in param_ids))
+        except (TypeError, ValueError):
+            data['error'] = 'invalid request'
+            data['message'] = 'start_date, end_date, station_id and param_id are required'
+            return JsonResponse(data)
+
+        qs = obs_data.objects.filter(
+                station_id__in=station_ids,
+                parameter_id__in=param_ids,
+                start_time__gte=sdate.strftime('%Y-%m-%d 00:00:00Z'),
+                end_time__lte=edate.strftime('%Y-%m-%d 00:00:00Z')
+            )
+        series_keys = [(stn_id, param_id) for stn_id in station_ids for param_id in param_ids]
+
+        if interval:
+            # parameters sharing an aggregate (INST and AVG are both
+            # averaged) are rolled up in one query
+            aggregates = dict()
+            parameters = get_reference().parameters
+            for param_id in param_ids:
+                if param_id in parameters:
+                    param_type = parameters[param_id]['parameter_type']
+                    aggregates.setdefault(aggregate_of(param_type), (param_type, []))[1].append(param_id)
+
+            rows = []
+            for param_type, type_param_ids in aggregates.values():
+                rows.extend(
+                    (row['station_id'], row['parameter_id'], row['start_time'], row['value'])
+                    for row in rollup(
+                        qs.filter(parameter_id__in=type_param_ids), param_type, interval,
+                        group_by=('station_id', 'parameter_id')
+                    )
+                )
+            data.update(columnar(rows, series_keys, 'start_time'))
+            data['interval'] = interval
+        else:
+            rows = qs.values_list('station_id', 'parameter_id', 'end_time', 'value')
+            data.update(columnar(rows, series_keys, 'end_time'))
+
+        return JsonResponse(data)
+
+
+class ExportObs(View):
+
+    # station_id and param_id may be repeated, format=csv|parquet|arrow
+    def get(self, request):
+        data = {}
+        start_date = request.GET.get('start_date', None)
+        end_date = request.GET.get('end_date', None)
+        station_ids = request.GET.getlist('station_id')
+        param_ids = request.GET.getlist('param_id')
+        fmt = request.GET.get('format', CSV)
+
+        if fmt not in available_formats():
+            data['error'] = 'invalid request'
+            data['message'] = f'format must be one of {", ".join(available_formats())}'
+            return JsonResponse(data)
+
+        try:
+            sdate = dt.strptime(start_date, '%Y-%m-%d')
+            edate = dt.strptime(end_date, '%Y-%m-%d')
+            station_ids = [int(stn_id) for stn_id in station_ids]
+            param_ids = [int(param_id) for param_id in param_ids]
+            if not (station_ids and param_ids):
+                raise ValueError('station_id and param_id are required')
+        except (TypeError, ValueError):
+            data['error'] = 'invalid request'
+            data['message'] = 'start_date, end_date, station_id and param_id are required'
+            return JsonResponse(data)
+
+        chunks = iter_record_chunks(
+            station_ids,
+            param_ids,
+            sdate.strftime('%Y-%m-%d 00:00:00Z'),
+            edate.strftime('%Y-%m-%d 00:00:00Z')
+        )
+
+        response = StreamingHttpResponse(
+            stream_export(chunks, fmt), content_type=CONTENT_TYPES[fmt]
+        )
+        filename = f'observations_{sdate:%Y%m%d}_{edate:%Y%m%d}.{FILE_EXTENSIONS[fmt]}'
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
+
+@method_decorator(conditional_on_data, name='get')
 class StationMeta(View):
 
     def get(self, request):
@@ -219,15 +338,38 @@ class StationMeta(View):
                             'lat', 'lon', 'station_type'
                         ]
 
-        station_info = station.objects.filter(id=station_id).values(*stn_info_fields).first()
-        params_ids = list(obs_data.objects.filter(station__id=station_id).values_list('parameter__id',flat=True).distinct())
-        param_names = list(parameter.objects.filter(id__in=params_ids).values('id','name','full_name'))
-
-        rec_info = obs_data.objects.filter(station__id=station_id).aggregate(Min('start_time'),Max('end_time'),Count('pk'))
-        rec_start = rec_info['start_time__min'].strftime('%Y-%m-%d') if rec_info['start_time__min'] else None
-        rec_end = rec_info['end_time__max'].strftime('%Y-%m-%d') if rec_info['end_time__max'] else None
-        rec_count = rec_info['pk__count'] if rec_info['pk__count'] else 0
-        missing = obs_data.objects.filter(value=-9999,station__id=station_id).count()
+        reference = get_reference()
+        try:
+            station_info = reference.stations.get(int(station_id), None)
+        except (TypeError, ValueError):
+            station_info = None
+        if station_info is not None:
+            station_info = {field: station_info[field] for field in stn_info_fields}
+
+        # answered from station_summary, one row per parameter of the station
+        summaries = list(
+            station_summary.objects.filter(
+                station_id=station_id, rec_count__gt=0
+            ).values(
+                'parameter_id', 'rec_start', 'rec_end', 'rec_count', 'missing_count'
+            ).order_by('parameter_id')
+        )
+        param_names = [
+            {
+                'id': row['parameter_id'],
+                'name': reference.parameters[row['parameter_id']]['name'],
+                'full_name': reference.parameters[row['parameter_id']]['full_name']
+            }
+            for row in summaries
+            if row['parameter_id'] in reference.parameters
+        ]
+
+        rec_start = min((row['rec_start'] for row in summaries), default=None)
+        rec_end = max((row['rec_end'] for row in summaries), default=None)
+        rec_start = rec_start.strftime('%Y-%m-%d') if rec_start else None
+        rec_end = rec_end.strftime('%Y-%m-%d') if rec_end else None
+        rec_count = sum(row['rec_count'] for row in summaries)
+        missing = sum(row['missing_count'] for row in summaries)
 
         stn_meta_fields['info'] = station_info
         stn_meta_fields['params'] = param_names
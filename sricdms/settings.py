@@ -95,6 +95,18 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+# file based so that all workers of a host share cached values
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, '__cache__/'),
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -146,4 +158,37 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 ECMWF_HRES_NC = '/home/anubinda/RIMESNAS/ECMWF_HRES/%d%m%Y.nc'
 FCST_JSON_URL_PREF = '/static/'
-FCST_JSONOUT = '/home/anubinda/Dev/sricdms/__tmp__/'
\ No newline at end of file
+FCST_JSONOUT = '/home/anubinda/Dev/sricdms/__tmp__/'
+
+# number of observation records validated and written per batch by bulk insert
+OBS_INGEST_BATCH_SIZE = 5000
+
+# max age in seconds of cached landing page statistics
+HOME_STATS_MAX_AGE = 300
+
+# number of observation records fetched per server-side cursor round trip by export
+OBS_EXPORT_CHUNK_SIZE = 10000
+
+# on disk cache of netcdf subsets, least recently used files are evicted over max bytes
+FCST_SUBSET_CACHE_DIR = os.path.join(BASE_DIR, '__cache__', 'forecast_subsets')
+FCST_SUBSET_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+# background subset jobs, pool threads per worker process, max jobs queued or
+# running over all workers, seconds a finished file is kept, seconds between
+# heartbeats of the unfinished jobs of a worker and seconds without a
+# heartbeat after which an unfinished job is considered lost
+FCST_JOB_DIR = os.path.join(BASE_DIR, '__cache__', 'forecast_jobs')
+FCST_JOB_WORKERS = 2
+FCST_JOB_MAX_QUEUED = 20
+FCST_JOB_TTL = 24 * 3600
+FCST_JOB_HEARTBEAT = 60
+FCST_JOB_TIMEOUT = 600
+
+# daily rainfall thresholds in mm of the categorical forecast verification scores
+FCST_VERIF_RAIN_THRESHOLDS = (1, 10, 25, 50)
+
+# per date manifests of the forecast processing commands, see forecast_data.backfill
+FCST_MANIFEST_DIR = os.path.join(BASE_DIR, '__cache__', 'forecast_manifests')
+
+# sources, regions, variables and products of the forecast rasters, see forecast_data.products
+FCST_PRODUCTS_FILE = os.path.join(BASE_DIR, 'forecast_data', 'products.yaml')
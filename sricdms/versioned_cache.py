@@ -0,0 +1,49 @@
+'''
+In-process cache of small, rarely changing data (reference tables,
+system state), shared invalidation through a version token kept in the
+django cache.
+
+Every worker process holds its own copy and compares the token on each
+access; invalidate() writes a new token so all workers rebuild on their
+next access. With the file based cache of settings this costs a file read
+per access and no database query while nothing changes.
+'''
+import threading
+import uuid
+
+from django.core.cache import cache
+
+
+class VersionedCache:
+
+    def __init__(self, name, build):
+        self.key = f'versioned_cache.{name}'
+        self.build = build
+        self.lock = threading.Lock()
+        self.version = None
+        self.value = None
+
+    def shared_version(self):
+        version = cache.get(self.key)
+        if version is None:
+            # first access or evicted token, a new token forces a rebuild everywhere
+            cache.add(self.key, uuid.uuid4().hex, timeout=None)
+            version = cache.get(self.key)
+        return version
+
+    def get(self):
+        version = self.shared_version()
+        if self.value is not None and version == self.version:
+            return self.value
+
+        with self.lock:
+            if self.value is None or version != self.version:
+                self.value = self.build()
+                self.version = version
+            return self.value
+
+    def invalidate(self):
+        cache.set(self.key, uuid.uuid4().hex, timeout=None)
+        with self.lock:
+            self.value = None
+            self.version = None
@@ -0,0 +1,89 @@
+/*
+ * Loader of the forecast map rasters for L.GridLayer.RasterGridLayer
+ *
+ * 'ufg'  : binary uniform grid written by forecast_data.ufgrid, an 84 byte
+ *          little-endian header followed by int16/int32 values, optionally
+ *          zlib (DecompressionStream) or brotli (needs a global BrotliDecode,
+ *          e.g. from brotli.js) compressed
+ * 'json' : ufgrid JSON with an integer list, the fallback
+ *
+ * Both resolve to the raster_data object the layer expects, values of ufg
+ * rasters are unscaled into a Float32Array with missing cells at nodata.
+ */
+const RasterGridLoader = {
+
+    HEADER_SIZE: 84,
+    COMPRESSIONS: ['none', 'zlib', 'brotli'],
+
+    load: function(url, format) {
+        if (format === 'ufg') {
+            return fetch(url)
+                .then(r => r.arrayBuffer())
+                .then(buffer => this.parseUfg(buffer));
+        }
+        return fetch(url).then(r => r.json());
+    },
+
+    parseUfg: function(buffer) {
+        const view = new DataView(buffer);
+        const magic = String.fromCharCode(
+            view.getUint8(0), view.getUint8(1), view.getUint8(2), view.getUint8(3)
+        );
+        if (magic !== 'UFG1' || view.getUint8(4) !== 1) {
+            return Promise.reject(new Error('not a ufg raster'));
+        }
+
+        const valueBytes = view.getUint8(5);
+        const compression = this.COMPRESSIONS[view.getUint8(6)];
+        const header = {
+            nx: view.getUint32(8, true),
+            ny: view.getUint32(12, true),
+            dx: view.getFloat64(16, true),
+            dy: view.getFloat64(24, true),
+            xll_center: view.getFloat64(32, true),
+            yll_center: view.getFloat64(40, true),
+            nodata: view.getFloat64(48, true),
+            min: view.getFloat64(56, true),
+            max: view.getFloat64(64, true),
+            sf: view.getFloat64(72, true),
+        };
+        const fill = view.getInt32(80, true);
+
+        return this.decompress(buffer.slice(this.HEADER_SIZE), compression).then((payload) => {
+            const count = header.nx * header.ny;
+            const scaled = this.readValues(payload, valueBytes, count);
+            const data = new Float32Array(count);
+            for (let i = 0; i < count; i++) {
+                data[i] = scaled[i] === fill ? header.nodata : scaled[i] / header.sf;
+            }
+            // values are unscaled already
+            return Object.assign(header, { data: data, sf: 1 });
+        });
+    },
+
+    readValues: function(payload, valueBytes, count) {
+        const view = new DataView(payload);
+        const values = valueBytes === 2 ? new Int16Array(count) : new Int32Array(count);
+        // explicit little-endian reads, typed array views use the platform's order
+        for (let i = 0; i < count; i++) {
+            values[i] = valueBytes === 2
+                ? view.getInt16(i * 2, true)
+                : view.getInt32(i * 4, true);
+        }
+        return values;
+    },
+
+    decompress: function(payload, compression) {
+        if (compression === 'zlib') {
+            const stream = new Blob([payload]).stream().pipeThrough(new DecompressionStream('deflate'));
+            return new Response(stream).arrayBuffer();
+        }
+        if (compression === 'brotli') {
+            if (typeof BrotliDecode !== 'function') {
+                return Promise.reject(new Error('brotli rasters need a BrotliDecode implementation'));
+            }
+            return Promise.resolve(BrotliDecode(new Int8Array(payload)).buffer);
+        }
+        return Promise.resolve(payload);
+    },
+};